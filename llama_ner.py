@@ -6,42 +6,37 @@ of the test sentences.
 """
 
 # Importing
-from transformers import AutoModelForTokenClassification, AutoTokenizer, AutoModelForCausalLM, AutoTokenizer
-import pandas as pd
-import seqeval.metrics
-import json
-
-def load_ner_data(file_path):
-    # Create an empty DataFrame to hold tokens and tags
-    data = pd.DataFrame(columns=["sentence_id", "words", "tags"])
-
-    current_words = []
-    current_tags = []
-    sentence_id = 0
-    sentences_data = []  # List to store each sentence's data
-
-    with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            line = line.strip()
-            # Check if the line is the start of a new sentence
-            if not line or line.startswith('# id'):
-                if current_words:  # Save the previous sentence
-                    sentences_data.append({"sentence_id": sentence_id, "words": current_words, "tags": current_tags})
-                    sentence_id += 1
-                current_words = []
-                current_tags = []
-            else:
-                # Split the line into columns
-                parts = line.split()
-                current_words.append(parts[0])
-                current_tags.append(parts[-1])  # The last column is the tag
-
-    # Using pandas.concat to add the list of sentence data to the DataFrame
-    data = pd.concat([data, pd.DataFrame(sentences_data)], ignore_index=True)
-
-    return data
-
-def create_ner_prompt(language, examples, annotations):
+from transformers import AutoModelForTokenClassification, AutoTokenizer, AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+import logging
+import time
+import torch
+from ner_conll import open_corpus
+from ner_constrained import TagGrammar
+from ner_continuous_batching import ContinuousBatchingEngine
+from ner_speculative import SpeculativeDecoder, PromptLookupDrafter, DraftModelDrafter
+from ner_backends import HuggingFaceBackend, OpenAICompletionsBackend
+from ner_instrumentation import METRICS_FORMATS, StageTracer, TimingStreamer, trace_stage
+from ner_cpu_inference import cache_model_name, configure_cpu_threads, load_cpu_model
+from ner_journal import SentenceJournal, model_settings, remove_journal, settings_fingerprint
+from ner_writer import AsyncFileWriter
+from ner_responses import record_decoded_response, finish_response, align_response, write_predictions_and_scores
+from ner_response_cache import ResponseCache, lookup_responses
+from ner_prompt_segments import PromptEncoder
+from ner_few_shot_packer import FewShotPacker, prompt_length_report
+from ner_tags import COMPACT_TAG_CODES, encode_tags, describe_compact_tags, compact_token_report
+from ner_generation import build_prefix_cache, generate_with_prefix_cache, bucket_by_length, generate_batch, tag_generation_kwargs, packed_generation_kwargs, max_response_tokens, max_packed_response_tokens
+
+def load_ner_data(file_path, tracer=None):
+    # Reuse the binary corpus cache next to the file while it is still valid, otherwise index the
+    # file so that only the sampled sentences are parsed
+    with trace_stage(tracer, 'load_ner_data', file=file_path):
+        return open_corpus(file_path)
+
+def create_ner_prompt_segments(language, examples, annotations, tag_codes=None, packed=False):
+    # The prompt as its fixed segments (the instruction header, the tag table, each example and the
+    # closing instruction), each ending in a newline so that they can be encoded separately. A packed
+    # prompt closes by asking for the tags of several numbered sentences instead of one
+
     # BIO Tags included
     entity_types = (
         "Location (LOC): B-Facility, I-Facility, B-OtherLOC, I-OtherLOC, B-HumanSettlement, I-HumanSettlement, B-Station, I-Station\n"
@@ -53,101 +48,403 @@ def create_ner_prompt(language, examples, annotations):
         "O (Outside of any entity)\n"
     )
 
-    prompt = f"For the following sequences of words in the {language} sentences, generate the appropriate sequence of BIO tags, each tag corresponding with each word in a sentence. Indicate the end of the generated sequence with a ##### symbol. ##### means that the sequence of BIO Tags for the corresponding sentence has ended. Each entity type is marked as 'B-' (beginning), 'I-' (inside), or 'O' (outside). Types include Location (LOC), Creative Work (CW), Group (GRP), Person (PER), Product (PROD), and Medical (MED). Here are all possible BIO Tags:\n{entity_types}\n Here are some examples:\n"
-
-    for i, (sentence, annotation) in enumerate(zip(examples, annotations), 1):
-        prompt += f"Sentence: {sentence}\n   Sequence of BIO Tags: {annotation} #####\n"
-
-    prompt += f"\nNow, using the same format as the examples, generate a sequence of BIO tags for the following sentence with each tag corresponding with each word in the new {language} sentence:\n"
+    # List the compact tag codes instead when the examples are annotated with them
+    if tag_codes is not None:
+        entity_types = describe_compact_tags(tag_codes)
 
-    return prompt
+    segments = [
+        f"For the following sequences of words in the {language} sentences, generate the appropriate sequence of BIO tags, each tag corresponding with each word in a sentence. Indicate the end of the generated sequence with a ##### symbol. ##### means that the sequence of BIO Tags for the corresponding sentence has ended. Each entity type is marked as 'B-' (beginning), 'I-' (inside), or 'O' (outside). Types include Location (LOC), Creative Work (CW), Group (GRP), Person (PER), Product (PROD), and Medical (MED). Here are all possible BIO Tags:\n",
+        entity_types,
+        "\n Here are some examples:\n",
+    ]
 
-def generate_prediction(sentence, model, tokenizer, prompt_template, decoded_response_filepath):
-    prompt = prompt_template + f"\nSentence: {sentence}\nSequence of BIO Tags:"
-    inputs = tokenizer.encode(prompt, return_tensors='pt')
+    for i, (sentence, annotation) in enumerate(zip(examples, annotations), 1):
+        segments.append(f"Sentence: {sentence}\n   Sequence of BIO Tags: {annotation} #####\n")
+
+    if packed:
+        segments.append(f"\nNow, using the same format as the examples, generate a sequence of BIO tags for each of the following numbered {language} sentences with each tag corresponding with each word in that sentence. Give the sequences in the same order as the sentences, each after its number and ended with #####:\n")
+    else:
+        segments.append(f"\nNow, using the same format as the examples, generate a sequence of BIO tags for the following sentence with each tag corresponding with each word in the new {language} sentence:\n")
+
+    return segments
+
+def create_packed_suffix(sentences):
+    # The numbered test sentences of a packed prompt, followed by the label of the first tag sequence
+    numbered_sentences = "".join(f"\nSentence {number}: {sentence}" for number, sentence in enumerate(sentences, 1))
+    return numbered_sentences + "\nSequence of BIO Tags 1:"
+
+def create_ner_prompt(language, examples, annotations, tag_codes=None):
+    return "".join(create_ner_prompt_segments(language, examples, annotations, tag_codes=tag_codes))
+
+def split_packed_response(generated_response, sentence_count):
+    # Split the response to a packed prompt into the response of each of its sentences, as
+    # extract_predicted_tags expects it. A sentence whose sequence is missing or carries the wrong
+    # number gets None, to be generated on its own instead. A sequence with too few or too many tags
+    # is kept, and aligned to its sentence like any other response
+    parts = generated_response.split("#####")
+    sentence_responses = []
+    for number in range(1, sentence_count + 1):
+        # Every sequence must be terminated, so the text after the last terminator is not one
+        if number >= len(parts):
+            sentence_responses.append(None)
+            continue
+
+        part = parts[number - 1].strip()
+        label = f"Sequence of BIO Tags {number}:"
+        if part.startswith(label):
+            part = part[len(label):].strip()
+        elif number > 1:
+            sentence_responses.append(None)
+            continue
+
+        sentence_responses.append(f" {part} #####")
+
+    return sentence_responses
+
+def generate_prediction(sentence, model, tokenizer, prompt_ids, decoded_response_writer, prefix_cache=None, tag_grammar=None, response_cache=None, speculative_decoder=None, tracer=None, sentence_id=None):
+    # The prompt arrives already encoded, assembled from its pre-tokenized segments
+    inputs = torch.tensor([prompt_ids])
 
     # Move input_ids to the same device as the model
     inputs = inputs.to(model.device)
 
-    outputs = model.generate(inputs, max_length=2500, num_return_sequences=1)
-    decoded_response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-    print("DECODED RESPONSE: ")
-    print(decoded_response)
-    print("/////////////////////////\n\n")
-
-    # Open the file for writing predictions
-    with open(decoded_response_filepath, 'w', encoding='utf-8') as decoded_response_file:
-        decoded_response_file.write(f"START OF DECODED RESPONSE \n\n")
-        decoded_response_file.write(decoded_response)
-        decoded_response_file.write(f"END OF DECODED RESPONSE \n\n\n")
-
-    # Identify the start of the predicted tags
-    start_index = decoded_response.find(f"Sentence: {sentence}\nSequence of BIO Tags:") + len(f"Sentence: {sentence}\nSequence of BIO Tags:")
-    if start_index == -1:
-        return []
-
-    # Locate the end of the predicted tags
-    end_index = decoded_response.find("#####", start_index)
-    predicted_tags_str = decoded_response[start_index:end_index].strip() if end_index != -1 else decoded_response[start_index:].strip()
-    predicted_tags = predicted_tags_str.split() if predicted_tags_str else []
-
-    return predicted_tags
-
-def clean_and_align_predicted_tags(predicted_tags, sentence_length):
-    # Replace any non-tag elements with 'O' and truncate or pad to match sentence length
-    cleaned_tags = [
-        tag if tag.startswith('B-') or tag.startswith('I-') or tag == 'O' else 'O'
-        for tag in predicted_tags
-    ]
-
-    return cleaned_tags[:sentence_length] + ['O'] * (sentence_length - len(cleaned_tags))
-
-def evaluate_for_language(model, tokenizer, language, dataset, few_shot_data, prediction_filepath, score_filepath, decoded_response_filepath):
-    # Prepare the initial part of the prompt with examples
-    example_sentences = [" ".join(words) for words in few_shot_data['words']]
-    example_annotations = [" ".join(tags) for tags in few_shot_data['tags']]
-    prompt = create_ner_prompt(language, example_sentences, example_annotations)
-
-    # List to store cleaned and aligned predicted tags
-    cleaned_predicted_tags = []
-
-    # Open the file for writing predictions
-    with open(prediction_filepath, 'w', encoding='utf-8') as prediction_file:
-
-        # Iterate over the test data
-        for index, row in dataset.iterrows():
-            sentence = " ".join(row['words'])
-            generated_prediction = generate_prediction(sentence, model, tokenizer, prompt, decoded_response_filepath)
-            aligned_tags = clean_and_align_predicted_tags(generated_prediction, len(row['words']))
-
-            # Save aligned tags and reference tags for each sentence
-            prediction_file.write(f"Sentence: {sentence}\n")
-            prediction_file.write(f"Predicted Tags: {' '.join(aligned_tags)}\n")
-            prediction_file.write(f"Reference Tags: {' '.join(row['tags'])}\n\n")
-
-            print("ALIGNED TAGS: ", aligned_tags)
-
-            cleaned_predicted_tags.append(aligned_tags)
-
-    # Actual tags from the test data
-    actual_tags = [tags for tags in dataset['tags']]
-
-    # Calculate evaluation metrics
-    precision = seqeval.metrics.precision_score(actual_tags, cleaned_predicted_tags)
-    recall = seqeval.metrics.recall_score(actual_tags, cleaned_predicted_tags)
-    f1_score = seqeval.metrics.f1_score(actual_tags, cleaned_predicted_tags)
-
-    # Save the scores
-    with open(score_filepath, 'w', encoding='utf-8') as score_file:
-        scores = {
-            'Precision': precision,
-            'Recall': recall,
-            'F1-Score': f1_score
-        }
-        score_file.write(json.dumps(scores, indent=4))
-
-    print(f"Precision: {precision}, Recall: {recall}, F1-Score: {f1_score}")
+    # Stop once the tag sequence is terminated or has a tag for every word
+    generation_kwargs = tag_generation_kwargs(tokenizer, inputs.shape[1], [len(sentence.split())], tag_grammar=tag_grammar)
+
+    # Serve the response from the response cache if this prompt was generated before
+    cache_key = response_cache.make_key(inputs[0].tolist(), constrained=tag_grammar is not None) if response_cache is not None else None
+    generated_response = response_cache.get(cache_key) if cache_key is not None else None
+
+    if generated_response is None and speculative_decoder is not None:
+        # Let the drafter propose several tokens at a time for the model to verify in one pass
+        start_time = time.perf_counter()
+        generated_tokens = speculative_decoder.generated_tokens
+        generated_response = speculative_decoder.generate(prompt_ids, len(sentence.split()))
+        if tracer is not None:
+            tracer.add_stage('generate', time.perf_counter() - start_time)
+            tracer.sentence(sentence_id, time.perf_counter() - start_time, len(prompt_ids), speculative_decoder.generated_tokens - generated_tokens)
+        if cache_key is not None:
+            response_cache.put(cache_key, generated_response)
+    elif generated_response is None:
+        # When tracing, the streamer times the prefill apart from the decode steps
+        streamer = TimingStreamer() if tracer is not None else None
+
+        # Reuse the few shot prefix's key/value cache when one was built for this prompt
+        if prefix_cache is not None:
+            outputs = generate_with_prefix_cache(model, inputs, prefix_cache, num_return_sequences=1, streamer=streamer, **generation_kwargs)
+        else:
+            outputs = model.generate(inputs, num_return_sequences=1, streamer=streamer, **generation_kwargs)
+
+        # Only the newly generated tokens need decoding, the prompt is already known
+        with trace_stage(tracer, 'detokenization'):
+            generated_response = tokenizer.decode(outputs[0, inputs.shape[1]:], skip_special_tokens=True)
+        if streamer is not None:
+            tracer.add_stage('prefill', streamer.prefill_seconds())
+            tracer.add_stage('decode', streamer.decode_seconds())
+            tracer.sentence(sentence_id, streamer.end_time - streamer.start_time, inputs.shape[1], outputs.shape[1] - inputs.shape[1], prefill_seconds=streamer.prefill_seconds(), decode_seconds=streamer.decode_seconds())
+        if cache_key is not None:
+            response_cache.put(cache_key, generated_response)
+
+    record_decoded_response(f"Sentence: {sentence}\nSequence of BIO Tags:{generated_response}", decoded_response_writer)
+
+    return generated_response
+
+def generate_predictions_backend(dataset, backend, prompt_ids, decoded_response_writer, constrained=False, response_cache=None, on_response=None):
+    # Generate responses for all test sentences through an inference backend, keyed by the dataset
+    # index of each sentence's row. Responses may finish in any order. Each one is cached and passed
+    # to on_response as soon as it arrives, while the decoded responses are written in the dataset's
+    # order. The encoded prompts are keyed by row index as well
+    sentences = {sentence.sentence_id: sentence.text for sentence in dataset}
+    indices = list(sentences)
+    encoded_prompts = [prompt_ids[index] for index in indices]
+
+    # Sentences whose prompt was generated before are served from the response cache
+    cache_keys, cached_responses, to_generate = lookup_responses(response_cache, encoded_prompts, constrained=constrained)
+
+    generated_responses = {}
+    written = 0
+
+    def write_in_order():
+        nonlocal written
+        while written < len(indices) and indices[written] in generated_responses:
+            record_decoded_response(f"Sentence: {sentences[indices[written]]}\nSequence of BIO Tags:{generated_responses[indices[written]]}", decoded_response_writer)
+            written += 1
+
+    # The backend's requests are keyed by row index as well, so its traced sentences carry their row ids
+    positions = {index: position for position, index in enumerate(indices)}
+
+    def on_finished(index, generated_response):
+        position = positions[index]
+        if cache_keys is not None and position not in cached_responses:
+            response_cache.put(cache_keys[position], generated_response)
+        generated_responses[index] = generated_response
+        if on_response is not None:
+            on_response(index, generated_response)
+        write_in_order()
+
+    for position, generated_response in sorted(cached_responses.items()):
+        on_finished(indices[position], generated_response)
+
+    requests = [(indices[position], encoded_prompts[position], len(sentences[indices[position]].split())) for position in to_generate]
+    try:
+        backend.generate(requests, on_finished=on_finished)
+    finally:
+        # An interrupted run still writes every response it got, leaving out the missing ones
+        for index in indices[written:]:
+            if index in generated_responses:
+                record_decoded_response(f"Sentence: {sentences[index]}\nSequence of BIO Tags:{generated_responses[index]}", decoded_response_writer)
+
+    return generated_responses
+
+def generate_predictions_batched(dataset, model, tokenizer, prompt_ids, decoded_response_writer, batch_size, prefix_cache=None, tag_grammar=None, response_cache=None, on_response=None, tracer=None):
+    # Generate responses for all test sentences in batches of similar prompt length, keyed by the
+    # dataset index of each sentence's row. Each response is also passed to on_response as soon as
+    # its batch is done
+    backend = HuggingFaceBackend(model, tokenizer, batch_size, prefix_cache=prefix_cache, tag_grammar=tag_grammar, tracer=tracer)
+
+    return generate_predictions_backend(dataset, backend, prompt_ids, decoded_response_writer, constrained=tag_grammar is not None, response_cache=response_cache, on_response=on_response)
+
+def generate_predictions_packed(packs, model, tokenizer, prompt_ids, decoded_response_writer, batch_size, prefix_cache=None, response_cache=None, on_response=None, tracer=None):
+    # Generate responses for packs of test sentences that each share one prompt, given the encoded
+    # prompt of every pack in order, in batches of similar prompt length. The responses are split per
+    # sentence and keyed by the dataset index of each sentence's row. Sentences whose part of their
+    # pack's response is missing are left out, for the caller to generate on their own
+    cache_keys, cached_responses, to_generate = lookup_responses(response_cache, prompt_ids, constrained=False)
+
+    generated_responses = {}
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    def finish_pack(position, packed_response, latency=None, generated_tokens=0):
+        pack = packs[position]
+        for number, (sentence, sentence_response) in enumerate(zip(pack, split_packed_response(packed_response, len(pack)))):
+            if sentence_response is None:
+                continue
+
+            # When tracing, each sentence takes its pack's latency and an even share of its pack's
+            # prompt and generated tokens
+            if tracer is not None and latency is not None:
+                prompt_tokens = len(prompt_ids[position]) // len(pack) + (number < len(prompt_ids[position]) % len(pack))
+                sentence_tokens = generated_tokens // len(pack) + (number < generated_tokens % len(pack))
+                tracer.sentence(sentence.sentence_id, latency, prompt_tokens, sentence_tokens)
+            finish_response(generated_responses, sentence.sentence_id, sentence.text, sentence_response, decoded_response_writer, on_response)
+
+    for position, packed_response in sorted(cached_responses.items()):
+        finish_pack(position, packed_response)
+
+    for batch in bucket_by_length([len(prompt_ids[position]) for position in to_generate], batch_size):
+        batch = [to_generate[position] for position in batch]
+
+        # Each packed response stops once it holds a terminated sequence for every sentence in its pack
+        prompt_width = max(len(prompt_ids[position]) for position in batch)
+        generation_kwargs = packed_generation_kwargs(tokenizer, prompt_width, [[len(sentence) for sentence in packs[position]] for position in batch])
+        start_time = time.perf_counter()
+        outputs = generate_batch(model, tokenizer, [prompt_ids[position] for position in batch], prefix_cache=prefix_cache, num_return_sequences=1, **generation_kwargs)
+        latency = time.perf_counter() - start_time
+
+        for position, output in zip(batch, outputs):
+            packed_response = tokenizer.decode(output[prompt_width:], skip_special_tokens=True)
+            if cache_keys is not None:
+                response_cache.put(cache_keys[position], packed_response)
+            # every pack of a batch finishes with the batch. Padding after an early stop is not generated
+            finish_pack(position, packed_response, latency, int((output[prompt_width:] != pad_token_id).sum()))
+
+    return generated_responses
+
+def generate_predictions_continuous(dataset, model, tokenizer, prompt_ids, decoded_response_writer, decode_slots, prefix_cache=None, tag_grammar=None, response_cache=None, on_response=None, tracer=None):
+    # Generate responses for all test sentences through a fixed number of continuously refilled
+    # decode slots, keyed by the dataset index of each sentence's row. Each response is also passed
+    # to on_response as soon as its sentence is evicted
+    engine = ContinuousBatchingEngine(model, tokenizer, decode_slots, prefix_cache=prefix_cache, tag_grammar=tag_grammar, tracer=tracer)
+    generated_responses = generate_predictions_backend(dataset, engine, prompt_ids, decoded_response_writer, constrained=tag_grammar is not None, response_cache=response_cache, on_response=on_response)
+    print("CONTINUOUS BATCHING STATS: ", engine.stats)
+
+    return generated_responses
+
+def build_language_prompt(tokenizer, language, dataset, few_shot_data, compact_tags=False, packed=False):
+    # Prepare the initial part of the prompt with examples, as its segments
+    example_sentences = [sentence.text for sentence in few_shot_data]
+    example_annotations = [" ".join(sentence.tags) for sentence in few_shot_data]
+
+    # In compact mode the examples are annotated with the compact tag codes, and the number of tokens
+    # this saves against the full tags is reported
+    tag_codes = COMPACT_TAG_CODES if compact_tags else None
+    token_report = None
+    if tag_codes is not None:
+        compact_annotations = [" ".join(encode_tags(sentence.tags, tag_codes)) for sentence in few_shot_data]
+        prompt_segments = create_ner_prompt_segments(language, example_sentences, compact_annotations, tag_codes=tag_codes, packed=packed)
+        token_report = compact_token_report(tokenizer, create_ner_prompt(language, example_sentences, example_annotations), "".join(prompt_segments), [sentence.tags for sentence in dataset], tag_codes)
+    else:
+        prompt_segments = create_ner_prompt_segments(language, example_sentences, example_annotations, packed=packed)
+
+    return prompt_segments, tag_codes, token_report
+
+def generate_for_language(model, tokenizer, language, dataset, few_shot_data, decoded_response_filepath, use_prefix_cache=False, batch_size=1, constrained=False, compact_tags=False, decode_slots=0, response_cache=None, journal_filepath=None, prompt_token_budget=None, prompt_overflow='trim', sentences_per_prompt=1, speculative_drafter=None, speculative_tokens=8, backend=None, tracer=None):
+    # Generate and align the tags of every sentence in the dataset, returning them keyed by row index
+    # together with the compact tag token report, if any, and the generation throughput report
+    if sentences_per_prompt > 1 and (constrained or decode_slots > 0):
+        raise ValueError("Packed prompts are generated in plain batches, without constrained decoding or decode slots")
+    if speculative_drafter is not None and (batch_size > 1 or decode_slots > 0 or constrained or sentences_per_prompt > 1):
+        raise ValueError("Speculative decoding generates one sentence at a time, without batches, decode slots, constrained decoding or packed prompts")
+    if backend is not None and (constrained or decode_slots > 0 or sentences_per_prompt > 1 or speculative_drafter is not None):
+        raise ValueError("A separate inference backend only generates plain responses, without constrained decoding, decode slots, packed prompts or speculative decoding")
+    if isinstance(speculative_drafter, str) and speculative_drafter != 'prompt_lookup':
+        raise ValueError(f"Unknown speculative drafter {speculative_drafter!r}, expected 'prompt_lookup' or a draft model")
+
+    # Every stage and sentence from here on is traced against this language
+    if tracer is not None:
+        tracer.begin_language(language)
+
+    with trace_stage(tracer, 'prompt_construction'):
+        prompt_segments, tag_codes, token_report = build_language_prompt(tokenizer, language, dataset, few_shot_data, compact_tags=compact_tags)
+    if token_report is not None:
+        print("COMPACT TAG TOKEN REPORT: ", token_report)
+
+    # With several sentences per prompt, the prompts close by asking for every numbered sentence's tags
+    packed_segments = None
+    if sentences_per_prompt > 1:
+        with trace_stage(tracer, 'prompt_construction', packed=True):
+            packed_segments = build_language_prompt(tokenizer, language, dataset, few_shot_data, compact_tags=compact_tags, packed=True)[0]
+
+    # The prompt prefix is fixed for the whole language, so its key/value cache only needs computing
+    # once. A separate inference backend keeps its own caches
+    prefix_cache = build_prefix_cache(model, tokenizer, "".join(packed_segments or prompt_segments)) if use_prefix_cache and backend is None else None
+
+    # The tag grammar only depends on the tokenizer, so it is built once per language as well
+    tag_grammar = TagGrammar(tokenizer, tag_codes=tag_codes) if constrained else None
+
+    # Speculative decoding drafts tokens by prompt lookup or with a small draft model, starting each
+    # sentence from the few shot prefix cache as well
+    speculative_decoder = None
+    if speculative_drafter == 'prompt_lookup':
+        speculative_decoder = SpeculativeDecoder(model, tokenizer, PromptLookupDrafter(speculative_tokens), prefix_cache=prefix_cache)
+    elif speculative_drafter is not None:
+        speculative_decoder = SpeculativeDecoder(model, tokenizer, DraftModelDrafter(speculative_drafter, speculative_tokens), prefix_cache=prefix_cache)
+
+    # Aligned tags for every sentence keyed by row index, starting from the sentences already completed
+    # in the journal by an interrupted run, which are not generated again. The journal is only resumed
+    # if it was written with the same model, prompt and options, and the tags of its sentences are
+    # parsed again from their raw responses
+    journal = None
+    aligned_predictions = {}
+    if journal_filepath is not None:
+        journal_fingerprint = settings_fingerprint({
+            'Model': {'Model': backend.model_name, 'Backend': backend.cache_settings()} if backend is not None else model_settings(model),
+            'Tokenizer': tokenizer.name_or_path,
+            'Language': language,
+            'Prompt': "".join(prompt_segments) + "".join(packed_segments or []),
+            'Few Shot Sentence Ids': [int(index) for index in few_shot_data.index],
+            'Constrained': constrained,
+            'Compact Tags': compact_tags,
+            'Prompt Token Budget': prompt_token_budget,
+            'Prompt Overflow': prompt_overflow,
+            'Sentences Per Prompt': sentences_per_prompt,
+        })
+        journal = SentenceJournal(journal_filepath, fingerprint=journal_fingerprint)
+        aligned_predictions = {int(index): align_response(journal.entries[index]['response'], len(dataset.by_id(index)), tag_codes=tag_codes) for index in dataset.index if index in journal}
+        print(f"RESUMING FROM JOURNAL: {len(aligned_predictions)} of {len(dataset)} sentences already done")
+    remaining_dataset = dataset.drop(list(aligned_predictions))
+
+    # Prompts are encoded from the pre-tokenized prompt segments, with their suffixes encoded in a
+    # single batched call. With a prompt token budget, each prompt keeps as many of the few shot
+    # examples as fit alongside the most tokens its response may take
+    prompt_encoder = PromptEncoder(tokenizer)
+    packer = FewShotPacker(prompt_encoder, prompt_token_budget, overflow=prompt_overflow) if prompt_token_budget is not None else None
+
+    def encode_prompts(segments, suffixes, response_tokens):
+        templates = [segments] * len(suffixes)
+        if packer is not None:
+            templates = [packer.pack(segments, len(few_shot_data), suffix, response_tokens=tokens) for suffix, tokens in zip(suffixes, response_tokens)]
+        with trace_stage(tracer, 'tokenization', prompts=len(suffixes)):
+            encoded_prompts = prompt_encoder.encode_prompts(templates, suffixes)
+        print("PROMPT LENGTH REPORT: ", prompt_length_report(encoded_prompts, prompt_token_budget))
+
+        return encoded_prompts
+
+    # The remaining sentences are split into packs sharing a prompt, or each get their own prompt
+    if sentences_per_prompt > 1:
+        packs = [remaining_dataset[start:start + sentences_per_prompt] for start in range(0, len(remaining_dataset), sentences_per_prompt)]
+        packed_prompt_ids = encode_prompts(packed_segments, [create_packed_suffix([sentence.text for sentence in pack]) for pack in packs], [max_packed_response_tokens([len(sentence) for sentence in pack]) for pack in packs])
+    else:
+        prompt_ids = dict(zip(remaining_dataset.index, encode_prompts(prompt_segments, [f"\nSentence: {row.text}\nSequence of BIO Tags:" for row in remaining_dataset], [max_response_tokens(len(row)) for row in remaining_dataset])))
+
+    # Decoded responses go through a background writer, appending to the earlier responses when resuming
+    decoded_response_writer = AsyncFileWriter(decoded_response_filepath, mode='a' if aligned_predictions else 'w')
+
+    def record_response(index, generated_response):
+        with trace_stage(tracer, 'parsing'):
+            aligned_predictions[index] = align_response(generated_response, len(dataset.by_id(index)), tag_codes=tag_codes)
+
+        # Journal the sentence as soon as it is done, so a crash only loses the sentences in flight
+        if journal is not None:
+            journal.record(int(index), generated_response, aligned_predictions[index])
+
+    # The writer and the journal are closed even if generation is interrupted, keeping every finished response
+    sentence_count = len(remaining_dataset)
+    fallback_count = 0
+    start_time = time.perf_counter()
+    try:
+        if sentences_per_prompt > 1:
+            with trace_stage(tracer, 'generate', packs=len(packs)):
+                generated_responses = generate_predictions_packed(packs, model, tokenizer, packed_prompt_ids, decoded_response_writer, batch_size, prefix_cache=prefix_cache, response_cache=response_cache, on_response=record_response, tracer=tracer)
+
+            # Sentences whose part of their pack's response was missing fall back to a prompt of their own
+            remaining_dataset = remaining_dataset.drop(list(generated_responses))
+            fallback_count = len(remaining_dataset)
+            print(f"PACKED PROMPT FALLBACK: {fallback_count} of {sum(len(pack) for pack in packs)} sentences")
+            prompt_ids = dict(zip(remaining_dataset.index, encode_prompts(prompt_segments, [f"\nSentence: {row.text}\nSequence of BIO Tags:" for row in remaining_dataset], [max_response_tokens(len(row)) for row in remaining_dataset])))
+
+        # With a separate inference backend, decode slots or a batch size above one, every remaining
+        # response is generated up front, otherwise one sentence at a time
+        if backend is not None:
+            generate_predictions_backend(remaining_dataset, backend, prompt_ids, decoded_response_writer, response_cache=response_cache, on_response=record_response)
+            print("INFERENCE BACKEND STATS: ", backend.stats)
+        elif decode_slots > 0:
+            generate_predictions_continuous(remaining_dataset, model, tokenizer, prompt_ids, decoded_response_writer, decode_slots, prefix_cache=prefix_cache, tag_grammar=tag_grammar, response_cache=response_cache, on_response=record_response, tracer=tracer)
+        elif batch_size > 1:
+            generate_predictions_batched(remaining_dataset, model, tokenizer, prompt_ids, decoded_response_writer, batch_size, prefix_cache=prefix_cache, tag_grammar=tag_grammar, response_cache=response_cache, on_response=record_response, tracer=tracer)
+        else:
+            for row in remaining_dataset:
+                index, sentence = row.sentence_id, row.text
+                record_response(index, generate_prediction(sentence, model, tokenizer, prompt_ids[index], decoded_response_writer, prefix_cache=prefix_cache, tag_grammar=tag_grammar, response_cache=response_cache, speculative_decoder=speculative_decoder, tracer=tracer, sentence_id=index))
+    finally:
+        with trace_stage(tracer, 'file_writes', file=decoded_response_filepath):
+            decoded_response_writer.close()
+            if journal is not None:
+                journal.close()
+    generation_seconds = time.perf_counter() - start_time
+    print("PROMPT SEGMENT STATS: ", prompt_encoder.stats())
+    if packer is not None:
+        print("FEW SHOT PACKER STATS: ", packer.stats())
+    if speculative_decoder is not None:
+        print("SPECULATIVE DECODING STATS: ", speculative_decoder.stats())
+
+    # How many sentences each prompt carried and how fast they were generated, to weigh against the F1-score
+    throughput_report = {
+        'Sentences Per Prompt': sentences_per_prompt,
+        'Sentences': sentence_count,
+        'Prompts': (len(packs) if sentences_per_prompt > 1 else 0) + len(prompt_ids),
+        'Fallback Sentences': fallback_count,
+        'Generation Seconds': generation_seconds,
+        'Sentences Per Second': sentence_count / generation_seconds if generation_seconds > 0 else 0.0,
+    }
+    print("THROUGHPUT REPORT: ", throughput_report)
+
+    return aligned_predictions, token_report, throughput_report
+
+def evaluate_for_language(model, tokenizer, language, dataset, few_shot_data, prediction_filepath, score_filepath, decoded_response_filepath, use_prefix_cache=False, batch_size=1, constrained=False, compact_tags=False, decode_slots=0, response_cache=None, journal_filepath=None, prompt_token_budget=None, prompt_overflow='trim', sentences_per_prompt=1, speculative_drafter=None, speculative_tokens=8, backend=None, tracer=None, metrics_filepath=None):
+    aligned_predictions, token_report, throughput_report = generate_for_language(model, tokenizer, language, dataset, few_shot_data, decoded_response_filepath, use_prefix_cache=use_prefix_cache, batch_size=batch_size, constrained=constrained, compact_tags=compact_tags, decode_slots=decode_slots, response_cache=response_cache, journal_filepath=journal_filepath, prompt_token_budget=prompt_token_budget, prompt_overflow=prompt_overflow, sentences_per_prompt=sentences_per_prompt, speculative_drafter=speculative_drafter, speculative_tokens=speculative_tokens, backend=backend, tracer=tracer)
+    scores = write_predictions_and_scores(dataset, aligned_predictions, prediction_filepath, score_filepath, token_report=token_report, tracer=tracer)
+    remove_journal(journal_filepath)
+
+    # The throughput of this run against its F1-score, for choosing how many sentences to pack per prompt
+    print(f"THROUGHPUT VS F1: {throughput_report['Sentences Per Prompt']} sentences per prompt, {throughput_report['Sentences Per Second']:.3f} sentences per second, {throughput_report['Fallback Sentences']} fallback sentences, F1-Score {scores['F1-Score']}")
+
+    if response_cache is not None:
+        print("RESPONSE CACHE STATS: ", response_cache.stats())
+
+    # This language's stage times, latency quantiles, tokens per second and peak memory
+    if tracer is not None and metrics_filepath is not None:
+        tracer.write_summary(metrics_filepath, language)
 
 def get_examples_and_sample(dataset, few_shot_size, sample_size):
     # sample the dataset for the few shot examples and remove them from the dataset
@@ -161,38 +458,65 @@ def get_examples_and_sample(dataset, few_shot_size, sample_size):
 if __name__ == '__main__':
     FEW_SHOT_SIZE = 10
     SAMPLE_SIZE = 300
+    USE_PREFIX_CACHE = False
+    BATCH_SIZE = 1
+    CONSTRAINED_DECODING = False
+    COMPACT_TAGS = False
+    DECODE_SLOTS = 0
+    USE_RESPONSE_CACHE = True
+    PROMPT_TOKEN_BUDGET = None
+    PROMPT_OVERFLOW = 'trim'
+    SENTENCES_PER_PROMPT = 1
+    SPECULATIVE_DRAFTER = None
+    SPECULATIVE_TOKENS = 8
+    DRAFT_MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+    BACKEND = 'huggingface'
+    SERVER_URL = "http://localhost:8000/v1"
+    SERVER_CONCURRENCY = 32
+    LOG_LEVEL = 'INFO'
+    TRACE = True
+    METRICS_FORMAT = 'prometheus'
+    CPU_PRECISION = None
+    CPU_THREADS = None
 
     folder_path = 'INSERT_FOLDER_PATH_HERE'
 
-    # Filenames
+    # Decoded responses and aligned tags are only printed at the DEBUG log level
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
+
+    # Every stage and sentence of the run is traced to a JSONL file, with a metrics summary per language
+    tracer = StageTracer(folder_path + "trace.jsonl", METRICS_FORMAT) if TRACE else None
+    metrics_extension = METRICS_FORMATS[METRICS_FORMAT]
+
+    # Filenames, each parsed once into a cached corpus that later runs memory map
 
     # English Data
     en_test_file_path = folder_path + 'en_test.conll'
-    en_test_ner_data = load_ner_data(en_test_file_path)
+    en_test_ner_data = load_ner_data(en_test_file_path, tracer=tracer)
 
     # Bangla Data
     bn_test_file_path = folder_path + 'bn_test.conll'
-    bn_test_ner_data = load_ner_data(bn_test_file_path)
+    bn_test_ner_data = load_ner_data(bn_test_file_path, tracer=tracer)
 
     # Farsi Data
     fa_test_file_path = folder_path + 'fa_test.conll'
-    fa_test_ner_data = load_ner_data(fa_test_file_path)
+    fa_test_ner_data = load_ner_data(fa_test_file_path, tracer=tracer)
 
     # Hindi Data
     hi_test_file_path = folder_path + 'hi_test.conll'
-    hi_test_ner_data = load_ner_data(hi_test_file_path)
+    hi_test_ner_data = load_ner_data(hi_test_file_path, tracer=tracer)
 
     # Portuguese Data
     pt_test_file_path = folder_path + 'pt_test.conll'
-    pt_test_ner_data = load_ner_data(pt_test_file_path)
+    pt_test_ner_data = load_ner_data(pt_test_file_path, tracer=tracer)
 
     # Italian Data
     it_test_file_path = folder_path + 'it_test.conll'
-    it_test_ner_data = load_ner_data(it_test_file_path)
+    it_test_ner_data = load_ner_data(it_test_file_path, tracer=tracer)
 
     # Ukrainian Data
     uk_test_file_path = folder_path + 'uk_test.conll'
-    uk_test_ner_data = load_ner_data(uk_test_file_path)
+    uk_test_ner_data = load_ner_data(uk_test_file_path, tracer=tracer)
 
     # English Sample
     en_test_ner_data_few_shot, en_test_ner_data_sample = get_examples_and_sample(en_test_ner_data, FEW_SHOT_SIZE, SAMPLE_SIZE)
@@ -219,53 +543,95 @@ if __name__ == '__main__':
     model_name = "meta-llama/Llama-2-7b-chat-hf"
 
     tokenizer = AutoTokenizer.from_pretrained(model_name, token="INSERT_TOKEN_HERE")
-    model = AutoModelForCausalLM.from_pretrained(model_name, token="INSERT_TOKEN_HERE", device_map = 'auto')
+    if BACKEND == 'openai':
+        # The model is served by a separate inference server, so only its generation config is loaded
+        model = None
+        backend = OpenAICompletionsBackend(SERVER_URL, model_name, generation_config=GenerationConfig.from_pretrained(model_name, token="INSERT_TOKEN_HERE"), max_concurrency=SERVER_CONCURRENCY, tracer=tracer)
+    elif CPU_PRECISION is not None:
+        # On a CPU node the model is memory mapped, optionally quantized, and pinned to a fixed set of cores
+        configure_cpu_threads(CPU_THREADS)
+        model = load_cpu_model(model_name, token="INSERT_TOKEN_HERE", precision=CPU_PRECISION)
+        backend = None
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name, token="INSERT_TOKEN_HERE", device_map = 'auto')
+        backend = None
+
+    # Speculative decoding drafts by prompt lookup, or with a small model sharing Llama-2's tokenizer
+    speculative_drafter = SPECULATIVE_DRAFTER
+    if SPECULATIVE_DRAFTER == 'draft_model' and CPU_PRECISION is not None:
+        speculative_drafter = load_cpu_model(DRAFT_MODEL_NAME, precision=CPU_PRECISION)
+    elif SPECULATIVE_DRAFTER == 'draft_model':
+        speculative_drafter = AutoModelForCausalLM.from_pretrained(DRAFT_MODEL_NAME, device_map = 'auto')
+
+    # Responses already generated by an earlier run with the same prompts and settings are reused
+    response_cache = ResponseCache(folder_path + "response_cache.sqlite", cache_model_name(model_name, CPU_PRECISION), backend.cache_settings() if backend is not None else model.generation_config.to_dict()) if USE_RESPONSE_CACHE else None
 
     print("ENGLISH")
     en_prediction_filepath = folder_path + "en_predicted_vs_reference_tags.txt"
     en_score_filepath = folder_path + "en_evaluation_scores.json"
     en_decoded_filepath = folder_path + "en_decoded_responses.txt"
-    evaluate_for_language(model, tokenizer, "English", en_test_ner_data_sample, en_test_ner_data_few_shot, en_prediction_filepath, en_score_filepath, en_decoded_filepath)
+    en_journal_filepath = folder_path + "en_journal.jsonl"
+    en_metrics_filepath = folder_path + "en_metrics" + metrics_extension
+    evaluate_for_language(model, tokenizer, "English", en_test_ner_data_sample, en_test_ner_data_few_shot, en_prediction_filepath, en_score_filepath, en_decoded_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=en_journal_filepath, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, sentences_per_prompt=SENTENCES_PER_PROMPT, speculative_drafter=speculative_drafter, speculative_tokens=SPECULATIVE_TOKENS, backend=backend, tracer=tracer, metrics_filepath=en_metrics_filepath)
     print()
 
     print("BANGLA")
     bn_prediction_filepath = folder_path + "bn_predicted_vs_reference_tags.txt"
     bn_score_filepath = folder_path + "bn_evaluation_scores.json"
     bn_decoded_filepath = folder_path + "bn_decoded_responses.txt"
-    evaluate_for_language(model, tokenizer, "Bangla", bn_test_ner_data_sample, bn_test_ner_data_few_shot, bn_prediction_filepath, bn_score_filepath, bn_decoded_filepath)
+    bn_journal_filepath = folder_path + "bn_journal.jsonl"
+    bn_metrics_filepath = folder_path + "bn_metrics" + metrics_extension
+    evaluate_for_language(model, tokenizer, "Bangla", bn_test_ner_data_sample, bn_test_ner_data_few_shot, bn_prediction_filepath, bn_score_filepath, bn_decoded_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=bn_journal_filepath, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, sentences_per_prompt=SENTENCES_PER_PROMPT, speculative_drafter=speculative_drafter, speculative_tokens=SPECULATIVE_TOKENS, backend=backend, tracer=tracer, metrics_filepath=bn_metrics_filepath)
     print()
 
     print("FARSI")
     fa_prediction_filepath = folder_path + "fa_predicted_vs_reference_tags.txt"
     fa_score_filepath = folder_path + "fa_evaluation_scores.json"
     fa_decoded_filepath = folder_path + "fa_decoded_responses.txt"
-    evaluate_for_language(model, tokenizer, "Farsi", fa_test_ner_data_sample, fa_test_ner_data_few_shot, fa_prediction_filepath, fa_score_filepath, fa_decoded_filepath)
+    fa_journal_filepath = folder_path + "fa_journal.jsonl"
+    fa_metrics_filepath = folder_path + "fa_metrics" + metrics_extension
+    evaluate_for_language(model, tokenizer, "Farsi", fa_test_ner_data_sample, fa_test_ner_data_few_shot, fa_prediction_filepath, fa_score_filepath, fa_decoded_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=fa_journal_filepath, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, sentences_per_prompt=SENTENCES_PER_PROMPT, speculative_drafter=speculative_drafter, speculative_tokens=SPECULATIVE_TOKENS, backend=backend, tracer=tracer, metrics_filepath=fa_metrics_filepath)
     print()
 
     print("HINDI")
     hi_prediction_filepath = folder_path + "hi_predicted_vs_reference_tags.txt"
     hi_score_filepath = folder_path + "hi_evaluation_scores.json"
     hi_decoded_filepath = folder_path + "hi_decoded_responses.txt"
-    evaluate_for_language(model, tokenizer, "Hindi", hi_test_ner_data_sample, hi_test_ner_data_few_shot, hi_prediction_filepath, hi_score_filepath, hi_decoded_filepath)
+    hi_journal_filepath = folder_path + "hi_journal.jsonl"
+    hi_metrics_filepath = folder_path + "hi_metrics" + metrics_extension
+    evaluate_for_language(model, tokenizer, "Hindi", hi_test_ner_data_sample, hi_test_ner_data_few_shot, hi_prediction_filepath, hi_score_filepath, hi_decoded_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=hi_journal_filepath, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, sentences_per_prompt=SENTENCES_PER_PROMPT, speculative_drafter=speculative_drafter, speculative_tokens=SPECULATIVE_TOKENS, backend=backend, tracer=tracer, metrics_filepath=hi_metrics_filepath)
     print()
 
     print("PORTUGUESE")
     pt_prediction_filepath = folder_path + "pt_predicted_vs_reference_tags.txt"
     pt_score_filepath = folder_path + "pt_evaluation_scores.json"
     pt_decoded_filepath = folder_path + "pt_decoded_responses.txt"
-    evaluate_for_language(model, tokenizer, "Portuguese", pt_test_ner_data_sample, pt_test_ner_data_few_shot, pt_prediction_filepath, pt_score_filepath, pt_decoded_filepath)
+    pt_journal_filepath = folder_path + "pt_journal.jsonl"
+    pt_metrics_filepath = folder_path + "pt_metrics" + metrics_extension
+    evaluate_for_language(model, tokenizer, "Portuguese", pt_test_ner_data_sample, pt_test_ner_data_few_shot, pt_prediction_filepath, pt_score_filepath, pt_decoded_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=pt_journal_filepath, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, sentences_per_prompt=SENTENCES_PER_PROMPT, speculative_drafter=speculative_drafter, speculative_tokens=SPECULATIVE_TOKENS, backend=backend, tracer=tracer, metrics_filepath=pt_metrics_filepath)
     print()
 
     print("ITALIAN")
     it_prediction_filepath = folder_path + "it_predicted_vs_reference_tags.txt"
     it_score_filepath = folder_path + "it_evaluation_scores.json"
     it_decoded_filepath = folder_path + "it_decoded_responses.txt"
-    evaluate_for_language(model, tokenizer, "Italian", it_test_ner_data_sample, it_test_ner_data_few_shot, it_prediction_filepath, it_score_filepath, it_decoded_filepath)
+    it_journal_filepath = folder_path + "it_journal.jsonl"
+    it_metrics_filepath = folder_path + "it_metrics" + metrics_extension
+    evaluate_for_language(model, tokenizer, "Italian", it_test_ner_data_sample, it_test_ner_data_few_shot, it_prediction_filepath, it_score_filepath, it_decoded_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=it_journal_filepath, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, sentences_per_prompt=SENTENCES_PER_PROMPT, speculative_drafter=speculative_drafter, speculative_tokens=SPECULATIVE_TOKENS, backend=backend, tracer=tracer, metrics_filepath=it_metrics_filepath)
     print()
 
     print("UKRAINIAN")
     uk_prediction_filepath = folder_path + "uk_predicted_vs_reference_tags.txt"
     uk_score_filepath = folder_path + "uk_evaluation_scores.json"
     uk_decoded_filepath = folder_path + "uk_decoded_responses.txt"
-    evaluate_for_language(model, tokenizer, "Ukrainian", uk_test_ner_data_sample, uk_test_ner_data_few_shot, uk_prediction_filepath, uk_score_filepath, uk_decoded_filepath)
+    uk_journal_filepath = folder_path + "uk_journal.jsonl"
+    uk_metrics_filepath = folder_path + "uk_metrics" + metrics_extension
+    evaluate_for_language(model, tokenizer, "Ukrainian", uk_test_ner_data_sample, uk_test_ner_data_few_shot, uk_prediction_filepath, uk_score_filepath, uk_decoded_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=uk_journal_filepath, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, sentences_per_prompt=SENTENCES_PER_PROMPT, speculative_drafter=speculative_drafter, speculative_tokens=SPECULATIVE_TOKENS, backend=backend, tracer=tracer, metrics_filepath=uk_metrics_filepath)
     print()
+
+    if response_cache is not None:
+        response_cache.close()
+
+    # The whole run's summary, including loading the data
+    if tracer is not None:
+        tracer.close(folder_path + "run_metrics" + metrics_extension)
@@ -7,41 +7,26 @@ of the test sentences.
 
 # Importing
 from transformers import AutoModelForTokenClassification, AutoTokenizer, AutoModelForCausalLM, AutoTokenizer
-import pandas as pd
-import seqeval.metrics
 import json
+import logging
+import torch
+from ner_conll import open_corpus
+from new_ner_metric import score_corpus
+from ner_prompt_segments import PromptEncoder
+from ner_responses import clean_and_align_predicted_tags
+from ner_generation import build_prefix_cache, generate_with_prefix_cache, bucket_by_length, generate_batch, tag_generation_kwargs
+from ner_instrumentation import logger
+from ner_cpu_inference import configure_cpu_threads, load_cpu_model
 
 def load_ner_data(file_path):
-    # Create an empty DataFrame to hold tokens and tags
-    data = pd.DataFrame(columns=["sentence_id", "words", "tags"])
-
-    current_words = []
-    current_tags = []
-    sentence_id = 0
-    sentences_data = []  # List to store each sentence's data
-
-    with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            line = line.strip()
-            # Check if the line is the start of a new sentence
-            if not line or line.startswith('# id'):
-                if current_words:  # Save the previous sentence
-                    sentences_data.append({"sentence_id": sentence_id, "words": current_words, "tags": current_tags})
-                    sentence_id += 1
-                current_words = []
-                current_tags = []
-            else:
-                # Split the line into columns
-                parts = line.split()
-                current_words.append(parts[0])
-                current_tags.append(parts[-1])  # The last column is the tag
-
-    # Using pandas.concat to add the list of sentence data to the DataFrame
-    data = pd.concat([data, pd.DataFrame(sentences_data)], ignore_index=True)
-
-    return data
+    # Reuse the binary corpus cache next to the file while it is still valid, otherwise index the
+    # file so that only the sampled sentences are parsed
+    return open_corpus(file_path)
+
+def create_ner_prompt_segments(language, examples, annotations):
+    # The prompt as its fixed segments (the instruction header, the tag table, each example and the
+    # closing instruction), each ending in a newline so that they can be encoded separately
 
-def create_ner_prompt(language, examples, annotations):
     # BIO Tags included
     entity_types = (
         "Location (LOC): B-Facility, I-Facility, B-OtherLOC, I-OtherLOC, B-HumanSettlement, I-HumanSettlement, B-Station, I-Station\n"
@@ -53,55 +38,112 @@ def create_ner_prompt(language, examples, annotations):
         "O (Outside of any entity)\n"
     )
 
-    prompt = f"Identify and label the named entities in the following {language} sentences with BIO tagging. The entities can be one of the following types:\n{entity_types}\n Examples:\n"
+    segments = [
+        f"Identify and label the named entities in the following {language} sentences with BIO tagging. The entities can be one of the following types:\n",
+        entity_types,
+        "\n Examples:\n",
+    ]
 
     for i, (sentence, annotation) in enumerate(zip(examples, annotations), 1):
-        prompt += f"Sentence: {sentence}\n   Entities: {annotation} \n"
+        segments.append(f"Sentence: {sentence}\n   Entities: {annotation} \n")
 
-    prompt += f"\nNow, identify the named entities in the new {language} sentence following the same format:\n"
+    segments.append(f"\nNow, identify the named entities in the new {language} sentence following the same format:\n")
 
-    return prompt
+    return segments
 
-def generate_prediction(sentence, model, tokenizer, prompt_template):
-    prompt = prompt_template + f"\nSentence: {sentence}\nEntities:"
-    inputs = tokenizer.encode(prompt, return_tensors='pt')
+def create_ner_prompt(language, examples, annotations):
+    return "".join(create_ner_prompt_segments(language, examples, annotations))
+
+def extract_predicted_tags(generated_response):
+    # Locate the end of the predicted tags in the newly generated text
+    end_index = generated_response.find("Please")
+    predicted_tags_str = generated_response[:end_index].strip() if end_index != -1 else generated_response.strip()
+    predicted_tags = predicted_tags_str.split() if predicted_tags_str else []
+
+    return predicted_tags
+
+def generate_prediction(sentence, model, tokenizer, prompt_ids, prefix_cache=None):
+    # The prompt arrives already encoded, assembled from its pre-tokenized segments
+    inputs = torch.tensor([prompt_ids])
 
     # Move input_ids to the same device as the model
     inputs = inputs.to(model.device)
 
-    outputs = model.generate(inputs, max_length=2500, num_return_sequences=1)
-    decoded_response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    # Stop once the tag sequence is terminated or has a tag for every word
+    generation_kwargs = tag_generation_kwargs(tokenizer, inputs.shape[1], [len(sentence.split())], terminator="Please")
 
-    print("DECODED_RESPONSE:")
-    print(decoded_response)
+    # Reuse the few shot prefix's key/value cache when one was built for this prompt
+    if prefix_cache is not None:
+        outputs = generate_with_prefix_cache(model, inputs, prefix_cache, num_return_sequences=1, **generation_kwargs)
+    else:
+        outputs = model.generate(inputs, num_return_sequences=1, **generation_kwargs)
 
-    # Identify the start of the predicted tags
-    start_index = decoded_response.find(f"Sentence: {sentence}\nEntities:") + len(f"Sentence: {sentence}\nEntities:")
-    if start_index == -1:
-        return []
+    # Only the newly generated tokens need decoding, the prompt is already known
+    generated_response = tokenizer.decode(outputs[0, inputs.shape[1]:], skip_special_tokens=True)
 
-    # Locate the end of the predicted tags
-    end_index = decoded_response.find("Please", start_index)
-    predicted_tags_str = decoded_response[start_index:end_index].strip() if end_index != -1 else decoded_response[start_index:].strip()
-    predicted_tags = predicted_tags_str.split() if predicted_tags_str else []
+    logger.debug("DECODED_RESPONSE:\nSentence: %s\nEntities:%s", sentence, generated_response)
 
-    return predicted_tags
+    return extract_predicted_tags(generated_response)
 
-def clean_and_align_predicted_tags(predicted_tags, sentence_length):
-    # Replace any non-tag elements with 'O' and truncate or pad to match sentence length
-    cleaned_tags = [
-        tag if tag.startswith('B-') or tag.startswith('I-') or tag == 'O' else 'O'
-        for tag in predicted_tags
-    ]
+def generate_predictions_batched(dataset, model, tokenizer, prompt_ids, batch_size, prefix_cache=None):
+    # Generate predictions for all test sentences in batches of similar prompt length, keyed by the
+    # dataset index of each sentence's row, as are the encoded prompts
+    sentences = {sentence.sentence_id: sentence.text for sentence in dataset}
+    indices = list(sentences)
+    encoded_prompts = [prompt_ids[index] for index in indices]
 
-    return cleaned_tags[:sentence_length] + ['O'] * (sentence_length - len(cleaned_tags))
+    predictions = {}
+    for batch in bucket_by_length([len(prompt_ids) for prompt_ids in encoded_prompts], batch_size):
+        # Left padding gives every prompt in the batch the same width, so the generated tokens start there
+        prompt_width = max(len(encoded_prompts[position]) for position in batch)
+        generation_kwargs = tag_generation_kwargs(tokenizer, prompt_width, [len(sentences[indices[position]].split()) for position in batch], terminator="Please")
+        outputs = generate_batch(model, tokenizer, [encoded_prompts[position] for position in batch], prefix_cache=prefix_cache, num_return_sequences=1, **generation_kwargs)
 
-def evaluate_for_language(model, tokenizer, language, dataset, few_shot_data, prediction_filepath, score_filepath):
-    # Prepare the initial part of the prompt with examples
-    example_sentences = [" ".join(words) for words in few_shot_data['words']]
-    example_annotations = [" ".join(tags) for tags in few_shot_data['tags']]
-    prompt = create_ner_prompt(language, example_sentences, example_annotations)
+        for position, output in zip(batch, outputs):
+            generated_response = tokenizer.decode(output[prompt_width:], skip_special_tokens=True)
+
+            logger.debug("DECODED_RESPONSE:\nSentence: %s\nEntities:%s", sentences[indices[position]], generated_response)
+
+            predictions[indices[position]] = extract_predicted_tags(generated_response)
+
+    return predictions
 
+def predict_for_language(model, tokenizer, language, dataset, few_shot_data, use_prefix_cache=False, batch_size=1):
+    # Generate and align the tags of every sentence in the dataset, returning them keyed by row index
+
+    # Prepare the initial part of the prompt with examples
+    example_sentences = [sentence.text for sentence in few_shot_data]
+    example_annotations = [" ".join(sentence.tags) for sentence in few_shot_data]
+    prompt_segments = create_ner_prompt_segments(language, example_sentences, example_annotations)
+
+    # The prompt prefix is fixed for the whole language, so its key/value cache only needs computing once
+    prefix_cache = build_prefix_cache(model, tokenizer, "".join(prompt_segments)) if use_prefix_cache else None
+
+    # Every sentence's prompt is encoded up front from the pre-tokenized prompt segments, with the
+    # sentences themselves encoded in a single batched call
+    prompt_encoder = PromptEncoder(tokenizer)
+    prompt_ids = dict(zip(dataset.index, prompt_encoder.encode_prompts(
+        [prompt_segments] * len(dataset),
+        [f"\nSentence: {row.text}\nEntities:" for row in dataset],
+    )))
+
+    # With a batch size above one, every prediction is generated up front and looked up by row index
+    batched_predictions = None
+    if batch_size > 1:
+        batched_predictions = generate_predictions_batched(dataset, model, tokenizer, prompt_ids, batch_size, prefix_cache=prefix_cache)
+
+    aligned_predictions = {}
+    for row in dataset:
+        index, sentence = row.sentence_id, row.text
+        if batched_predictions is not None:
+            generated_prediction = batched_predictions[index]
+        else:
+            generated_prediction = generate_prediction(sentence, model, tokenizer, prompt_ids[index], prefix_cache=prefix_cache)
+        aligned_predictions[index] = clean_and_align_predicted_tags(generated_prediction, len(row))
+
+    return aligned_predictions
+
+def write_predictions_and_scores(dataset, aligned_predictions, prediction_filepath, score_filepath):
     # List to store cleaned and aligned predicted tags
     cleaned_predicted_tags = []
 
@@ -109,25 +151,21 @@ def evaluate_for_language(model, tokenizer, language, dataset, few_shot_data, pr
     with open(prediction_filepath, 'w', encoding='utf-8') as prediction_file:
 
         # Iterate over the test data
-        for index, row in dataset.iterrows():
-            sentence = " ".join(row['words'])
-            generated_prediction = generate_prediction(sentence, model, tokenizer, prompt)
-            aligned_tags = clean_and_align_predicted_tags(generated_prediction, len(row['words']))
+        for row in dataset:
+            aligned_tags = aligned_predictions[row.sentence_id]
 
             # Save aligned tags and reference tags for each sentence
-            prediction_file.write(f"Sentence: {sentence}\n")
+            prediction_file.write(f"Sentence: {row.text}\n")
             prediction_file.write(f"Predicted Tags: {' '.join(aligned_tags)}\n")
-            prediction_file.write(f"Reference Tags: {' '.join(row['tags'])}\n\n")
+            prediction_file.write(f"Reference Tags: {' '.join(row.tags)}\n\n")
 
             cleaned_predicted_tags.append(aligned_tags)
 
-    # Actual tags from the test data
-    actual_tags = [tags for tags in dataset['tags']]
-
-    # Calculate evaluation metrics
-    precision = seqeval.metrics.precision_score(actual_tags, cleaned_predicted_tags)
-    recall = seqeval.metrics.recall_score(actual_tags, cleaned_predicted_tags)
-    f1_score = seqeval.metrics.f1_score(actual_tags, cleaned_predicted_tags)
+    # Calculate evaluation metrics over the corpus's tag ids, matching seqeval's entity scores
+    entity_scores = score_corpus(dataset, cleaned_predicted_tags)
+    precision = entity_scores['Precision']
+    recall = entity_scores['Recall']
+    f1_score = entity_scores['F1-Score']
 
     # Save the scores
     with open(score_filepath, 'w', encoding='utf-8') as score_file:
@@ -140,6 +178,10 @@ def evaluate_for_language(model, tokenizer, language, dataset, few_shot_data, pr
 
     print(f"Precision: {precision}, Recall: {recall}, F1-Score: {f1_score}")
 
+def evaluate_for_language(model, tokenizer, language, dataset, few_shot_data, prediction_filepath, score_filepath, use_prefix_cache=False, batch_size=1):
+    aligned_predictions = predict_for_language(model, tokenizer, language, dataset, few_shot_data, use_prefix_cache=use_prefix_cache, batch_size=batch_size)
+    write_predictions_and_scores(dataset, aligned_predictions, prediction_filepath, score_filepath)
+
 def get_examples_and_sample(dataset, few_shot_size, sample_size):
     # sample the dataset for the few shot examples and remove them from the dataset
     few_shot_data = dataset.sample(n=few_shot_size, random_state=16)
@@ -152,9 +194,17 @@ def get_examples_and_sample(dataset, few_shot_size, sample_size):
 if __name__ == '__main__':
     FEW_SHOT_SIZE = 5
     SAMPLE_SIZE = 300
+    USE_PREFIX_CACHE = False
+    BATCH_SIZE = 1
+    LOG_LEVEL = 'INFO'
+    CPU_PRECISION = None
+    CPU_THREADS = None
 
     folder_path = 'INSERT_BASE_FOLDER_PATH_HERE'
 
+    # Decoded responses are only printed at the DEBUG log level
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
+
     # Filenames
 
     # Bangla Data
@@ -210,46 +260,51 @@ if __name__ == '__main__':
     model_name = "meta-llama/Llama-2-7b-chat-hf"
 
     tokenizer = AutoTokenizer.from_pretrained(model_name, token="INSERT_TOKEN_HERE")
-    model = AutoModelForCausalLM.from_pretrained(model_name, token="INSERT_TOKEN_HERE", device_map = 'auto')
+    if CPU_PRECISION is not None:
+        # On a CPU node the model is memory mapped, optionally quantized, and pinned to a fixed set of cores
+        configure_cpu_threads(CPU_THREADS)
+        model = load_cpu_model(model_name, token="INSERT_TOKEN_HERE", precision=CPU_PRECISION)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name, token="INSERT_TOKEN_HERE", device_map = 'auto')
 
     print("ENGLISH")
     en_prediction_filepath = folder_path + "en_prediction_vs_reference_tags.txt"
     en_score_filepath = folder_path + "en_score.txt"
-    evaluate_for_language(model, tokenizer, "English", en_test_ner_data_sample, en_test_ner_data_few_shot, en_prediction_filepath, en_score_filepath)
+    evaluate_for_language(model, tokenizer, "English", en_test_ner_data_sample, en_test_ner_data_few_shot, en_prediction_filepath, en_score_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE)
     print()
 
     print("BANGLA")
     bn_prediction_filepath = folder_path + "bn_prediction_vs_reference_tags.txt"
     bn_score_filepath = folder_path + "bn_score.txt"
-    evaluate_for_language(model, tokenizer, "Bangla", bn_test_ner_data_sample, bn_test_ner_data_few_shot, bn_prediction_filepath, bn_score_filepath)
+    evaluate_for_language(model, tokenizer, "Bangla", bn_test_ner_data_sample, bn_test_ner_data_few_shot, bn_prediction_filepath, bn_score_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE)
     print()
 
     print("FARSI")
     fa_prediction_filepath = folder_path + "fa_prediction_vs_reference_tags.txt"
     fa_score_filepath = folder_path + "fa_score.txt"
-    evaluate_for_language(model, tokenizer, "Farsi", fa_test_ner_data_sample, fa_test_ner_data_few_shot, fa_prediction_filepath, fa_score_filepath)
+    evaluate_for_language(model, tokenizer, "Farsi", fa_test_ner_data_sample, fa_test_ner_data_few_shot, fa_prediction_filepath, fa_score_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE)
     print()
 
     print("HINDI")
     hi_prediction_filepath = folder_path + "hi_prediction_vs_reference_tags.txt"
     hi_score_filepath = folder_path + "hi_score.txt"
-    evaluate_for_language(model, tokenizer, "Hindi", hi_test_ner_data_sample, hi_test_ner_data_few_shot, hi_prediction_filepath, hi_score_filepath)
+    evaluate_for_language(model, tokenizer, "Hindi", hi_test_ner_data_sample, hi_test_ner_data_few_shot, hi_prediction_filepath, hi_score_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE)
     print()
 
     print("PORTUGUESE")
     pt_prediction_filepath = folder_path + "pt_prediction_vs_reference_tags.txt"
     pt_score_filepath = folder_path + "pt_score.txt"
-    evaluate_for_language(model, tokenizer, "Portuguese", pt_test_ner_data_sample, pt_test_ner_data_few_shot, pt_prediction_filepath, pt_score_filepath)
+    evaluate_for_language(model, tokenizer, "Portuguese", pt_test_ner_data_sample, pt_test_ner_data_few_shot, pt_prediction_filepath, pt_score_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE)
     print()
 
     print("ITALIAN")
     it_prediction_filepath = folder_path + "it_prediction_vs_reference_tags.txt"
     it_score_filepath = folder_path + "it_score.txt"
-    evaluate_for_language(model, tokenizer, "Italian", it_test_ner_data_sample, it_test_ner_data_few_shot, it_prediction_filepath, it_score_filepath)
+    evaluate_for_language(model, tokenizer, "Italian", it_test_ner_data_sample, it_test_ner_data_few_shot, it_prediction_filepath, it_score_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE)
     print()
 
     print("UKRAINIAN")
     uk_prediction_filepath = folder_path + "uk_prediction_vs_reference_tags.txt"
     uk_score_filepath = folder_path + "uk_score.txt"
-    evaluate_for_language(model, tokenizer, "Ukrainian", uk_test_ner_data_sample, uk_test_ner_data_few_shot, uk_prediction_filepath, uk_score_filepath)
+    evaluate_for_language(model, tokenizer, "Ukrainian", uk_test_ner_data_sample, uk_test_ner_data_few_shot, uk_prediction_filepath, uk_score_filepath, use_prefix_cache=USE_PREFIX_CACHE, batch_size=BATCH_SIZE)
     print()
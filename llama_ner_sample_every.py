@@ -6,42 +6,33 @@ few shot examples that are randomly sampled for each test sentence in each langu
 
 # Importing
 from transformers import AutoModelForTokenClassification, AutoTokenizer, AutoModelForCausalLM, AutoTokenizer
-import pandas as pd
-import seqeval.metrics
-import json
+import logging
+import torch
+from ner_conll import open_corpus
+from ner_constrained import TagGrammar
+from ner_continuous_batching import ContinuousBatchingEngine
+from ner_journal import SentenceJournal, model_settings, remove_journal, settings_fingerprint
+from ner_writer import AsyncFileWriter
+from ner_responses import record_decoded_response, finish_response, align_response, write_predictions_and_scores
+from ner_response_cache import ResponseCache, lookup_responses
+from ner_prompt_segments import PromptEncoder
+from ner_few_shot_packer import FewShotPacker, prompt_length_report
+from ner_few_shot_retrieval import FewShotIndex
+from ner_tags import COMPACT_TAG_CODES, encode_tags, describe_compact_tags, compact_token_report
+from ner_generation import generate_with_prefix_cache, bucket_by_length, generate_batch, tag_generation_kwargs, max_response_tokens
+from ner_radix_cache import RadixPrefixCache, common_prefix
+from ner_cpu_inference import cache_model_name, configure_cpu_threads, load_cpu_model
 import os
 
 def load_ner_data(file_path):
-    # Create an empty DataFrame to hold tokens and tags
-    data = pd.DataFrame(columns=["sentence_id", "words", "tags"])
-
-    current_words = []
-    current_tags = []
-    sentence_id = 0
-    sentences_data = []  # List to store each sentence's data
-
-    with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            line = line.strip()
-            # Check if the line is the start of a new sentence
-            if not line or line.startswith('# id'):
-                if current_words:  # Save the previous sentence
-                    sentences_data.append({"sentence_id": sentence_id, "words": current_words, "tags": current_tags})
-                    sentence_id += 1
-                current_words = []
-                current_tags = []
-            else:
-                # Split the line into columns
-                parts = line.split()
-                current_words.append(parts[0])
-                current_tags.append(parts[-1])  # The last column is the tag
-
-    # Using pandas.concat to add the list of sentence data to the DataFrame
-    data = pd.concat([data, pd.DataFrame(sentences_data)], ignore_index=True)
-
-    return data
-
-def create_ner_prompt(language, examples, annotations):
+    # Reuse the binary corpus cache next to the file while it is still valid, otherwise index the
+    # file so that only the sampled sentences are parsed
+    return open_corpus(file_path)
+
+def create_ner_prompt_segments(language, examples, annotations, tag_codes=None):
+    # The prompt as its fixed segments (the instruction header, the tag table, each example and the
+    # closing instruction), each ending in a newline so that they can be encoded separately
+
     # BIO Tags included
     entity_types = (
         "Location (LOC): B-Facility, I-Facility, B-OtherLOC, I-OtherLOC, B-HumanSettlement, I-HumanSettlement, B-Station, I-Station\n"
@@ -53,103 +44,246 @@ def create_ner_prompt(language, examples, annotations):
         "O (Outside of any entity)\n"
     )
 
-    prompt = f"For the following sequences of words in the {language} sentences, generate the appropriate sequence of BIO tags, each tag corresponding with each word in a sentence. Indicate the end of the generated sequence with a ##### symbol. ##### means that the sequence of BIO Tags for the corresponding sentence has ended. Each entity type is marked as 'B-' (beginning), 'I-' (inside), or 'O' (outside). Types include Location (LOC), Creative Work (CW), Group (GRP), Person (PER), Product (PROD), and Medical (MED). Here are all possible BIO Tags:\n{entity_types}\n Here are some examples:\n"
-
-    for i, (sentence, annotation) in enumerate(zip(examples, annotations), 1):
-        prompt += f"Sentence: {sentence}\n   Sequence of BIO Tags: {annotation} #####\n"
-
-    prompt += f"\nNow, using the same format as the examples, generate a sequence of BIO tags for the following sentence with each tag corresponding with each word in the new {language} sentence:\n"
-
-    return prompt
-
-def generate_prediction(sentence, model, tokenizer, prompt_template, decoded_response_filepath):
-    prompt = prompt_template + f"\nSentence: {sentence}\nSequence of BIO Tags:"
-    inputs = tokenizer.encode(prompt, return_tensors='pt')
-
-    # Move input_ids to the same device as the model
-    inputs = inputs.to(model.device)
-
-    outputs = model.generate(inputs, max_length=2500, num_return_sequences=1)
-    decoded_response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-    print("DECODED RESPONSE: ")
-    print(decoded_response)
-    print("/////////////////////////\n\n")
-
-    # Open the file for writing predictions
-    with open(decoded_response_filepath, 'w', encoding='utf-8') as decoded_response_file:
-        decoded_response_file.write(f"START OF DECODED RESPONSE \n\n")
-        decoded_response_file.write(decoded_response)
-        decoded_response_file.write(f"END OF DECODED RESPONSE \n\n\n")
-
-    # Identify the start of the predicted tags
-    start_index = decoded_response.find(f"Sentence: {sentence}\nSequence of BIO Tags:") + len(f"Sentence: {sentence}\nSequence of BIO Tags:")
-    if start_index == -1:
-        return []
+    # List the compact tag codes instead when the examples are annotated with them
+    if tag_codes is not None:
+        entity_types = describe_compact_tags(tag_codes)
 
-    # Locate the end of the predicted tags
-    end_index = decoded_response.find("#####", start_index)
-    predicted_tags_str = decoded_response[start_index:end_index].strip() if end_index != -1 else decoded_response[start_index:].strip()
-    predicted_tags = predicted_tags_str.split() if predicted_tags_str else []
-
-    return predicted_tags
-
-def clean_and_align_predicted_tags(predicted_tags, sentence_length):
-    # Replace any non-tag elements with 'O' and truncate or pad to match sentence length
-    cleaned_tags = [
-        tag if tag.startswith('B-') or tag.startswith('I-') or tag == 'O' else 'O'
-        for tag in predicted_tags
+    segments = [
+        f"For the following sequences of words in the {language} sentences, generate the appropriate sequence of BIO tags, each tag corresponding with each word in a sentence. Indicate the end of the generated sequence with a ##### symbol. ##### means that the sequence of BIO Tags for the corresponding sentence has ended. Each entity type is marked as 'B-' (beginning), 'I-' (inside), or 'O' (outside). Types include Location (LOC), Creative Work (CW), Group (GRP), Person (PER), Product (PROD), and Medical (MED). Here are all possible BIO Tags:\n",
+        entity_types,
+        "\n Here are some examples:\n",
     ]
 
-    return cleaned_tags[:sentence_length] + ['O'] * (sentence_length - len(cleaned_tags))
-
-def evaluate_for_language(model, tokenizer, language, dataset, few_shot_dataset, few_shot_size, prediction_filepath, score_filepath, decoded_response_filepath):
-    # List to store cleaned and aligned predicted tags
-    cleaned_predicted_tags = []
-
-    # Open the file for writing predictions
-    with open(prediction_filepath, 'w', encoding='utf-8') as prediction_file:
-
-        # Iterate over the test data
-        for index, row in dataset.iterrows():
-            few_shot_data = few_shot_dataset.sample(n=few_shot_size, random_state=16)
-
-            # Prepare the initial part of the prompt with examples
-            example_sentences = [" ".join(words) for words in few_shot_data['words']]
-            example_annotations = [" ".join(tags) for tags in few_shot_data['tags']]
-            prompt = create_ner_prompt(language, example_sentences, example_annotations)
-
-            sentence = " ".join(row['words'])
-            generated_prediction = generate_prediction(sentence, model, tokenizer, prompt, decoded_response_filepath)
-            aligned_tags = clean_and_align_predicted_tags(generated_prediction, len(row['words']))
-
-            # Save aligned tags and reference tags for each sentence
-            prediction_file.write(f"Sentence: {sentence}\n")
-            prediction_file.write(f"Predicted Tags: {' '.join(aligned_tags)}\n")
-            prediction_file.write(f"Reference Tags: {' '.join(row['tags'])}\n\n")
+    for i, (sentence, annotation) in enumerate(zip(examples, annotations), 1):
+        segments.append(f"Sentence: {sentence}\n   Sequence of BIO Tags: {annotation} #####\n")
 
-            print("ALIGNED TAGS: ", aligned_tags)
+    segments.append(f"\nNow, using the same format as the examples, generate a sequence of BIO tags for the following sentence with each tag corresponding with each word in the new {language} sentence:\n")
 
-            cleaned_predicted_tags.append(aligned_tags)
+    return segments
 
-    # Actual tags from the test data
-    actual_tags = [tags for tags in dataset['tags']]
+def create_ner_prompt(language, examples, annotations, tag_codes=None):
+    return "".join(create_ner_prompt_segments(language, examples, annotations, tag_codes=tag_codes))
 
-    # Calculate evaluation metrics
-    precision = seqeval.metrics.precision_score(actual_tags, cleaned_predicted_tags)
-    recall = seqeval.metrics.recall_score(actual_tags, cleaned_predicted_tags)
-    f1_score = seqeval.metrics.f1_score(actual_tags, cleaned_predicted_tags)
+def generate_prediction(sentence, model, tokenizer, prompt_ids, decoded_response_writer, tag_grammar=None, response_cache=None, radix_cache=None):
+    # The prompt arrives already encoded, assembled from its pre-tokenized segments
+    inputs = torch.tensor([prompt_ids])
 
-    # Save the scores
-    with open(score_filepath, 'w', encoding='utf-8') as score_file:
-        scores = {
-            'Precision': precision,
-            'Recall': recall,
-            'F1-Score': f1_score
-        }
-        score_file.write(json.dumps(scores, indent=4))
+    # Move input_ids to the same device as the model
+    inputs = inputs.to(model.device)
 
-    print(f"Precision: {precision}, Recall: {recall}, F1-Score: {f1_score}")
+    # Stop once the tag sequence is terminated or has a tag for every word
+    generation_kwargs = tag_generation_kwargs(tokenizer, inputs.shape[1], [len(sentence.split())], tag_grammar=tag_grammar)
+
+    # Serve the response from the response cache if this prompt was generated before
+    cache_key = response_cache.make_key(inputs[0].tolist(), constrained=tag_grammar is not None) if response_cache is not None else None
+    generated_response = response_cache.get(cache_key) if cache_key is not None else None
+
+    if generated_response is None:
+        # Reuse the longest prefix of the prompt already in the radix cache, prefilling only the rest
+        if radix_cache is not None:
+            outputs = generate_with_prefix_cache(model, inputs, radix_cache.prefix(inputs[0, :-1].tolist()), num_return_sequences=1, **generation_kwargs)
+        else:
+            outputs = model.generate(inputs, num_return_sequences=1, **generation_kwargs)
+
+        # Only the newly generated tokens need decoding, the prompt is already known
+        generated_response = tokenizer.decode(outputs[0, inputs.shape[1]:], skip_special_tokens=True)
+        if cache_key is not None:
+            response_cache.put(cache_key, generated_response)
+
+    record_decoded_response(f"Sentence: {sentence}\nSequence of BIO Tags:{generated_response}", decoded_response_writer)
+
+    return generated_response
+
+def generate_predictions_batched(dataset, model, tokenizer, prompt_ids, decoded_response_writer, batch_size, tag_grammar=None, response_cache=None, on_response=None, radix_cache=None):
+    # Generate predictions for all test sentences in batches of similar prompt length. Each row has
+    # its own encoded prompt, and both the prompts and the predictions are keyed by the dataset
+    # index of the row
+    sentences = {sentence.sentence_id: sentence.text for sentence in dataset}
+    indices = list(sentences)
+    encoded_prompts = [prompt_ids[index] for index in indices]
+
+    # Sentences whose prompt was generated before are served from the response cache
+    cache_keys, cached_responses, to_generate = lookup_responses(response_cache, encoded_prompts, constrained=tag_grammar is not None)
+
+    generated_responses = {}
+    for position, generated_response in sorted(cached_responses.items()):
+        finish_response(generated_responses, indices[position], sentences[indices[position]], generated_response, decoded_response_writer, on_response)
+
+    for batch in bucket_by_length([len(encoded_prompts[position]) for position in to_generate], batch_size):
+        batch = [to_generate[position] for position in batch]
+
+        # Left padding gives every prompt in the batch the same width, so the generated tokens start there
+        prompt_width = max(len(encoded_prompts[position]) for position in batch)
+        generation_kwargs = tag_generation_kwargs(tokenizer, prompt_width, [len(sentences[indices[position]].split()) for position in batch], tag_grammar=tag_grammar)
+        # The prefix the whole batch shares is taken from the radix cache, prefilling only what it lacks
+        prefix_cache = radix_cache.prefix(common_prefix([encoded_prompts[position] for position in batch])) if radix_cache is not None else None
+        outputs = generate_batch(model, tokenizer, [encoded_prompts[position] for position in batch], prefix_cache=prefix_cache, num_return_sequences=1, **generation_kwargs)
+
+        for position, output in zip(batch, outputs):
+            generated_response = tokenizer.decode(output[prompt_width:], skip_special_tokens=True)
+            if cache_keys is not None:
+                response_cache.put(cache_keys[position], generated_response)
+            finish_response(generated_responses, indices[position], sentences[indices[position]], generated_response, decoded_response_writer, on_response)
+
+    return generated_responses
+
+def generate_predictions_continuous(dataset, model, tokenizer, prompt_ids, decoded_response_writer, decode_slots, tag_grammar=None, response_cache=None, on_response=None, radix_cache=None):
+    # Generate predictions for all test sentences through a fixed number of continuously refilled
+    # decode slots. Each row has its own encoded prompt, and both the prompts and the predictions
+    # are keyed by the dataset index of the row
+    sentences = {sentence.sentence_id: sentence.text for sentence in dataset}
+    indices = list(sentences)
+    encoded_prompts = [prompt_ids[index] for index in indices]
+
+    # Sentences whose prompt was generated before are served from the response cache
+    cache_keys, cached_responses, to_generate = lookup_responses(response_cache, encoded_prompts, constrained=tag_grammar is not None)
+
+    generated_responses = {}
+    for position, generated_response in sorted(cached_responses.items()):
+        finish_response(generated_responses, indices[position], sentences[indices[position]], generated_response, decoded_response_writer, on_response)
+
+    def on_finished(position, generated_response):
+        if cache_keys is not None:
+            response_cache.put(cache_keys[position], generated_response)
+        finish_response(generated_responses, indices[position], sentences[indices[position]], generated_response, decoded_response_writer, on_response)
+
+    requests = [(position, encoded_prompts[position], len(sentences[indices[position]].split())) for position in to_generate]
+    engine = ContinuousBatchingEngine(model, tokenizer, decode_slots, tag_grammar=tag_grammar, radix_cache=radix_cache)
+    engine.generate(requests, on_finished=on_finished)
+    print("CONTINUOUS BATCHING STATS: ", engine.stats)
+
+    return generated_responses
+
+def build_few_shot_prompt_segments(language, few_shot_data, tag_codes=None):
+    # Prepare the initial part of the prompt with examples, annotated with the compact tag codes if given
+    example_sentences = [sentence.text for sentence in few_shot_data]
+    example_annotations = [" ".join(encode_tags(sentence.tags, tag_codes) if tag_codes is not None else sentence.tags) for sentence in few_shot_data]
+    return create_ner_prompt_segments(language, example_sentences, example_annotations, tag_codes=tag_codes)
+
+def build_sampled_prompt_segments(language, few_shot_dataset, few_shot_size, tag_codes=None):
+    # Sample the few shot examples for a single test sentence and build its prompt, as its segments
+    return build_few_shot_prompt_segments(language, few_shot_dataset.sample(n=few_shot_size, random_state=16), tag_codes=tag_codes)
+
+def build_sampled_prompt(language, few_shot_dataset, few_shot_size, tag_codes=None):
+    return "".join(build_sampled_prompt_segments(language, few_shot_dataset, few_shot_size, tag_codes=tag_codes))
+
+def build_token_report(tokenizer, language, dataset, few_shot_dataset, few_shot_size, tag_codes):
+    # The number of tokens the compact tag codes save against the full tags, for a sampled prompt
+    return compact_token_report(tokenizer, build_sampled_prompt(language, few_shot_dataset, few_shot_size), build_sampled_prompt(language, few_shot_dataset, few_shot_size, tag_codes=tag_codes), [sentence.tags for sentence in dataset], tag_codes)
+
+def generate_for_language(model, tokenizer, language, dataset, few_shot_dataset, few_shot_size, decoded_response_filepath, batch_size=1, constrained=False, compact_tags=False, decode_slots=0, response_cache=None, journal_filepath=None, radix_cache_budget=None, prompt_token_budget=None, prompt_overflow='trim', few_shot_selection='sample'):
+    # Generate and align the tags of every sentence in the dataset, returning them keyed by row index
+    # together with the compact tag token report, if any
+
+    # In compact mode the examples are annotated with the compact tag codes, and the number of tokens
+    # this saves against the full tags is reported
+    tag_codes = COMPACT_TAG_CODES if compact_tags else None
+    token_report = None
+    if tag_codes is not None:
+        token_report = build_token_report(tokenizer, language, dataset, few_shot_dataset, few_shot_size, tag_codes)
+        print("COMPACT TAG TOKEN REPORT: ", token_report)
+
+    # The tag grammar only depends on the tokenizer, so it is built once per language
+    tag_grammar = TagGrammar(tokenizer, tag_codes=tag_codes) if constrained else None
+
+    # The sampled prompts share the header and often leading examples, so their key/value caches are
+    # kept in a radix tree for the language, within the given memory budget in bytes
+    radix_cache = RadixPrefixCache(model, radix_cache_budget) if radix_cache_budget else None
+
+    # Aligned tags for every sentence keyed by row index, starting from the sentences already completed
+    # in the journal by an interrupted run, which are not generated again. The journal is only resumed
+    # if it was written with the same model, few shot pool and options, and the tags of its sentences
+    # are parsed again from their raw responses
+    journal = None
+    aligned_predictions = {}
+    if journal_filepath is not None:
+        journal_fingerprint = settings_fingerprint({
+            'Model': model_settings(model),
+            'Tokenizer': tokenizer.name_or_path,
+            'Language': language,
+            'Sampled Prompt': "".join(build_sampled_prompt_segments(language, few_shot_dataset, few_shot_size, tag_codes=tag_codes)),
+            'Few Shot Pool Sentence Ids': [int(index) for index in few_shot_dataset.index],
+            'Few Shot Size': few_shot_size,
+            'Few Shot Selection': few_shot_selection,
+            'Constrained': constrained,
+            'Compact Tags': compact_tags,
+            'Prompt Token Budget': prompt_token_budget,
+            'Prompt Overflow': prompt_overflow,
+        })
+        journal = SentenceJournal(journal_filepath, fingerprint=journal_fingerprint)
+        aligned_predictions = {int(index): align_response(journal.entries[index]['response'], len(dataset.by_id(index)), tag_codes=tag_codes) for index in dataset.index if index in journal}
+        print(f"RESUMING FROM JOURNAL: {len(aligned_predictions)} of {len(dataset)} sentences already done")
+    remaining_dataset = dataset.drop(list(aligned_predictions))
+
+    # Every remaining row's prompt is built and encoded up front from pre-tokenized segments, so the
+    # header, the tag table and each example are only encoded once for the language, and the
+    # sentences themselves in a single batched call
+    prompt_encoder = PromptEncoder(tokenizer)
+    if few_shot_selection == 'retrieve':
+        # The examples most similar to each sentence, retrieved for all of them in one batched product.
+        # Every sentence of the pool is compared, so the whole pool is read into a corpus here
+        few_shot_pool = few_shot_dataset[:]
+        few_shot_index = FewShotIndex(few_shot_pool)
+        neighbours = few_shot_index.top_k(remaining_dataset, few_shot_size)
+        templates = [build_few_shot_prompt_segments(language, few_shot_pool.take(positions), tag_codes=tag_codes) for positions in neighbours]
+        print("FEW SHOT RETRIEVAL STATS: ", few_shot_index.stats())
+    elif few_shot_selection == 'sample':
+        # The sample is seeded, so every sentence draws the same examples and they are sampled only once
+        templates = [build_sampled_prompt_segments(language, few_shot_dataset, few_shot_size, tag_codes=tag_codes)] * len(remaining_dataset)
+    else:
+        raise ValueError(f"Unknown few shot selection {few_shot_selection!r}, expected 'sample' or 'retrieve'")
+    suffixes = [f"\nSentence: {row.text}\nSequence of BIO Tags:" for row in remaining_dataset]
+
+    # With a prompt token budget, each sentence's prompt keeps as many of its few shot examples as fit
+    # alongside the most tokens its response may take
+    if prompt_token_budget is not None:
+        packer = FewShotPacker(prompt_encoder, prompt_token_budget, overflow=prompt_overflow)
+        templates = [packer.pack(segments, few_shot_size, suffix, response_tokens=max_response_tokens(len(row))) for segments, suffix, row in zip(templates, suffixes, remaining_dataset)]
+        print("FEW SHOT PACKER STATS: ", packer.stats())
+
+    prompt_ids = dict(zip(remaining_dataset.index, prompt_encoder.encode_prompts(templates, suffixes)))
+    print("PROMPT SEGMENT STATS: ", prompt_encoder.stats())
+    print("PROMPT LENGTH REPORT: ", prompt_length_report(prompt_ids.values(), prompt_token_budget))
+
+    # Decoded responses go through a background writer, appending to the earlier responses when resuming
+    decoded_response_writer = AsyncFileWriter(decoded_response_filepath, mode='a' if aligned_predictions else 'w')
+
+    def record_response(index, generated_response):
+        aligned_predictions[index] = align_response(generated_response, len(dataset.by_id(index)), tag_codes=tag_codes)
+
+        # Journal the sentence as soon as it is done, so a crash only loses the sentences in flight
+        if journal is not None:
+            journal.record(int(index), generated_response, aligned_predictions[index])
+
+    # The writer and the journal are closed even if generation is interrupted, keeping every finished response
+    try:
+        # With decode slots or a batch size above one, every remaining response is generated up front,
+        # otherwise one sentence at a time
+        if decode_slots > 0:
+            generate_predictions_continuous(remaining_dataset, model, tokenizer, prompt_ids, decoded_response_writer, decode_slots, tag_grammar=tag_grammar, response_cache=response_cache, on_response=record_response, radix_cache=radix_cache)
+        elif batch_size > 1:
+            generate_predictions_batched(remaining_dataset, model, tokenizer, prompt_ids, decoded_response_writer, batch_size, tag_grammar=tag_grammar, response_cache=response_cache, on_response=record_response, radix_cache=radix_cache)
+        else:
+            for row in remaining_dataset:
+                index, sentence = row.sentence_id, row.text
+                record_response(index, generate_prediction(sentence, model, tokenizer, prompt_ids[index], decoded_response_writer, tag_grammar=tag_grammar, response_cache=response_cache, radix_cache=radix_cache))
+    finally:
+        decoded_response_writer.close()
+        if journal is not None:
+            journal.close()
+
+    if radix_cache is not None:
+        print("RADIX CACHE STATS: ", radix_cache.stats())
+
+    return aligned_predictions, token_report
+
+def evaluate_for_language(model, tokenizer, language, dataset, few_shot_dataset, few_shot_size, prediction_filepath, score_filepath, decoded_response_filepath, batch_size=1, constrained=False, compact_tags=False, decode_slots=0, response_cache=None, journal_filepath=None, radix_cache_budget=None, prompt_token_budget=None, prompt_overflow='trim', few_shot_selection='sample'):
+    aligned_predictions, token_report = generate_for_language(model, tokenizer, language, dataset, few_shot_dataset, few_shot_size, decoded_response_filepath, batch_size=batch_size, constrained=constrained, compact_tags=compact_tags, decode_slots=decode_slots, response_cache=response_cache, journal_filepath=journal_filepath, radix_cache_budget=radix_cache_budget, prompt_token_budget=prompt_token_budget, prompt_overflow=prompt_overflow, few_shot_selection=few_shot_selection)
+    write_predictions_and_scores(dataset, aligned_predictions, prediction_filepath, score_filepath, token_report=token_report)
+    remove_journal(journal_filepath)
+
+    if response_cache is not None:
+        print("RESPONSE CACHE STATS: ", response_cache.stats())
 
 def get_examples_and_sample(dataset, few_shot_size, sample_size):
     # sample the dataset for the few shot and test examples
@@ -157,7 +291,7 @@ def get_examples_and_sample(dataset, few_shot_size, sample_size):
     sampled_data = dataset.sample(n=total_size, random_state=16)
 
     # return the few shot data first, followed by the test data
-    return sampled_data.iloc[:FEW_SHOT_SIZE], sampled_data.iloc[FEW_SHOT_SIZE:]
+    return sampled_data[:FEW_SHOT_SIZE], sampled_data[FEW_SHOT_SIZE:]
 
 def get_sample_and_remove(dataset, sample_size):
     # sample the dataset and remove from the dataset
@@ -168,9 +302,24 @@ def get_sample_and_remove(dataset, sample_size):
 if __name__ == '__main__':
     FEW_SHOT_SIZE = 10
     SAMPLE_SIZE = 300
+    BATCH_SIZE = 1
+    CONSTRAINED_DECODING = False
+    COMPACT_TAGS = False
+    DECODE_SLOTS = 0
+    USE_RESPONSE_CACHE = True
+    RADIX_CACHE_BUDGET = 2 * 1024 ** 3
+    PROMPT_TOKEN_BUDGET = None
+    PROMPT_OVERFLOW = 'trim'
+    FEW_SHOT_SELECTION = 'sample'
+    LOG_LEVEL = 'INFO'
+    CPU_PRECISION = None
+    CPU_THREADS = None
 
     folder_path = 'INSERT_BASE_FOLDER_PATH_HERE'
 
+    # Decoded responses and aligned tags are only printed at the DEBUG log level
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
+
     en_score_filepath = folder_path + "en_evaluation_scores_sample_every.json"
     bn_score_filepath = folder_path + "bn_evaluation_scores_sample_every.json"
     fa_score_filepath = folder_path + "fa_evaluation_scores_sample_every.json"
@@ -184,7 +333,7 @@ if __name__ == '__main__':
         exit(0)
 
 
-    # Filenames
+    # Filenames, each parsed once into a cached corpus that later runs memory map
 
     # English Data
     en_test_file_path = folder_path + 'en_test.conll'
@@ -239,55 +388,73 @@ if __name__ == '__main__':
     model_name = "meta-llama/Llama-2-7b-chat-hf"
 
     tokenizer = AutoTokenizer.from_pretrained(model_name, token="INSERT_TOKEN_HERE")
-    model = AutoModelForCausalLM.from_pretrained(model_name, token="INSERT_TOKEN_HERE", device_map = 'auto')
+    if CPU_PRECISION is not None:
+        # On a CPU node the model is memory mapped, optionally quantized, and pinned to a fixed set of cores
+        configure_cpu_threads(CPU_THREADS)
+        model = load_cpu_model(model_name, token="INSERT_TOKEN_HERE", precision=CPU_PRECISION)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name, token="INSERT_TOKEN_HERE", device_map = 'auto')
+
+    # Responses already generated by an earlier run with the same prompts and settings are reused
+    response_cache = ResponseCache(folder_path + "response_cache.sqlite", cache_model_name(model_name, CPU_PRECISION), model.generation_config.to_dict()) if USE_RESPONSE_CACHE else None
 
     print("SAMPLE_EVERY OUTPUT:")
 
     print("ENGLISH")
     en_prediction_filepath = folder_path + "en_predicted_vs_reference_tags_sample_every.txt"
     en_decoded_filepath = folder_path + "en_decoded_responses_sample_every.txt"
+    en_journal_filepath = folder_path + "en_journal_sample_every.jsonl"
     if not os.path.exists(en_score_filepath):
-        evaluate_for_language(model, tokenizer, "English", en_test_ner_data_sample, en_test_ner_data_few_shot, FEW_SHOT_SIZE, en_prediction_filepath, en_score_filepath, en_decoded_filepath)
+        evaluate_for_language(model, tokenizer, "English", en_test_ner_data_sample, en_test_ner_data_few_shot, FEW_SHOT_SIZE, en_prediction_filepath, en_score_filepath, en_decoded_filepath, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=en_journal_filepath, radix_cache_budget=RADIX_CACHE_BUDGET, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, few_shot_selection=FEW_SHOT_SELECTION)
     print()
 
     print("BANGLA")
     bn_prediction_filepath = folder_path + "bn_predicted_vs_reference_tags_sample_every.txt"
     bn_decoded_filepath = folder_path + "bn_decoded_responses_sample_every.txt"
+    bn_journal_filepath = folder_path + "bn_journal_sample_every.jsonl"
     if not os.path.exists(bn_score_filepath):
-        evaluate_for_language(model, tokenizer, "Bangla", bn_test_ner_data_sample, bn_test_ner_data_few_shot, FEW_SHOT_SIZE, bn_prediction_filepath, bn_score_filepath, bn_decoded_filepath)
+        evaluate_for_language(model, tokenizer, "Bangla", bn_test_ner_data_sample, bn_test_ner_data_few_shot, FEW_SHOT_SIZE, bn_prediction_filepath, bn_score_filepath, bn_decoded_filepath, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=bn_journal_filepath, radix_cache_budget=RADIX_CACHE_BUDGET, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, few_shot_selection=FEW_SHOT_SELECTION)
     print()
 
     print("FARSI")
     fa_prediction_filepath = folder_path + "fa_predicted_vs_reference_tags_sample_every.txt"
     fa_decoded_filepath = folder_path + "fa_decoded_responses_sample_every.txt"
+    fa_journal_filepath = folder_path + "fa_journal_sample_every.jsonl"
     if not os.path.exists(fa_score_filepath):
-        evaluate_for_language(model, tokenizer, "Farsi", fa_test_ner_data_sample, fa_test_ner_data_few_shot, FEW_SHOT_SIZE, fa_prediction_filepath, fa_score_filepath, fa_decoded_filepath)
+        evaluate_for_language(model, tokenizer, "Farsi", fa_test_ner_data_sample, fa_test_ner_data_few_shot, FEW_SHOT_SIZE, fa_prediction_filepath, fa_score_filepath, fa_decoded_filepath, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=fa_journal_filepath, radix_cache_budget=RADIX_CACHE_BUDGET, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, few_shot_selection=FEW_SHOT_SELECTION)
     print()
 
     print("HINDI")
     hi_prediction_filepath = folder_path + "hi_predicted_vs_reference_tags_sample_every.txt"
     hi_decoded_filepath = folder_path + "hi_decoded_responses_sample_every.txt"
+    hi_journal_filepath = folder_path + "hi_journal_sample_every.jsonl"
     if not os.path.exists(hi_score_filepath):
-        evaluate_for_language(model, tokenizer, "Hindi", hi_test_ner_data_sample, hi_test_ner_data_few_shot, FEW_SHOT_SIZE, hi_prediction_filepath, hi_score_filepath, hi_decoded_filepath)
+        evaluate_for_language(model, tokenizer, "Hindi", hi_test_ner_data_sample, hi_test_ner_data_few_shot, FEW_SHOT_SIZE, hi_prediction_filepath, hi_score_filepath, hi_decoded_filepath, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=hi_journal_filepath, radix_cache_budget=RADIX_CACHE_BUDGET, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, few_shot_selection=FEW_SHOT_SELECTION)
     print()
 
     print("PORTUGUESE")
     pt_prediction_filepath = folder_path + "pt_predicted_vs_reference_tags_sample_every.txt"
     pt_decoded_filepath = folder_path + "pt_decoded_responses_sample_every.txt"
+    pt_journal_filepath = folder_path + "pt_journal_sample_every.jsonl"
     if not os.path.exists(pt_score_filepath):
-        evaluate_for_language(model, tokenizer, "Portuguese", pt_test_ner_data_sample, pt_test_ner_data_few_shot, FEW_SHOT_SIZE, pt_prediction_filepath, pt_score_filepath, pt_decoded_filepath)
+        evaluate_for_language(model, tokenizer, "Portuguese", pt_test_ner_data_sample, pt_test_ner_data_few_shot, FEW_SHOT_SIZE, pt_prediction_filepath, pt_score_filepath, pt_decoded_filepath, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=pt_journal_filepath, radix_cache_budget=RADIX_CACHE_BUDGET, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, few_shot_selection=FEW_SHOT_SELECTION)
     print()
 
     print("ITALIAN")
     it_prediction_filepath = folder_path + "it_predicted_vs_reference_tags_sample_every.txt"
     it_decoded_filepath = folder_path + "it_decoded_responses_sample_every.txt"
+    it_journal_filepath = folder_path + "it_journal_sample_every.jsonl"
     if not os.path.exists(it_score_filepath):
-        evaluate_for_language(model, tokenizer, "Italian", it_test_ner_data_sample, it_test_ner_data_few_shot, FEW_SHOT_SIZE, it_prediction_filepath, it_score_filepath, it_decoded_filepath)
+        evaluate_for_language(model, tokenizer, "Italian", it_test_ner_data_sample, it_test_ner_data_few_shot, FEW_SHOT_SIZE, it_prediction_filepath, it_score_filepath, it_decoded_filepath, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=it_journal_filepath, radix_cache_budget=RADIX_CACHE_BUDGET, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, few_shot_selection=FEW_SHOT_SELECTION)
     print()
 
     print("UKRAINIAN")
     uk_prediction_filepath = folder_path + "uk_predicted_vs_reference_tags_sample_every.txt"
     uk_decoded_filepath = folder_path + "uk_decoded_responses_sample_every.txt"
+    uk_journal_filepath = folder_path + "uk_journal_sample_every.jsonl"
     if not os.path.exists(uk_score_filepath):
-        evaluate_for_language(model, tokenizer, "Ukrainian", uk_test_ner_data_sample, uk_test_ner_data_few_shot, FEW_SHOT_SIZE, uk_prediction_filepath, uk_score_filepath, uk_decoded_filepath)
+        evaluate_for_language(model, tokenizer, "Ukrainian", uk_test_ner_data_sample, uk_test_ner_data_few_shot, FEW_SHOT_SIZE, uk_prediction_filepath, uk_score_filepath, uk_decoded_filepath, batch_size=BATCH_SIZE, constrained=CONSTRAINED_DECODING, compact_tags=COMPACT_TAGS, decode_slots=DECODE_SLOTS, response_cache=response_cache, journal_filepath=uk_journal_filepath, radix_cache_budget=RADIX_CACHE_BUDGET, prompt_token_budget=PROMPT_TOKEN_BUDGET, prompt_overflow=PROMPT_OVERFLOW, few_shot_selection=FEW_SHOT_SELECTION)
     print()
+
+    if response_cache is not None:
+        response_cache.close()
@@ -0,0 +1,242 @@
+"""
+Inference backends for NER generation. A backend takes (key, prompt_ids, word_count) requests, as
+the continuous batching engine in ner_continuous_batching does, returns the generated text for each
+key and hands each key and text to an on_finished callback as soon as that sentence is done, in
+whatever order they finish.
+
+The Hugging Face backend runs the model in process, in left padded batches of similar prompt length.
+The OpenAI compatible backend sends the prompts to the completions endpoint of a separate inference
+server, such as vLLM, from an asyncio client. Connections are pooled, at most a set number of
+requests are in flight at once, and transient errors (timeouts, dropped connections and 408, 429
+and 5xx responses) are retried with exponential backoff. Prompts are sent as their token ids, so
+the server sees exactly the ids the in-process model would, and the server needs to accept token id
+prompts. aiohttp is only needed for this backend.
+
+Running this file directly starts a local stub completions server that answers out of order and
+fails some requests once, and checks that the client gets every response back under its own key.
+"""
+
+import asyncio
+import time
+
+from ner_instrumentation import TimingStreamer
+from ner_generation import bucket_by_length, generate_batch, max_response_tokens, tag_generation_kwargs
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# HTTP statuses worth retrying: request timeout, rate limiting and server side errors
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+class HuggingFaceBackend:
+    # the in-process Hugging Face model, generating in left padded batches of similar prompt length
+
+    def __init__(self, model, tokenizer, batch_size=1, prefix_cache=None, tag_grammar=None, tracer=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.prefix_cache = prefix_cache
+        self.tag_grammar = tag_grammar
+        self.tracer = tracer
+
+        self.stats = {}
+
+    def generate(self, requests, on_finished=None):
+        # takes (key, prompt_ids, word_count) requests and returns the generated text for each key,
+        # also passing each key and text to `on_finished` as soon as its batch is done
+        results = {}
+        start_time = time.perf_counter()
+
+        batches = bucket_by_length([len(prompt_ids) for _, prompt_ids, _ in requests], self.batch_size)
+        for batch in batches:
+            batch = [requests[position] for position in batch]
+
+            # Left padding gives every prompt in the batch the same width, so the generated tokens start there
+            prompt_width = max(len(prompt_ids) for _, prompt_ids, _ in batch)
+            generation_kwargs = tag_generation_kwargs(self.tokenizer, prompt_width, [word_count for _, _, word_count in batch], tag_grammar=self.tag_grammar)
+            streamer = TimingStreamer() if self.tracer is not None else None
+            outputs = generate_batch(self.model, self.tokenizer, [prompt_ids for _, prompt_ids, _ in batch], prefix_cache=self.prefix_cache, num_return_sequences=1, streamer=streamer, **generation_kwargs)
+            if streamer is not None:
+                self.tracer.add_stage('prefill', streamer.prefill_seconds(), batch_size=len(batch))
+                self.tracer.add_stage('decode', streamer.decode_seconds(), batch_size=len(batch))
+
+            for (key, prompt_ids, _), output in zip(batch, outputs):
+                decode_start_time = time.perf_counter()
+                results[key] = self.tokenizer.decode(output[prompt_width:], skip_special_tokens=True)
+                if streamer is not None:
+                    # every sentence of a batch finishes with the batch. Padding after an early stop is not generated
+                    self.tracer.add_stage('detokenization', time.perf_counter() - decode_start_time)
+                    pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+                    generated_tokens = int((output[prompt_width:] != pad_token_id).sum())
+                    self.tracer.sentence(key, streamer.end_time - streamer.start_time, len(prompt_ids), generated_tokens)
+                if on_finished is not None:
+                    on_finished(key, results[key])
+
+        elapsed = time.perf_counter() - start_time
+        self.stats = {
+            'Sentences': len(results),
+            'Batches': len(batches),
+            'Seconds': elapsed,
+            'Sentences Per Second': len(results) / elapsed if elapsed > 0 else 0.0,
+        }
+
+        return results
+
+class OpenAICompletionsBackend:
+    # an OpenAI compatible completions endpoint of a separate inference server, e.g. vLLM's
+    # http://localhost:8000/v1, queried concurrently from an asyncio client
+
+    def __init__(self, base_url, model_name, generation_config=None, max_concurrency=16, max_retries=5, retry_delay=1.0, timeout=300, api_key=None, terminator="#####", tracer=None):
+        self.completions_url = base_url.rstrip('/') + "/completions"
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.api_key = api_key
+        self.terminator = terminator
+        self.tracer = tracer
+
+        # follow the model's own sampling settings, as model.generate does, or decode greedily
+        self.sampling = {'temperature': 0.0}
+        if generation_config is not None and generation_config.do_sample:
+            self.sampling = {
+                'temperature': generation_config.temperature or 1.0,
+                'top_p': generation_config.top_p if generation_config.top_p is not None else 1.0,
+            }
+
+        self.stats = {}
+
+    def cache_settings(self):
+        # what decides the responses besides the prompt, for the response cache key
+        return {'server': self.completions_url, 'terminator': self.terminator, **self.sampling}
+
+    async def _complete(self, session, semaphore, key, prompt_ids, word_count, counters):
+        # one completion, retried on transient errors. The terminator is a stop sequence, which the
+        # server leaves out of the text, so it is put back when the server stopped on it
+        body = {
+            'model': self.model_name,
+            'prompt': prompt_ids,
+            'max_tokens': max_response_tokens(word_count),
+            'stop': [self.terminator],
+            **self.sampling,
+        }
+
+        async with semaphore:
+            start_time = time.perf_counter()
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with session.post(self.completions_url, json=body) as response:
+                        if response.status == 200:
+                            result = await response.json()
+                            break
+                        if response.status not in RETRY_STATUSES or attempt == self.max_retries:
+                            raise RuntimeError(f"The completions endpoint answered {response.status}: {await response.text()}")
+                except (aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError, asyncio.TimeoutError):
+                    if attempt == self.max_retries:
+                        raise
+                counters['Retries'] += 1
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+        choice = result['choices'][0]
+        completion_tokens = result.get('usage', {}).get('completion_tokens')
+        counters['Completion Tokens'] += completion_tokens or 0
+        if self.tracer is not None:
+            # the server's time in the queue, prefill and decode is one stage seen from here
+            latency = time.perf_counter() - start_time
+            self.tracer.add_stage('generate', latency)
+            self.tracer.sentence(key, latency, len(prompt_ids), completion_tokens)
+        text = choice['text']
+        if choice.get('finish_reason') == 'stop' and choice.get('stop_reason', self.terminator) == self.terminator:
+            text += self.terminator
+
+        return text
+
+    async def agenerate(self, requests, on_finished=None):
+        # the generated text for each key of the (key, prompt_ids, word_count) requests, with every
+        # request sent at once and at most max_concurrency of them in flight over a pooled session
+        if aiohttp is None:
+            raise ImportError("aiohttp is needed for the OpenAI compatible backend, install it or generate in process")
+
+        results = {}
+        counters = {'Retries': 0, 'Completion Tokens': 0}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        headers = {'Authorization': f"Bearer {self.api_key}"} if self.api_key else None
+        start_time = time.perf_counter()
+
+        async def complete(key, prompt_ids, word_count):
+            results[key] = await self._complete(session, semaphore, key, prompt_ids, word_count, counters)
+            if on_finished is not None:
+                on_finished(key, results[key])
+
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            tasks = [asyncio.ensure_future(complete(*request)) for request in requests]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # one failed request cancels the rest instead of leaving them running
+                for task in tasks:
+                    task.cancel()
+
+        elapsed = time.perf_counter() - start_time
+        self.stats = {
+            'Sentences': len(results),
+            'Seconds': elapsed,
+            'Sentences Per Second': len(results) / elapsed if elapsed > 0 else 0.0,
+            'Completion Tokens': counters['Completion Tokens'],
+            'Retries': counters['Retries'],
+        }
+
+        return results
+
+    def generate(self, requests, on_finished=None):
+        # the same as agenerate, for callers outside an event loop
+        return asyncio.run(self.agenerate(requests, on_finished))
+
+if __name__ == '__main__':
+    import random
+
+    from aiohttp import web
+
+    # a stub completions server whose completion is the prompt's last token ids, answering after a
+    # random delay and failing the first attempt at every third prompt with a 503
+    attempts = {}
+
+    async def completions(request):
+        body = await request.json()
+        prompt_key = tuple(body['prompt'])
+        attempts[prompt_key] = attempts.get(prompt_key, 0) + 1
+        if body['prompt'][-1] % 3 == 0 and attempts[prompt_key] == 1:
+            return web.Response(status=503, text="busy")
+
+        await asyncio.sleep(random.random() * 0.05)
+        return web.json_response({
+            'choices': [{'text': " ".join(str(token_id) for token_id in body['prompt'][-2:]) + " ", 'finish_reason': 'stop'}],
+            'usage': {'completion_tokens': 2},
+        })
+
+    async def main():
+        app = web.Application()
+        app.router.add_post('/v1/completions', completions)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        try:
+            backend = OpenAICompletionsBackend(f"http://127.0.0.1:{port}/v1", "stub", max_concurrency=8, retry_delay=0.01)
+            requests = [(key, [1, 100 + key, key], 2) for key in range(60)]
+            finish_order = []
+            results = await backend.agenerate(requests, on_finished=lambda key, text: finish_order.append(key))
+        finally:
+            await runner.cleanup()
+
+        mismatches = sum(results[key] != f"{100 + key} {key} #####" for key, _, _ in requests)
+        print(f"Mismatches: {mismatches} of {len(requests)}, finished out of order: {finish_order != sorted(finish_order)}")
+        print(backend.stats)
+
+    asyncio.run(main())
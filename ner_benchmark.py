@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+A reproducible CPU benchmark of the llama_ner.py generation pipeline, needing neither a GPU nor the
+network. It writes synthetic MultiCoNER style CoNLL files for all seven languages, each in its own
+script (Latin, Bengali, Perso-Arabic, Devanagari and Cyrillic), trains a small BPE tokenizer on
+their prompts and builds a tiny randomly initialised Llama model, all from fixed seeds. Every mode
+of the pipeline (the baseline, prefix cache, batched, continuous batching, constrained decoding,
+compact tags, packed prompts, speculative decoding and a warm response cache) then runs
+evaluate_for_language over every language.
+
+Each mode runs in a fresh worker process with a fixed number of threads, after a short warm up, so
+that its peak memory is its own and one mode's allocations do not slow down the next. The stage
+tracer of ner_instrumentation gives the per-sentence latencies and generated tokens. The sentences
+per second, 50th and 95th percentile latency, generated tokens, tokens per second and peak resident
+and accelerator memory of every mode and language are written as JSON, so that runs before and after
+a change can be compared.
+
+The model's outputs are random, so the F1-scores mean nothing; the tiny model only stands in for
+Llama-2 so that the time spent around the model can be measured.
+
+Usage: python ner_benchmark.py [--output benchmark_results.json] [--compare earlier_results.json]
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import torch
+import transformers
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+import llama_ner
+from ner_conll import load_corpus
+from ner_instrumentation import StageTracer, peak_memory
+from ner_response_cache import ResponseCache
+from ner_runner import LANGUAGES
+from ner_tags import BIO_TAGS, COMPACT_TAG_CODES
+
+# The letters each language's synthetic words are made of
+ALPHABETS = {
+    'en': "abcdefghijklmnopqrstuvwxyz",
+    'bn': "অআইউএওকখগঘচছজঝটঠডঢণতথদধনপফবভমযরলশষসহ",
+    'fa': "ابپتثجچحخدذرزژسشصضطظعغفقکگلمنوهی",
+    'hi': "अआइईउऊएऐओऔकखगघचछजझटठडढणतथदधनपफबभमयरलवशषसह",
+    'pt': "abcdefghijlmnopqrstuvxzáâãçéêíóôõú",
+    'it': "abcdefghilmnopqrstuvzàèéìòù",
+    'uk': "абвгґдеєжзиіїйклмнопрстуфхцчшщьюя",
+}
+
+# evaluate_for_language options of every mode, as llama_ner.py's constants would set them. A warm
+# response cache mode times a second pass over sentences the first pass already cached
+MODES = {
+    'baseline': {},
+    'prefix_cache': {'use_prefix_cache': True},
+    'batched': {'batch_size': 8},
+    'batched_prefix_cache': {'batch_size': 8, 'use_prefix_cache': True},
+    'continuous_batching': {'decode_slots': 8, 'use_prefix_cache': True},
+    'constrained': {'constrained': True, 'use_prefix_cache': True},
+    'compact_tags': {'compact_tags': True, 'use_prefix_cache': True},
+    'packed': {'sentences_per_prompt': 4, 'batch_size': 8, 'use_prefix_cache': True},
+    'speculative': {'speculative_drafter': 'prompt_lookup', 'use_prefix_cache': True},
+    'response_cache': {'batch_size': 8, 'use_prefix_cache': True, 'warm_response_cache': True},
+}
+
+def synthetic_sentence(rng, alphabet):
+    # words of random letters, with about a third of them starting an entity of one to three words
+    length = rng.randint(4, 12)
+    words = ["".join(rng.choice(alphabet) for _ in range(rng.randint(2, 8))) for _ in range(length)]
+    tags = []
+    while len(tags) < length:
+        if rng.random() < 0.3:
+            entity_type = rng.choice(BIO_TAGS[:-1:2])[2:]
+            span = min(rng.randint(1, 3), length - len(tags))
+            tags += [f"B-{entity_type}"] + [f"I-{entity_type}"] * (span - 1)
+        else:
+            tags.append('O')
+
+    return words, tags
+
+def write_synthetic_conll(file_path, language_code, sentence_count, seed):
+    # a MultiCoNER style CoNLL file: an id and domain line per sentence, then one "word _ _ tag" line
+    # per word and a blank line
+    rng = random.Random(f"{seed}-{language_code}")
+    with open(file_path, 'w', encoding='utf-8') as conll_file:
+        for _ in range(sentence_count):
+            words, tags = synthetic_sentence(rng, ALPHABETS[language_code])
+            conll_file.write(f"# id {uuid.UUID(int=rng.getrandbits(128))}\tdomain={language_code}\n")
+            for word, tag in zip(words, tags):
+                conll_file.write(f"{word} _ _ {tag}\n")
+            conll_file.write("\n")
+
+def train_tokenizer(texts, vocab_size):
+    # a byte pair encoding tokenizer in the style of Llama-2's: words are marked by a leading "▁", a
+    # <s> is put in front of every encoded text, and there is no padding token. Newlines are kept as
+    # tokens of their own, so the prompt segments encode the same apart as together
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([pre_tokenizers.Split("\n", "isolated"), pre_tokenizers.Metaspace()])
+    tokenizer.decoder = decoders.Metaspace()
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<unk>", "<s>", "</s>"]))
+    tokenizer.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", 1)])
+
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>")
+
+def build_benchmark(work_path, sentence_count, few_shot_size, seed, vocab_size=4000):
+    # writes every language's CoNLL file and saves a tokenizer trained on their full, compact and
+    # packed prompts together with a tiny Llama model, returning the model's path
+    texts = []
+    for language_code, language in LANGUAGES.items():
+        file_path = os.path.join(work_path, f"{language_code}_test.conll")
+        write_synthetic_conll(file_path, language_code, sentence_count + few_shot_size, seed)
+
+        # The tokenizer is trained on every sentence, so the whole file is read into a corpus
+        dataset = load_corpus(file_path)
+        examples = [sentence.text for sentence in dataset]
+        annotations = [" ".join(sentence.tags) for sentence in dataset]
+        compact_annotations = [" ".join(COMPACT_TAG_CODES[tag] for tag in sentence.tags) for sentence in dataset]
+        texts += llama_ner.create_ner_prompt_segments(language, examples, annotations)
+        texts += llama_ner.create_ner_prompt_segments(language, examples, compact_annotations, tag_codes=COMPACT_TAG_CODES, packed=True)
+        texts += [f"\nSentence: {example}\nSequence of BIO Tags: {annotation} #####" for example, annotation in zip(examples, annotations)]
+
+    tokenizer = train_tokenizer(texts, vocab_size)
+
+    # The generation config pads with <unk>, as Llama-2-7b-chat-hf's does
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.unk_token_id,
+    )
+    model = LlamaForCausalLM(config).eval()
+
+    model_path = os.path.join(work_path, "tiny_llama")
+    tokenizer.save_pretrained(model_path)
+    model.save_pretrained(model_path)
+
+    return model_path
+
+def latency_quantiles(latencies):
+    # the 50th and 95th percentile latency, or None when no sentence was generated
+    if not latencies:
+        return None, None
+    return float(np.quantile(latencies, 0.5)), float(np.quantile(latencies, 0.95))
+
+def run_mode(work_path, model_path, mode, few_shot_size, sample_size, threads):
+    # runs one mode over every language in this process and returns its results, with the pipeline's
+    # reports going to the mode's log. Meant to be the only work of a fresh process, so that the peak
+    # memory is this mode's alone
+    torch.set_num_threads(threads)
+    with open(os.path.join(work_path, f"{mode}.log"), 'w', encoding='utf-8') as log_file, contextlib.redirect_stdout(log_file):
+        return _run_mode(work_path, model_path, mode, few_shot_size, sample_size)
+
+def _run_mode(work_path, model_path, mode, few_shot_size, sample_size):
+    options = dict(MODES[mode])
+    warm_response_cache = options.pop('warm_response_cache', False)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path).eval()
+
+    datasets = {}
+    for language_code in LANGUAGES:
+        datasets[language_code] = llama_ner.get_examples_and_sample(llama_ner.load_ner_data(os.path.join(work_path, f"{language_code}_test.conll")), few_shot_size, sample_size)
+
+    def evaluate(language_code, sample_data, response_cache=None, tracer=None):
+        few_shot_data = datasets[language_code][0]
+        output_path = os.path.join(work_path, f"{mode}_{language_code}")
+        llama_ner.evaluate_for_language(model, tokenizer, LANGUAGES[language_code], sample_data, few_shot_data, output_path + "_predictions.txt", output_path + "_scores.json", output_path + "_decoded.txt", response_cache=response_cache, tracer=tracer, **options)
+
+    # The first generate calls are slower than the rest, so a few sentences are run before timing
+    evaluate('en', datasets['en'][1][:2])
+
+    response_cache = None
+    if warm_response_cache:
+        response_cache = ResponseCache(os.path.join(work_path, f"{mode}_response_cache.sqlite"), model_path, model.generation_config.to_dict())
+        for language_code in LANGUAGES:
+            evaluate(language_code, datasets[language_code][1], response_cache=response_cache)
+
+    tracer = StageTracer(os.path.join(work_path, f"{mode}_trace.jsonl"))
+    languages = {}
+    try:
+        for language_code, language in LANGUAGES.items():
+            sample_data = datasets[language_code][1]
+            start_time = time.perf_counter()
+            evaluate(language_code, sample_data, response_cache=response_cache, tracer=tracer)
+            seconds = time.perf_counter() - start_time
+
+            p50_latency, p95_latency = latency_quantiles(tracer.latencies.get(language, []))
+            generated_tokens = tracer.generated_tokens.get(language, 0)
+            with open(os.path.join(work_path, f"{mode}_{language_code}_scores.json"), encoding='utf-8') as score_file:
+                f1_score = json.load(score_file)['F1-Score']
+            languages[language_code] = {
+                'Sentences': len(sample_data),
+                'Seconds': seconds,
+                'Sentences Per Second': len(sample_data) / seconds,
+                'Traced Sentences': len(tracer.latencies.get(language, [])),
+                'P50 Latency Seconds': p50_latency,
+                'P95 Latency Seconds': p95_latency,
+                'Generated Tokens': generated_tokens,
+                'Tokens Per Second': generated_tokens / seconds,
+                'F1-Score': f1_score,
+            }
+    finally:
+        tracer.close()
+        if response_cache is not None:
+            response_cache.close()
+
+    sentences = sum(result['Sentences'] for result in languages.values())
+    seconds = sum(result['Seconds'] for result in languages.values())
+    generated_tokens = sum(result['Generated Tokens'] for result in languages.values())
+    p50_latency, p95_latency = latency_quantiles([latency for latencies in tracer.latencies.values() for latency in latencies])
+    peak_rss, peak_accelerator = peak_memory()
+
+    return {
+        'Options': MODES[mode],
+        'Sentences': sentences,
+        'Seconds': seconds,
+        'Sentences Per Second': sentences / seconds,
+        'P50 Latency Seconds': p50_latency,
+        'P95 Latency Seconds': p95_latency,
+        'Generated Tokens': generated_tokens,
+        'Tokens Per Second': generated_tokens / seconds,
+        'Peak RSS Bytes': peak_rss,
+        'Peak Accelerator Bytes': peak_accelerator,
+        'Languages': languages,
+    }
+
+def compare_results(results, earlier_results):
+    # each mode's sentences per second and p95 latency against an earlier run's, as ratios of the new
+    # value to the old one. Modes missing from either run are left out
+    comparison = {}
+    for mode, result in results['Modes'].items():
+        earlier = earlier_results.get('Modes', {}).get(mode)
+        if earlier is None:
+            continue
+        comparison[mode] = {
+            'Sentences Per Second Ratio': result['Sentences Per Second'] / earlier['Sentences Per Second'],
+            'P95 Latency Ratio': result['P95 Latency Seconds'] / earlier['P95 Latency Seconds'] if result['P95 Latency Seconds'] and earlier['P95 Latency Seconds'] else None,
+        }
+
+    return comparison
+
+def run_benchmark(modes, work_path, sentence_count=20, few_shot_size=10, seed=16, threads=1):
+    # builds the data and model once, then runs each mode in its own spawned worker process
+    model_path = build_benchmark(work_path, sentence_count, few_shot_size, seed)
+
+    results = {
+        'Environment': {
+            'Python': platform.python_version(),
+            'Platform': platform.platform(),
+            'Processor': platform.processor(),
+            'Torch': torch.__version__,
+            'Transformers': transformers.__version__,
+            'Threads': threads,
+        },
+        'Settings': {'Sentences Per Language': sentence_count, 'Few Shot Size': few_shot_size, 'Seed': seed},
+        'Modes': {},
+    }
+
+    context = multiprocessing.get_context('spawn')
+    for mode in modes:
+        with context.Pool(processes=1) as pool:
+            results['Modes'][mode] = pool.apply(run_mode, (work_path, model_path, mode, few_shot_size, sentence_count, threads))
+
+        result = results['Modes'][mode]
+        print(f"{mode.upper()}: {result['Sentences Per Second']:.2f} sentences per second, p50 {result['P50 Latency Seconds']} s, p95 {result['P95 Latency Seconds']} s, {result['Generated Tokens']} generated tokens, peak RSS {result['Peak RSS Bytes'] / 1024 ** 2:.0f} MiB")
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks every generation mode of llama_ner.py on a tiny model on the CPU")
+    parser.add_argument('--output', default="benchmark_results.json", help="where to write the results as JSON")
+    parser.add_argument('--compare', help="an earlier results file to compare each mode's throughput and latency with")
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES), help="the modes to run, all of them by default")
+    parser.add_argument('--sentences', type=int, default=20, help="test sentences per language")
+    parser.add_argument('--few-shot-size', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=1, help="torch threads per mode, kept fixed so that runs compare")
+    parser.add_argument('--work-dir', help="where to keep the data, model and outputs, a temporary folder by default")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_path:
+        work_path = args.work_dir or temporary_path
+        os.makedirs(work_path, exist_ok=True)
+        results = run_benchmark(args.modes, work_path, sentence_count=args.sentences, few_shot_size=args.few_shot_size, seed=args.seed, threads=args.threads)
+
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as earlier_file:
+            results['Comparison'] = compare_results(results, json.load(earlier_file))
+        print("BENCHMARK COMPARISON: ", results['Comparison'])
+
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        output_file.write(json.dumps(results, indent=4))
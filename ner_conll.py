@@ -0,0 +1,149 @@
+"""
+An indexed reader for large MultiCoNER .conll files. The file is scanned once into the byte offsets
+of every sentence, and the index is saved next to it (e.g. en_train.conll.index.npz) so later runs
+skip the scan. The file itself is memory mapped, and only the sentences that are actually used are
+parsed. An IndexedConllFile can stand in for the corpus from load_ner_data wherever it is only
+sampled from or dropped from, picking exactly the same sentences for the same random_state, and it
+can also be iterated over sentence by sentence without building a corpus at all. load_corpus reads a
+whole file into a NerCorpus through the binary corpus cache kept next to it, and open_corpus is what
+the scripts sample from: that cache while it is valid, and otherwise the indexed file, so that a
+file without a cache is never parsed in full just to draw a sample from it.
+"""
+
+import mmap
+import os
+
+import numpy as np
+
+from ner_corpus import NerCorpus, load_corpus_cache, save_corpus_cache
+
+def build_sentence_offsets(file_path):
+    # byte offsets of the first and past-the-last token line of every sentence. As in load_ner_data,
+    # a sentence is only complete once a blank line or a '# id' line follows it
+    starts = []
+    ends = []
+    sentence_start = None
+    offset = 0
+
+    with open(file_path, 'rb') as file:
+        for line in file:
+            stripped = line.decode('utf-8').strip()
+            if not stripped or stripped.startswith('# id'):
+                if sentence_start is not None:
+                    starts.append(sentence_start)
+                    ends.append(offset)
+                sentence_start = None
+            elif sentence_start is None:
+                sentence_start = offset
+            offset += len(line)
+
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+def load_sentence_offsets(file_path):
+    # the saved sentence offsets of a file, rebuilt whenever the file's size or modification time
+    # no longer match the ones they were built from
+    index_path = file_path + ".index.npz"
+    source = os.stat(file_path)
+
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            if index['source_size'] == source.st_size and index['source_mtime_ns'] == source.st_mtime_ns:
+                return index['starts'], index['ends']
+
+    starts, ends = build_sentence_offsets(file_path)
+
+    # written under a temporary name of this process's own and moved into place, so a crash never
+    # leaves a partial index and shards indexing the same file at once never share a file
+    temporary_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'wb') as index_file:
+        np.savez(index_file, starts=starts, ends=ends, source_size=source.st_size, source_mtime_ns=source.st_mtime_ns)
+    os.replace(temporary_path, index_path)
+
+    return starts, ends
+
+class IndexedConllFile:
+    # the sentences of a .conll file, or the subset of them left after drop, read on demand from a
+    # memory map. Sentence positions in the file double as the row index, as in load_ner_data
+
+    def __init__(self, file_path, positions=None, _offsets=None, _buffer=None):
+        self.file_path = file_path
+        self.starts, self.ends = _offsets if _offsets is not None else load_sentence_offsets(file_path)
+        self.positions = np.arange(len(self.starts)) if positions is None else positions
+
+        if _buffer is not None:
+            self.buffer = _buffer
+        elif os.path.getsize(file_path) > 0:
+            with open(file_path, 'rb') as file:
+                self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = b""
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, item):
+        # a NerCorpus of the sentences in a slice of positions, as slicing a corpus gives
+        return self.rows(self.positions[item])
+
+    @property
+    def index(self):
+        return self.positions
+
+    def sentence(self, position):
+        # parses the words and tags of the sentence at a position in the file
+        words = []
+        tags = []
+        for line in self.buffer[self.starts[position]:self.ends[position]].decode('utf-8').split('\n'):
+            parts = line.split()
+            if parts:
+                words.append(parts[0])
+                tags.append(parts[-1])  # The last column is the tag
+
+        return words, tags
+
+    def iter_sentences(self):
+        # yields (sentence_id, words, tags) for each sentence in turn without building a corpus
+        for position in self.positions:
+            words, tags = self.sentence(position)
+            yield int(position), words, tags
+
+    def rows(self, positions):
+        # a NerCorpus, as load_ner_data returns, holding only the sentences at the given positions
+        return NerCorpus.from_sentences((int(position),) + self.sentence(position) for position in positions)
+
+    def sample(self, n, random_state=None):
+        # the same sentences load_ner_data's corpus (or DataFrame.sample) picks for the same random_state
+        if random_state is None:
+            random_state = np.random.mtrand._rand
+        elif not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        chosen = random_state.choice(len(self.positions), size=n, replace=False)
+
+        return self.rows(self.positions[chosen])
+
+    def drop(self, labels):
+        # the sentences left after removing the given row labels, still read lazily
+        remaining = self.positions[~np.isin(self.positions, np.asarray(labels, dtype=np.int64))]
+
+        return IndexedConllFile(self.file_path, remaining, _offsets=(self.starts, self.ends), _buffer=self.buffer)
+
+def load_corpus(file_path):
+    # the whole file as a NerCorpus, memory mapped from the binary cache next to it (e.g.
+    # en_test.conll.corpus) while that is still valid, and otherwise streamed into a new corpus
+    # sentence by sentence and cached
+    cache_path = file_path + ".corpus"
+    corpus = load_corpus_cache(cache_path, file_path)
+    if corpus is None:
+        corpus = NerCorpus.from_sentences(IndexedConllFile(file_path).iter_sentences())
+        save_corpus_cache(corpus, cache_path, file_path)
+
+    return corpus
+
+def open_corpus(file_path):
+    # the file to sample from: the memory mapped corpus cache next to it while that is still valid,
+    # and otherwise the indexed file, which only parses the sentences that are sampled from it
+    corpus = load_corpus_cache(file_path + ".corpus", file_path)
+    if corpus is None:
+        return IndexedConllFile(file_path)
+
+    return corpus
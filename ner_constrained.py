@@ -0,0 +1,163 @@
+"""
+Grammar constrained decoding of BIO tag sequences. Every tag in the closed inventory is tokenized
+into a token level trie, and a logits processor follows each generated sequence through that trie,
+one new token per step, so that only tokens continuing a valid tag can be generated. I- tags may only
+follow a B- or I- tag of the same type, and the ##### terminator is forced once the sequence holds a
+tag for every word.
+"""
+
+import torch
+from transformers import LogitsProcessor
+
+from ner_tags import BIO_TAGS, can_follow, encode_tags
+
+def continuation_ids(tokenizer, text, anchor="Tags:"):
+    # token ids `text` gets when generated straight after the prompt's "Sequence of BIO Tags:". It is
+    # encoded behind an anchor and only what follows the anchor is kept, since sentencepiece treats
+    # a leading space at the very start of a string differently from one in the middle of a sequence
+    anchor_ids = tokenizer.encode(anchor, add_special_tokens=False)
+    full_ids = tokenizer.encode(anchor + text, add_special_tokens=False)
+
+    if full_ids[:len(anchor_ids)] == anchor_ids:
+        return full_ids[len(anchor_ids):]
+    return tokenizer.encode(text, add_special_tokens=False)
+
+class TagTrieNode:
+    __slots__ = ('children', 'tag', 'reachable_tags')
+
+    def __init__(self):
+        self.children = {}
+        self.tag = None
+        self.reachable_tags = set()
+
+class TagGrammar:
+    # the token level trie over " <tag>" for every tag, together with the terminator's token ids. It
+    # only depends on the tokenizer and tag alphabet, so it is built once and shared by every generate
+    # call. With tag codes, the trie is built over the compact codes instead of the full tags
+
+    def __init__(self, tokenizer, tag_codes=None, terminator="#####"):
+        self.tags = encode_tags(BIO_TAGS, tag_codes) if tag_codes is not None else list(BIO_TAGS)
+        full_tags = dict(zip(self.tags, BIO_TAGS))
+        self.root = TagTrieNode()
+        self.max_tag_length = 0
+
+        for tag in self.tags:
+            tag_ids = continuation_ids(tokenizer, " " + tag)
+            self.max_tag_length = max(self.max_tag_length, len(tag_ids))
+
+            node = self.root
+            node.reachable_tags.add(tag)
+            for token_id in tag_ids:
+                node = node.children.setdefault(token_id, TagTrieNode())
+                node.reachable_tags.add(tag)
+            node.tag = tag
+
+        self.terminator_ids = continuation_ids(tokenizer, " " + terminator)
+        self.eos_token_id = tokenizer.eos_token_id
+
+        # tags allowed to start after each possible previous tag, None being the start of the sequence
+        self.allowed_after = {
+            previous_tag: {tag for tag in self.tags if can_follow(full_tags.get(previous_tag), full_tags[tag])}
+            for previous_tag in [None] + self.tags
+        }
+
+    def _tag_start_ids(self, previous_tag):
+        allowed_tags = self.allowed_after[previous_tag]
+        return [token_id for token_id, child in self.root.children.items() if not child.reachable_tags.isdisjoint(allowed_tags)]
+
+class TagGrammarState:
+    # where one generated sequence is in the tag grammar: the trie node of the tag being spelled out,
+    # the last complete tag, how many tags are complete and how much of the terminator has been
+    # generated. It is only advanced by the tokens generated since the last step, so that a step
+    # does not walk the whole sequence again
+
+    def __init__(self, tag_grammar, word_count):
+        self.tag_grammar = tag_grammar
+        self.word_count = word_count
+        self.length = 0
+        self.node = tag_grammar.root
+        self.previous_tag = None
+        self.tag_count = 0
+        self.terminator_position = None
+        self.left_grammar = False
+
+    def extend(self, token_ids):
+        grammar = self.tag_grammar
+        for token_id in token_ids:
+            self.length += 1
+            if self.left_grammar:
+                continue
+
+            if self.terminator_position is not None:
+                if self.terminator_position < len(grammar.terminator_ids):
+                    self.terminator_position += 1
+                continue
+
+            # a token that does not continue the current tag completes it and starts the next item
+            if self.node is not grammar.root and token_id not in self.node.children:
+                if self.node.tag is None:
+                    self.left_grammar = True
+                    continue
+                self.tag_count += 1
+                self.previous_tag = self.node.tag
+                self.node = grammar.root
+
+            if self.node is grammar.root and self.tag_count == self.word_count:
+                self.terminator_position = 1
+                continue
+
+            self.node = self.node.children.get(token_id)
+            if self.node is None:
+                self.left_grammar = True
+
+    def allowed_token_ids(self):
+        # the token ids allowed next, or None if the sequence has left the grammar and should not be
+        # constrained any further
+        grammar = self.tag_grammar
+        if self.left_grammar:
+            return None
+
+        if self.terminator_position is not None:
+            if self.terminator_position < len(grammar.terminator_ids):
+                return [grammar.terminator_ids[self.terminator_position]]
+            return [grammar.eos_token_id]
+
+        if self.node is grammar.root:
+            if self.tag_count == self.word_count:
+                return [grammar.terminator_ids[0]]
+            return grammar._tag_start_ids(self.previous_tag)
+
+        allowed_tags = grammar.allowed_after[self.previous_tag]
+        allowed_ids = [token_id for token_id, child in self.node.children.items() if not child.reachable_tags.isdisjoint(allowed_tags)]
+
+        # the current node may already spell out a whole tag, in which case the next item can start
+        if self.node.tag in allowed_tags:
+            if self.tag_count + 1 == self.word_count:
+                allowed_ids.append(grammar.terminator_ids[0])
+            else:
+                allowed_ids.extend(grammar._tag_start_ids(self.node.tag))
+
+        return allowed_ids
+
+class BIOConstrainedLogitsProcessor(LogitsProcessor):
+    # masks every token the tag grammar does not allow next, per row of the batch. Each row keeps
+    # its grammar state, which is only given the row's new tokens
+
+    def __init__(self, tag_grammar, prompt_length, word_counts):
+        self.tag_grammar = tag_grammar
+        self.prompt_length = prompt_length
+        self.word_counts = word_counts
+        self.states = [TagGrammarState(tag_grammar, word_count) for word_count in word_counts]
+
+    def __call__(self, input_ids, scores):
+        mask = torch.full_like(scores, float('-inf'))
+
+        for row, state in enumerate(self.states):
+            state.extend(input_ids[row, self.prompt_length + state.length:].tolist())
+            allowed_ids = state.allowed_token_ids()
+            if allowed_ids is None:
+                mask[row] = 0
+            else:
+                mask[row, allowed_ids] = 0
+
+        return scores + mask
@@ -0,0 +1,302 @@
+"""
+Continuous batching for NER generation. A fixed number of decode slots each hold one test sentence.
+Every step decodes one token for all occupied slots in a single forward pass, sentences whose tag
+sequence is finished are evicted straight away, and waiting sentences are admitted into the freed
+slots, so one long Bangla or Farsi output no longer holds up a whole static batch.
+
+The slots share one batched key/value cache that is left padded to the longest slot, with an
+attention mask hiding the padding and explicit position ids per slot. A newly admitted sentence is
+prefilled on its own (on top of the few shot prefix cache, or the longest prefix in a radix prefix
+cache, when one is given) and merged in.
+
+Running this file directly checks the engine against model.generate on a tiny randomly initialised
+Llama model on the CPU and prints the throughput stats.
+"""
+
+import time
+from collections import deque
+
+import torch
+
+from ner_constrained import TagGrammarState
+from ner_generation import ResponseScanner, max_response_tokens, shared_prefix_length, slice_past_key_values
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+def to_legacy_cache(past_key_values):
+    # the engine pads, merges and evicts the cache as plain tuples of (key, value) tensors per layer
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+def to_model_cache(legacy_cache):
+    # newer transformers versions expect a Cache object rather than tuples
+    if DynamicCache is not None:
+        return DynamicCache.from_legacy_cache(legacy_cache)
+    return legacy_cache
+
+def left_pad_cache(legacy_cache, width):
+    # pads every layer's keys and values with zeros on the left up to `width` positions
+    padding = width - legacy_cache[0][0].shape[2]
+    if padding == 0:
+        return legacy_cache
+
+    return tuple(
+        (torch.nn.functional.pad(key, (0, 0, padding, 0)), torch.nn.functional.pad(value, (0, 0, padding, 0)))
+        for key, value in legacy_cache
+    )
+
+def sampling_probabilities(logits, temperature, top_p):
+    # the distribution each row's next token is sampled from, with the temperature applied and the
+    # tokens outside the top p mass zeroed out
+    probabilities = torch.softmax(logits / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probabilities, sorted_ids = probabilities.sort(dim=-1, descending=True)
+        outside_top_p = sorted_probabilities.cumsum(dim=-1) - sorted_probabilities > top_p
+        sorted_probabilities[outside_top_p] = 0
+        probabilities = torch.zeros_like(probabilities).scatter(-1, sorted_ids, sorted_probabilities)
+
+    return probabilities
+
+class DecodeSlot:
+    __slots__ = ('key', 'word_count', 'max_new_tokens', 'generated_ids', 'scanner', 'grammar_state', 'position', 'prompt_length', 'start_time')
+
+    def __init__(self, key, word_count, max_new_tokens, position, scanner, grammar_state=None):
+        self.key = key
+        self.word_count = word_count
+        self.max_new_tokens = max_new_tokens
+        self.generated_ids = []
+        self.scanner = scanner
+        self.grammar_state = grammar_state
+        self.position = position
+        self.prompt_length = position
+        self.start_time = time.perf_counter()
+
+class ContinuousBatchingEngine:
+    # generates the tag sequences of many sentences through a fixed number of decode slots
+
+    def __init__(self, model, tokenizer, num_slots, prefix_cache=None, tag_grammar=None, terminator="#####", radix_cache=None, tracer=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.num_slots = num_slots
+        self.prefix_cache = prefix_cache
+        self.radix_cache = radix_cache
+        self.tag_grammar = tag_grammar
+        self.terminator = terminator
+        self.tracer = tracer
+
+        # follow the model's own sampling settings, as model.generate does
+        generation_config = model.generation_config
+        self.do_sample = bool(generation_config.do_sample)
+        self.temperature = generation_config.temperature or 1.0
+        self.top_p = generation_config.top_p if generation_config.top_p is not None else 1.0
+
+        self.stats = {}
+
+    def _next_tokens(self, logits, slots):
+        # greedy or sampled next token per slot, masked to the tag grammar when one is given
+        if self.tag_grammar is not None:
+            mask = torch.full_like(logits, float('-inf'))
+            for row, slot in enumerate(slots):
+                # each slot's grammar state only takes the tokens generated since its last step
+                slot.grammar_state.extend(slot.generated_ids[slot.grammar_state.length:])
+                allowed_ids = slot.grammar_state.allowed_token_ids()
+                if allowed_ids is None:
+                    mask[row] = 0
+                else:
+                    mask[row, allowed_ids] = 0
+            logits = logits + mask
+
+        if not self.do_sample:
+            return logits.argmax(dim=-1).tolist()
+
+        return torch.multinomial(sampling_probabilities(logits, self.temperature, self.top_p), 1).squeeze(-1).tolist()
+
+    def _record(self, slot):
+        # the finished sentence's latency from its admission, when tracing
+        if self.tracer is not None:
+            self.tracer.sentence(slot.key, time.perf_counter() - slot.start_time, slot.prompt_length, len(slot.generated_ids))
+
+    def _is_finished(self, slot):
+        if not slot.generated_ids:
+            return False
+        if slot.generated_ids[-1] == self.tokenizer.eos_token_id or len(slot.generated_ids) >= slot.max_new_tokens:
+            return True
+
+        # only the tokens generated since the last check are scanned
+        slot.scanner.extend(slot.generated_ids[len(slot.scanner.token_ids):])
+        return slot.scanner.is_complete(slot.word_count)
+
+    def _prefill(self, prompt_ids):
+        # runs one prompt through the model, reusing the few shot prefix cache where it matches, or
+        # the longest prefix of the prompt in the radix cache when one is given
+        prefix_cache = self.prefix_cache
+        if self.radix_cache is not None:
+            prefix_cache = self.radix_cache.prefix(prompt_ids[:-1])
+
+        cached_length = 0
+        past_key_values = None
+        if prefix_cache is not None and prefix_cache[1] is not None:
+            prefix_ids, prefix_past_key_values = prefix_cache
+            cached_length = shared_prefix_length(prefix_ids, prompt_ids)
+            if cached_length > 0:
+                past_key_values = to_model_cache(to_legacy_cache(slice_past_key_values(prefix_past_key_values, cached_length)))
+
+        input_ids = torch.tensor([prompt_ids[cached_length:]], device=self.model.device)
+        with torch.no_grad():
+            outputs = self.model(input_ids, past_key_values=past_key_values, use_cache=True)
+
+        return outputs.logits[:, -1], to_legacy_cache(outputs.past_key_values)
+
+    def generate(self, requests, on_finished=None):
+        # takes (key, prompt_ids, word_count) requests and returns the generated text for each key,
+        # also passing each key and text to `on_finished` as soon as that sentence is evicted
+        pending = deque(requests)
+        slots = []
+        cache = None
+        attention_mask = None
+        results = {}
+
+        start_time = time.perf_counter()
+        decode_steps = 0
+        occupied_slot_steps = 0
+        generated_tokens = 0
+        decode_seconds = 0.0
+
+        while pending or slots:
+            # admit waiting sentences into free slots
+            while pending and len(slots) < self.num_slots:
+                key, prompt_ids, word_count = pending.popleft()
+                max_new_tokens = max_response_tokens(word_count)
+                grammar_state = None
+                if self.tag_grammar is not None:
+                    max_new_tokens = word_count * self.tag_grammar.max_tag_length + len(self.tag_grammar.terminator_ids) + 1
+                    grammar_state = TagGrammarState(self.tag_grammar, word_count)
+
+                slot = DecodeSlot(key, word_count, max_new_tokens, len(prompt_ids), ResponseScanner(self.tokenizer, self.terminator), grammar_state)
+                logits, slot_cache = self._prefill(prompt_ids)
+                slot.generated_ids.append(self._next_tokens(logits, [slot])[0])
+                generated_tokens += 1
+                if self.tracer is not None:
+                    self.tracer.add_stage('prefill', time.perf_counter() - slot.start_time, prompt_tokens=len(prompt_ids))
+
+                if self._is_finished(slot):
+                    results[key] = self.tokenizer.decode(slot.generated_ids, skip_special_tokens=True)
+                    self._record(slot)
+                    if on_finished is not None:
+                        on_finished(key, results[key])
+                    continue
+
+                slot_mask = torch.ones((1, len(prompt_ids)), dtype=torch.long, device=self.model.device)
+                if cache is None:
+                    cache, attention_mask = slot_cache, slot_mask
+                else:
+                    width = max(attention_mask.shape[1], slot_mask.shape[1])
+                    cache = tuple(
+                        (torch.cat([key_states, new_key_states]), torch.cat([value_states, new_value_states]))
+                        for (key_states, value_states), (new_key_states, new_value_states)
+                        in zip(left_pad_cache(cache, width), left_pad_cache(slot_cache, width))
+                    )
+                    attention_mask = torch.cat([
+                        torch.nn.functional.pad(attention_mask, (width - attention_mask.shape[1], 0)),
+                        torch.nn.functional.pad(slot_mask, (width - slot_mask.shape[1], 0)),
+                    ])
+                slots.append(slot)
+
+            if not slots:
+                continue
+
+            # decode one token for every occupied slot
+            step_start_time = time.perf_counter()
+            input_ids = torch.tensor([[slot.generated_ids[-1]] for slot in slots], device=self.model.device)
+            position_ids = torch.tensor([[slot.position] for slot in slots], device=self.model.device)
+            attention_mask = torch.nn.functional.pad(attention_mask, (0, 1), value=1)
+
+            with torch.no_grad():
+                outputs = self.model(input_ids, attention_mask=attention_mask, position_ids=position_ids, past_key_values=to_model_cache(cache), use_cache=True)
+            cache = to_legacy_cache(outputs.past_key_values)
+
+            for slot, token_id in zip(slots, self._next_tokens(outputs.logits[:, -1], slots)):
+                slot.generated_ids.append(token_id)
+                slot.position += 1
+
+            decode_steps += 1
+            decode_seconds += time.perf_counter() - step_start_time
+            occupied_slot_steps += len(slots)
+            generated_tokens += len(slots)
+
+            # evict finished sentences and drop cache columns that are padding in every remaining slot
+            finished = [self._is_finished(slot) for slot in slots]
+            if any(finished):
+                for slot, is_finished in zip(slots, finished):
+                    if is_finished:
+                        results[slot.key] = self.tokenizer.decode(slot.generated_ids, skip_special_tokens=True)
+                        self._record(slot)
+                        if on_finished is not None:
+                            on_finished(slot.key, results[slot.key])
+
+                keep = [row for row, is_finished in enumerate(finished) if not is_finished]
+                slots = [slots[row] for row in keep]
+                if not slots:
+                    cache, attention_mask = None, None
+                    continue
+
+                rows = torch.tensor(keep, device=self.model.device)
+                attention_mask = attention_mask[rows]
+                first_column = int(attention_mask.any(dim=0).nonzero()[0])
+                attention_mask = attention_mask[:, first_column:]
+                cache = tuple((key_states[rows, :, first_column:], value_states[rows, :, first_column:]) for key_states, value_states in cache)
+
+        # the decode steps are traced as one stage call, timing each would double their bookkeeping
+        if self.tracer is not None and decode_steps:
+            self.tracer.add_stage('decode', decode_seconds, steps=decode_steps)
+
+        elapsed = time.perf_counter() - start_time
+        self.stats = {
+            'Sentences': len(results),
+            'Seconds': elapsed,
+            'Sentences Per Second': len(results) / elapsed if elapsed > 0 else 0.0,
+            'Generated Tokens': generated_tokens,
+            'Tokens Per Second': generated_tokens / elapsed if elapsed > 0 else 0.0,
+            'Decode Steps': decode_steps,
+            'Mean Slot Occupancy': occupied_slot_steps / (decode_steps * self.num_slots) if decode_steps else 0.0,
+        }
+
+        return results
+
+if __name__ == '__main__':
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    # a tiny randomly initialised Llama model, decoded greedily, only needs token ids and an eos id
+    class TokenIdTokenizer:
+        eos_token_id = 2
+
+        def decode(self, token_ids, skip_special_tokens=True):
+            return " ".join(str(token_id) for token_id in token_ids if not (skip_special_tokens and token_id == self.eos_token_id))
+
+    torch.manual_seed(16)
+    config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, max_position_embeddings=512, bos_token_id=1, eos_token_id=2)
+    model = LlamaForCausalLM(config).eval()
+    model.generation_config.do_sample = False
+    tokenizer = TokenIdTokenizer()
+
+    prefix_ids = [1] + torch.randint(3, 128, (40,)).tolist()
+    requests = [(index, prefix_ids + torch.randint(3, 128, (int(torch.randint(2, 12, ())),)).tolist(), int(torch.randint(1, 8, ()))) for index in range(24)]
+
+    with torch.no_grad():
+        prefix_cache = (prefix_ids, model(torch.tensor([prefix_ids]), use_cache=True).past_key_values)
+
+    engine = ContinuousBatchingEngine(model, tokenizer, num_slots=4, prefix_cache=prefix_cache, terminator="#####")
+    results = engine.generate(requests)
+
+    mismatches = 0
+    for key, prompt_ids, word_count in requests:
+        # with no terminator in this vocabulary, a sentence ends after word_count + 1 tokens
+        expected_ids = model.generate(torch.tensor([prompt_ids]), attention_mask=torch.ones((1, len(prompt_ids)), dtype=torch.long), max_new_tokens=word_count + 1, do_sample=False, pad_token_id=2)[0, len(prompt_ids):]
+        mismatches += results[key] != tokenizer.decode(expected_ids.tolist())
+
+    print(f"Mismatches against model.generate: {mismatches} of {len(requests)}")
+    print(engine.stats)
@@ -0,0 +1,304 @@
+"""
+A compact columnar representation of a NER corpus. Rather than one DataFrame row of Python lists per
+sentence, the words of every sentence are interned into one contiguous int32 word id array and the
+tags into one uint8 tag id array over the 67 tag inventory, with CSR style offsets marking where
+each sentence starts. Sentences are read through light views that only hold the corpus and a
+position, and sampling or dropping sentences gathers the arrays rather than copying Python objects.
+
+A parsed corpus can be saved to a binary cache file next to its source and memory mapped back, so
+later runs use the arrays without parsing or copying anything.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+from ner_tags import BIO_TAGS
+
+class SentenceView:
+    __slots__ = ('corpus', 'position')
+
+    def __init__(self, corpus, position):
+        self.corpus = corpus
+        self.position = position
+
+    def __len__(self):
+        return int(self.corpus.offsets[self.position + 1] - self.corpus.offsets[self.position])
+
+    @property
+    def sentence_id(self):
+        return int(self.corpus.sentence_ids[self.position])
+
+    @property
+    def word_ids(self):
+        return self.corpus.word_ids[self.corpus.offsets[self.position]:self.corpus.offsets[self.position + 1]]
+
+    @property
+    def tag_ids(self):
+        return self.corpus.tag_ids[self.corpus.offsets[self.position]:self.corpus.offsets[self.position + 1]]
+
+    @property
+    def words(self):
+        vocabulary = self.corpus.vocabulary
+        return [vocabulary[word_id] for word_id in self.word_ids]
+
+    @property
+    def tags(self):
+        tag_names = self.corpus.tag_names
+        return [tag_names[tag_id] for tag_id in self.tag_ids]
+
+    @property
+    def text(self):
+        return " ".join(self.words)
+
+class NerCorpus:
+    # sentences as interned word and tag id arrays with CSR offsets. Each sentence keeps the id it was
+    # loaded with, which serves as its row label for sampling, dropping and looking it up again
+
+    def __init__(self, sentence_ids, offsets, word_ids, tag_ids, vocabulary, tag_names):
+        self.sentence_ids = sentence_ids
+        self.offsets = offsets
+        self.word_ids = word_ids
+        self.tag_ids = tag_ids
+        self.vocabulary = vocabulary
+        self.tag_names = tag_names
+        self._positions_by_id = None
+
+    @classmethod
+    def from_sentences(cls, sentences):
+        # builds a corpus from (sentence_id, words, tags) triples. Tags outside the inventory are
+        # given ids after the 67 inventory tags
+        word_index = {}
+        vocabulary = []
+        tag_index = {tag: tag_id for tag_id, tag in enumerate(BIO_TAGS)}
+        tag_names = list(BIO_TAGS)
+
+        sentence_ids = []
+        lengths = []
+        word_ids = []
+        tag_ids = []
+        for sentence_id, words, tags in sentences:
+            sentence_ids.append(sentence_id)
+            lengths.append(len(words))
+            for word in words:
+                word_id = word_index.get(word)
+                if word_id is None:
+                    word_id = word_index[word] = len(vocabulary)
+                    vocabulary.append(word)
+                word_ids.append(word_id)
+            for tag in tags:
+                tag_id = tag_index.get(tag)
+                if tag_id is None:
+                    tag_id = tag_index[tag] = len(tag_names)
+                    tag_names.append(tag)
+                tag_ids.append(tag_id)
+
+        if len(tag_names) > np.iinfo(np.uint8).max + 1:
+            raise ValueError(f"{len(tag_names)} distinct tags do not fit in uint8 tag ids")
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        return cls(
+            np.array(sentence_ids, dtype=np.int64),
+            offsets,
+            np.array(word_ids, dtype=np.int32),
+            np.array(tag_ids, dtype=np.uint8),
+            vocabulary,
+            tag_names,
+        )
+
+    def __len__(self):
+        return len(self.sentence_ids)
+
+    def __iter__(self):
+        for position in range(len(self.sentence_ids)):
+            yield SentenceView(self, position)
+
+    def __getitem__(self, item):
+        # a view of the sentence at a position, or a corpus of the sentences in a slice of positions
+        if isinstance(item, slice):
+            return self.take(np.arange(len(self.sentence_ids))[item])
+        return SentenceView(self, item)
+
+    @property
+    def index(self):
+        return self.sentence_ids
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def by_id(self, sentence_id):
+        # the view of the sentence with the given id
+        if self._positions_by_id is None:
+            self._positions_by_id = {int(sentence_id): position for position, sentence_id in enumerate(self.sentence_ids)}
+        return SentenceView(self, self._positions_by_id[int(sentence_id)])
+
+    def take(self, positions):
+        # a corpus of the sentences at the given positions, in that order, sharing the vocabulary
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+
+        offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        token_positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+        return NerCorpus(self.sentence_ids[positions], offsets, self.word_ids[token_positions], self.tag_ids[token_positions], self.vocabulary, self.tag_names)
+
+    def sample(self, n, random_state=None):
+        # the same sentences DataFrame.sample(n=n, random_state=random_state) picks from the equivalent DataFrame
+        if random_state is None:
+            random_state = np.random.mtrand._rand
+        elif not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+
+        return self.take(random_state.choice(len(self.sentence_ids), size=n, replace=False))
+
+    def drop(self, labels):
+        # the sentences left after removing those with the given ids, in their original order
+        return self.take(np.flatnonzero(~np.isin(self.sentence_ids, np.asarray(labels, dtype=np.int64))))
+
+    def to_dataframe(self):
+        # the corpus in the layout load_ner_data used to return
+        return pd.DataFrame(
+            {"sentence_id": self.sentence_ids, "words": [sentence.words for sentence in self], "tags": [sentence.tags for sentence in self]},
+            index=pd.Index(self.sentence_ids),
+        )
+
+class StringTable:
+    # a read-only list of strings stored as one UTF-8 buffer with offsets, decoded on access
+
+    def __init__(self, offsets, buffer):
+        self.offsets = offsets
+        self.buffer = buffer
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        return self.buffer[self.offsets[position]:self.offsets[position + 1]].tobytes().decode('utf-8')
+
+# Binary corpus cache layout: the magic bytes, the header length, a JSON header and then every array,
+# each aligned so that it can be used straight from the memory map
+CACHE_MAGIC = b"NERCORP1"
+CACHE_ALIGNMENT = 64
+
+def _file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def save_corpus_cache(corpus, cache_path, source_path):
+    # writes the corpus's arrays to cache_path, recording the size, modification time and content
+    # hash of the file it was parsed from
+    vocabulary = [corpus.vocabulary[word_id] for word_id in range(len(corpus.vocabulary))]
+    encoded_words = [word.encode('utf-8') for word in vocabulary]
+    vocabulary_offsets = np.zeros(len(encoded_words) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded_words], out=vocabulary_offsets[1:])
+
+    arrays = {
+        'sentence_ids': corpus.sentence_ids,
+        'offsets': corpus.offsets,
+        'word_ids': corpus.word_ids,
+        'tag_ids': corpus.tag_ids,
+        'vocabulary_offsets': vocabulary_offsets,
+        'vocabulary_bytes': np.frombuffer(b"".join(encoded_words), dtype=np.uint8),
+    }
+
+    source = os.stat(source_path)
+    header = {
+        'source_size': source.st_size,
+        'source_mtime_ns': source.st_mtime_ns,
+        'source_sha256': _file_sha256(source_path),
+        'tag_names': list(corpus.tag_names),
+        'arrays': {},
+    }
+
+    # lay the arrays out after the header, each on an aligned offset relative to the data section
+    position = 0
+    for name, array in arrays.items():
+        position = -(-position // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+        position += array.nbytes
+
+    def write_arrays(cache_file):
+        data_start = cache_file.tell()
+        for name, array in arrays.items():
+            cache_file.write(b"\0" * (data_start + header['arrays'][name]['offset'] - cache_file.tell()))
+            cache_file.write(np.ascontiguousarray(array).tobytes())
+
+    _replace_cache_file(cache_path, header, write_arrays)
+
+def _replace_cache_file(cache_path, header, write_data):
+    # writes the header and then the data section, at the first aligned offset after the header, with
+    # write_data. The file is written under a temporary name of this process's own and moved into
+    # place, so a crash never leaves a partial cache and concurrent writers never share a file
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(CACHE_MAGIC) + 8 + len(header_bytes)) // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+
+    temporary_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'wb') as cache_file:
+        cache_file.write(CACHE_MAGIC)
+        cache_file.write(struct.pack('<Q', len(header_bytes)))
+        cache_file.write(header_bytes)
+        cache_file.write(b"\0" * (data_start - cache_file.tell()))
+        write_data(cache_file)
+    os.replace(temporary_path, cache_path)
+
+def load_corpus_cache(cache_path, source_path):
+    # the corpus in cache_path, memory mapped so the arrays are used without copying, or None if
+    # there is no cache or it was not built from the current source file. A cache whose recorded
+    # size and modification time match is used as is; if only the modification time differs (after a
+    # copy or a fresh checkout) the source's content hash decides, and a cache that still matches is
+    # rewritten with the new modification time so that the hash is not worked out again on every load
+    if not os.path.exists(cache_path):
+        return None
+
+    with open(cache_path, 'rb') as cache_file:
+        if cache_file.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        buffer = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_length = struct.unpack_from('<Q', buffer, len(CACHE_MAGIC))[0]
+    header_start = len(CACHE_MAGIC) + 8
+    header = json.loads(buffer[header_start:header_start + header_length])
+
+    source = os.stat(source_path)
+    if header['source_size'] != source.st_size:
+        return None
+    data_start = -(-(header_start + header_length) // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+    if header['source_mtime_ns'] != source.st_mtime_ns:
+        if header['source_sha256'] != _file_sha256(source_path):
+            return None
+
+        # the data section is copied over unchanged behind the new header. The arrays below stay
+        # mapped from the old file, which lives on until they are released. A cache that cannot be
+        # rewritten (e.g. on a read-only filesystem) is still used
+        header['source_mtime_ns'] = source.st_mtime_ns
+        try:
+            _replace_cache_file(cache_path, header, lambda cache_file: cache_file.write(memoryview(buffer)[data_start:]))
+        except OSError:
+            pass
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = np.dtype(layout['dtype'])
+        count = int(np.prod(layout['shape']))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + layout['offset']).reshape(layout['shape'])
+
+    return NerCorpus(
+        arrays['sentence_ids'],
+        arrays['offsets'],
+        arrays['word_ids'],
+        arrays['tag_ids'],
+        StringTable(arrays['vocabulary_offsets'], arrays['vocabulary_bytes']),
+        header['tag_names'],
+    )
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-lean CPU inference for batch nodes without a GPU. Llama-2-7b in full precision takes about
+28 GB of RAM and is slow to load, so the model's safetensors shards are memory mapped and loaded
+straight into bfloat16, and the weights are only materialised once, with accelerate installed.
+With 'int8', every linear layer is then swapped one at a time for a dynamically quantized int8
+linear layer, which holds int8 weights and quantizes its activations on the fly, so only one layer
+is ever in float32 while converting. The remaining weights (embeddings and norms) go back to float32
+for the quantized layers. 'bfloat16' keeps the bfloat16 weights and 'float32' loads them as the
+scripts always have.
+
+The process is pinned to a fixed set of cores with one torch thread per core, so that runs are
+repeatable and several workers on one node do not compete for the same cores.
+
+Running this file directly loads the model in full precision and in the chosen precision, each in
+its own process, and reports the load time, resident memory, generated tokens per second and
+F1-score of each on a sample of a test file, with the F1-score's change checked against a tolerance.
+It exits with 0 if the check passed and 1 if it failed. Without a model and test file, it uses the
+tiny model and synthetic English data of ner_benchmark, whose random tags make the F1-scores
+meaningless, so the check is reported as not applicable and it exits with 2.
+
+Usage: python ner_cpu_inference.py [--model-name NAME --test-file en_test.conll --language English] [--precision int8]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from ner_instrumentation import GENERATION_STAGES, StageTracer, logger, peak_memory
+
+try:
+    import accelerate
+except ImportError:
+    accelerate = None
+
+# Precisions a CPU model can be loaded in, and the dtype its weights are read in
+CPU_PRECISIONS = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'int8': torch.bfloat16}
+
+def configure_cpu_threads(threads=None, worker_index=0, num_workers=1):
+    # pins this process to `threads` of the cores it may run on, the worker_index-th group of them
+    # when num_workers workers share a node, and gives torch one intra-op thread per core. By default
+    # the cores are split evenly between the workers. Returns the cores, or None where the platform
+    # cannot pin processes
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+    core_count = len(available) if available else os.cpu_count()
+    threads = threads or max(1, core_count // num_workers)
+    if threads * num_workers > core_count:
+        logger.warning("%d workers with %d threads each oversubscribe the %d cores available, so they will compete for cores", num_workers, threads, core_count)
+
+    cores = None
+    if available:
+        start = (worker_index * threads) % len(available)
+        cores = (available[start:] + available[:start])[:threads]
+        os.sched_setaffinity(0, cores)
+
+    torch.set_num_threads(threads)
+    try:
+        # only settable before the first inter-op parallel work
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    return cores
+
+def resident_memory():
+    # the current resident set size of this process in bytes, or its peak where /proc is missing
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_memory()[0]
+
+def quantize_linear_layers(model):
+    # swaps every linear layer for a dynamically quantized int8 one, one layer at a time, so that
+    # only a single layer is converted to float32 at once. Everything left is then made float32,
+    # which the quantized layers take as input
+    qconfig = torch.ao.quantization.default_dynamic_qconfig
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, torch.nn.Linear):
+                child = child.float()
+                child.qconfig = qconfig
+                setattr(module, name, torch.ao.nn.quantized.dynamic.Linear.from_float(child))
+
+    return model.float()
+
+def load_cpu_model(model_name, token=None, precision='int8'):
+    # the model for CPU inference, read from memory mapped safetensors in the precision's dtype,
+    # with its linear layers quantized to int8 for 'int8'
+    if precision not in CPU_PRECISIONS:
+        raise ValueError(f"Unknown CPU precision {precision!r}, expected one of {list(CPU_PRECISIONS)}")
+
+    model = AutoModelForCausalLM.from_pretrained(model_name, token=token, torch_dtype=CPU_PRECISIONS[precision], use_safetensors=True, low_cpu_mem_usage=accelerate is not None)
+    if precision == 'int8':
+        model = quantize_linear_layers(model)
+
+    return model.eval()
+
+def cache_model_name(model_name, precision):
+    # the model name responses are cached under. Reduced precision changes the responses, so they
+    # are kept apart from the full precision ones
+    return model_name if precision in (None, 'float32') else f"{model_name} ({precision})"
+
+def run_precision(model_name, token, precision, test_file_path, language, few_shot_size, sample_size, batch_size, threads, work_path):
+    # loads the model in one precision and generates a sample of the test file with it, returning the
+    # load time, memory, throughput and F1-score. Meant to be the only work of a fresh process, so
+    # that the peak memory is this precision's alone
+    import llama_ner
+
+    configure_cpu_threads(threads)
+
+    start_time = time.perf_counter()
+    tokenizer = AutoTokenizer.from_pretrained(model_name, token=token)
+    model = load_cpu_model(model_name, token=token, precision=precision)
+    load_seconds = time.perf_counter() - start_time
+    loaded_resident = resident_memory()
+    load_peak_resident = peak_memory()[0]
+
+    few_shot_data, sample_data = llama_ner.get_examples_and_sample(llama_ner.load_ner_data(test_file_path), few_shot_size, sample_size)
+    output_path = os.path.join(work_path, precision)
+    tracer = StageTracer(output_path + "_trace.jsonl")
+    try:
+        llama_ner.evaluate_for_language(model, tokenizer, language, sample_data, few_shot_data, output_path + "_predictions.txt", output_path + "_scores.json", output_path + "_decoded.txt", use_prefix_cache=True, batch_size=batch_size, tracer=tracer)
+    finally:
+        tracer.close()
+
+    generation_seconds = sum(tracer.stage_seconds.get((language, stage), 0.0) for stage in GENERATION_STAGES)
+    generated_tokens = tracer.generated_tokens.get(language, 0)
+    with open(output_path + "_scores.json", encoding='utf-8') as score_file:
+        f1_score = json.load(score_file)['F1-Score']
+
+    return {
+        'Precision': precision,
+        'Load Seconds': load_seconds,
+        'Resident Bytes After Load': loaded_resident,
+        'Peak Resident Bytes During Load': load_peak_resident,
+        'Peak Resident Bytes': peak_memory()[0],
+        'Generated Tokens': generated_tokens,
+        'Tokens Per Second': generated_tokens / generation_seconds if generation_seconds > 0 else 0.0,
+        'F1-Score': f1_score,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares CPU inference in a reduced precision against full precision")
+    parser.add_argument('--model-name', help="the model to load, the benchmark's tiny model by default")
+    parser.add_argument('--token', help="a Hugging Face token with access to the model")
+    parser.add_argument('--test-file', help="the CoNLL file to sample, synthetic English data by default")
+    parser.add_argument('--language', default="English")
+    parser.add_argument('--precision', choices=['bfloat16', 'int8'], default='int8')
+    parser.add_argument('--few-shot-size', type=int, default=10)
+    parser.add_argument('--sample-size', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--threads', type=int, help="torch threads, every core this process may use by default")
+    parser.add_argument('--max-f1-drop', type=float, default=0.02, help="the largest drop in F1-score the check allows")
+    parser.add_argument('--output', help="where to write the report as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_path:
+        model_name, test_file_path = args.model_name, args.test_file
+        benchmark_data = model_name is None or test_file_path is None
+        if benchmark_data:
+            from ner_benchmark import build_benchmark
+            benchmark_model_path = build_benchmark(work_path, args.sample_size, args.few_shot_size, seed=16)
+            model_name = model_name or benchmark_model_path
+            test_file_path = test_file_path or os.path.join(work_path, "en_test.conll")
+
+        # Each precision is loaded in a fresh process, so that neither sees the other's memory
+        report = {}
+        context = multiprocessing.get_context('spawn')
+        for precision in ('float32', args.precision):
+            with context.Pool(processes=1) as pool:
+                report[precision] = pool.apply(run_precision, (model_name, args.token, precision, test_file_path, args.language, args.few_shot_size, args.sample_size, args.batch_size, args.threads, work_path))
+            print("CPU INFERENCE REPORT: ", report[precision])
+
+    full, reduced = report['float32'], report[args.precision]
+    report['Comparison'] = {
+        'Load Time Ratio': reduced['Load Seconds'] / full['Load Seconds'],
+        'Resident Memory Ratio': reduced['Resident Bytes After Load'] / full['Resident Bytes After Load'],
+        'Tokens Per Second Ratio': reduced['Tokens Per Second'] / full['Tokens Per Second'] if full['Tokens Per Second'] > 0 else None,
+        'F1-Score Delta': reduced['F1-Score'] - full['F1-Score'],
+    }
+    print("CPU INFERENCE COMPARISON: ", report['Comparison'])
+
+    # The tiny model's tags are random, so its F1-scores say nothing about the precision
+    if benchmark_data:
+        report['F1 Delta Check'] = {'Status': 'not applicable', 'Reason': "the benchmark's tiny model or synthetic data was used, pass --model-name and --test-file"}
+        exit_status = 2
+    else:
+        f1_check_passed = report['Comparison']['F1-Score Delta'] >= -args.max_f1_drop
+        report['F1 Delta Check'] = {'Status': 'passed' if f1_check_passed else 'failed', 'Reason': f"{report['Comparison']['F1-Score Delta']:+.4f} against a largest allowed drop of {args.max_f1_drop}"}
+        exit_status = 0 if f1_check_passed else 1
+    print(f"F1 DELTA CHECK: {report['F1 Delta Check']['Status']}, {report['F1 Delta Check']['Reason']}")
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(json.dumps(report, indent=4))
+
+    sys.exit(exit_status)
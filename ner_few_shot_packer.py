@@ -0,0 +1,87 @@
+"""
+A token budget for few shot prompts. Scripts that represent tokens in many pieces, such as Bangla
+and Hindi, can push a 10 shot prompt close to Llama-2's 4096 token context and leave little room to
+generate. The packer knows the token length of every prompt segment from the PromptEncoder, where
+each example is only ever encoded once, and keeps as many of a prompt's few shot examples as fit the
+budget together with the test sentence the prompt is for and the most tokens its response may take. Each sentence is packed on its own, so a
+sentence gets the same prompt whether it is run alone, in a shard or after resuming. Examples are
+always dropped from the end, so the prompts that keep them still share their leading examples. With the 'fail'
+overflow policy, a prompt that would need trimming raises instead. A prompt that cannot fit the
+budget even without any examples always raises. The prompt lengths of each language are reported as
+a distribution.
+"""
+
+import numpy as np
+
+OVERFLOW_POLICIES = ('trim', 'fail')
+
+class FewShotPacker:
+
+    def __init__(self, prompt_encoder, token_budget, overflow='trim'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+
+        self.prompt_encoder = prompt_encoder
+        self.token_budget = token_budget
+        self.overflow = overflow
+
+        self.prompts_packed = 0
+        self.prompts_trimmed = 0
+        self.examples_dropped = 0
+
+    def pack(self, segments, num_examples, suffix, response_tokens=0):
+        # the prompt segments with as many leading examples kept as fit the budget together with the
+        # sentence's suffix and the response_tokens left free to generate into. The examples are the
+        # num_examples segments before the closing instruction, as create_ner_prompt_segments lays
+        # them out
+        lengths = self.prompt_encoder.segment_lengths(segments)
+        suffix_length = self.prompt_encoder.continuation_lengths([suffix])[0]
+        example_start = len(segments) - 1 - num_examples
+
+        prompt_length = sum(lengths) - sum(lengths[example_start:-1]) + suffix_length + response_tokens
+        if prompt_length > self.token_budget:
+            raise ValueError(f"The prompt and its {response_tokens} response tokens take {prompt_length} tokens without any few shot examples, over the budget of {self.token_budget} tokens")
+
+        kept = 0
+        for length in lengths[example_start:-1]:
+            if prompt_length + length > self.token_budget:
+                break
+            prompt_length += length
+            kept += 1
+
+        self.prompts_packed += 1
+        if kept < num_examples:
+            if self.overflow == 'fail':
+                raise ValueError(f"Only {kept} of {num_examples} few shot examples fit the budget of {self.token_budget} tokens")
+            self.prompts_trimmed += 1
+            self.examples_dropped += num_examples - kept
+
+        return segments[:example_start + kept] + segments[-1:]
+
+    def stats(self):
+        return {
+            'Token Budget': self.token_budget,
+            'Prompts Packed': self.prompts_packed,
+            'Prompts Trimmed': self.prompts_trimmed,
+            'Examples Dropped': self.examples_dropped,
+        }
+
+def prompt_length_report(encoded_prompts, token_budget=None):
+    # the distribution of the prompt lengths in tokens, and how many prompts are over the budget
+    lengths = np.array([len(prompt_ids) for prompt_ids in encoded_prompts])
+    if len(lengths) == 0:
+        return {'Prompts': 0}
+
+    report = {
+        'Prompts': len(lengths),
+        'Min Prompt Tokens': int(lengths.min()),
+        'Mean Prompt Tokens': float(lengths.mean()),
+        'Median Prompt Tokens': float(np.percentile(lengths, 50)),
+        'P90 Prompt Tokens': float(np.percentile(lengths, 90)),
+        'P99 Prompt Tokens': float(np.percentile(lengths, 99)),
+        'Max Prompt Tokens': int(lengths.max()),
+    }
+    if token_budget is not None:
+        report['Prompts Over Budget'] = int((lengths > token_budget).sum())
+
+    return report
@@ -0,0 +1,112 @@
+"""
+Retrieval of the few shot examples most similar to each test sentence, as an alternative to sampling
+them. The few shot pool is indexed once as a sparse TF-IDF matrix over hashed character n-grams of
+its words. The n-grams are worked out once per distinct word of the corpus's interned vocabulary
+rather than once per token, and a sentence's row is the sum of its words' rows, built with a single
+sparse product. The top k examples of every test sentence are then retrieved up front from one
+batched matrix product against the pool, so picking a sentence's examples at run time is a lookup.
+"""
+
+import zlib
+
+import numpy as np
+from scipy import sparse
+
+# Character n-gram sizes, taken within each word padded with a space on either side, and the number
+# of hashed feature columns
+NGRAM_SIZES = (2, 3, 4)
+NUM_FEATURES = 2 ** 20
+
+# Test sentences scored against the pool at once, bounding the dense score block to this many rows
+QUERY_CHUNK_SIZE = 64
+
+def word_ngram_features(word):
+    # the hashed feature column of every character n-gram of a word. crc32 is used rather than hash(),
+    # which is salted per process, so the columns are the same in every run
+    padded = f" {word.lower()} "
+    return [
+        zlib.crc32(padded[start:start + size].encode('utf-8')) % NUM_FEATURES
+        for size in NGRAM_SIZES
+        for start in range(max(len(padded) - size + 1, 1))
+    ]
+
+def ngram_counts(corpus):
+    # the sentences x features matrix of n-gram counts of a NerCorpus. Only the distinct words the
+    # corpus uses are broken into n-grams, and each sentence's words are then summed in one product
+    used_word_ids, token_columns = np.unique(corpus.word_ids, return_inverse=True)
+
+    rows = []
+    columns = []
+    for row, word_id in enumerate(used_word_ids):
+        features = word_ngram_features(corpus.vocabulary[int(word_id)])
+        rows.extend([row] * len(features))
+        columns.extend(features)
+    word_features = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(len(used_word_ids), NUM_FEATURES))
+
+    sentence_words = sparse.csr_matrix(
+        (np.ones(len(token_columns), dtype=np.float32), token_columns.reshape(-1), corpus.offsets),
+        shape=(len(corpus), len(used_word_ids)),
+    )
+
+    return (sentence_words @ word_features).tocsr()
+
+def normalize_rows(matrix):
+    # scales every row to unit length, leaving empty rows empty
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).reshape(-1))
+    norms[norms == 0] = 1.0
+
+    return sparse.diags(1.0 / norms) @ matrix
+
+class FewShotIndex:
+
+    def __init__(self, few_shot_dataset):
+        self.few_shot_dataset = few_shot_dataset
+
+        # sublinear term frequencies, weighted by the smoothed inverse document frequency of the pool
+        counts = ngram_counts(few_shot_dataset)
+        document_frequency = np.bincount(counts.indices, minlength=NUM_FEATURES)
+        self.idf = (np.log((1 + len(few_shot_dataset)) / (1 + document_frequency)) + 1).astype(np.float32)
+        self.matrix = self._weigh(counts)
+
+        self.queries = 0
+        self.top_similarity = 0.0
+        self.last_similarity = 0.0
+
+    def _weigh(self, counts):
+        # the L2 normalized TF-IDF rows of a count matrix
+        counts = counts.copy()
+        counts.data = 1 + np.log(counts.data)
+
+        return normalize_rows(counts @ sparse.diags(self.idf)).tocsr()
+
+    def top_k(self, dataset, k):
+        # the positions in the pool of the k examples most similar to each sentence of the dataset, most
+        # similar first, as a len(dataset) x k array. Ties go to the earlier example in the pool
+        k = min(k, len(self.few_shot_dataset))
+        queries = self._weigh(ngram_counts(dataset))
+        neighbours = np.zeros((len(dataset), k), dtype=np.int64)
+
+        for start in range(0, len(dataset), QUERY_CHUNK_SIZE):
+            scores = (queries[start:start + QUERY_CHUNK_SIZE] @ self.matrix.T).toarray()
+            kth_scores = np.partition(scores, scores.shape[1] - k, axis=1)[:, scores.shape[1] - k]
+
+            for offset, (row, kth_score) in enumerate(zip(scores, kth_scores)):
+                # every example scoring at least the k-th best score, ordered by score and then position
+                candidates = np.flatnonzero(row >= kth_score)
+                chosen = candidates[np.lexsort((candidates, -row[candidates]))][:k]
+                neighbours[start + offset] = chosen
+
+                self.queries += 1
+                self.top_similarity += float(row[chosen[0]])
+                self.last_similarity += float(row[chosen[-1]])
+
+        return neighbours
+
+    def stats(self):
+        return {
+            'Pool Size': len(self.few_shot_dataset),
+            'Pool Features': self.matrix.nnz,
+            'Queries': self.queries,
+            'Mean Top Similarity': self.top_similarity / self.queries if self.queries else 0.0,
+            'Mean Last Similarity': self.last_similarity / self.queries if self.queries else 0.0,
+        }
@@ -0,0 +1,244 @@
+"""
+Shared generation helpers for the llama_ner python scripts. The few shot prompt built by
+create_ner_prompt is identical for every test sentence of a language, so its key/value cache can be
+computed once and reused, leaving only the short per-sentence suffix to be prefilled. Test sentences
+can also be generated in left padded batches of similar length instead of one at a time, and each
+generated sequence is stopped as soon as it holds a full tag sequence for its sentence, optionally
+constrained to the tag grammar in ner_constrained.
+"""
+
+import torch
+import transformers
+from packaging import version
+from transformers import LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from ner_constrained import BIOConstrainedLogitsProcessor
+
+# Upper bound on the tokens one tag takes, e.g. " I-AerospaceManufacturer", plus room for the terminator
+MAX_TOKENS_PER_TAG = 12
+TERMINATOR_TOKENS = 8
+
+# Upper bound on the tokens of the "Sequence of BIO Tags 2:" style label before each sequence of a packed response
+PACKED_LABEL_TOKENS = 16
+
+# transformers 4.39 moved stopping criteria from one flag for the whole batch to one flag per row
+PER_ROW_STOPPING = version.parse(transformers.__version__) >= version.parse("4.39.0")
+
+def build_prefix_cache(model, tokenizer, prompt_template):
+    # runs the fixed few shot prefix through the model once and keeps its token ids alongside the
+    # resulting past_key_values so later calls can check how much of their prompt they share with it
+    prefix_ids = tokenizer.encode(prompt_template, return_tensors='pt').to(model.device)
+
+    with torch.no_grad():
+        outputs = model(prefix_ids, use_cache=True)
+
+    return prefix_ids[0].tolist(), outputs.past_key_values
+
+def slice_past_key_values(past_key_values, length, batch_size=1):
+    # returns a fresh cache holding only the first `length` positions, repeated `batch_size` times.
+    # The slices are views, and generate concatenates onto them instead of writing in place, so the
+    # cached prefix is untouched
+    is_cache_object = hasattr(past_key_values, 'to_legacy_cache')
+    legacy_cache = past_key_values.to_legacy_cache() if is_cache_object else past_key_values
+    sliced_cache = tuple(
+        (key[:, :, :length].expand(batch_size, -1, -1, -1), value[:, :, :length].expand(batch_size, -1, -1, -1))
+        for key, value in legacy_cache
+    )
+
+    if is_cache_object:
+        return type(past_key_values).from_legacy_cache(sliced_cache)
+    return sliced_cache
+
+def shared_prefix_length(prefix_ids, input_ids):
+    # number of leading tokens the encoded prompt has in common with the cached prefix; at least one
+    # prompt token is always left over since generate needs something to prefill
+    limit = min(len(prefix_ids), len(input_ids) - 1)
+    length = 0
+    while length < limit and prefix_ids[length] == input_ids[length]:
+        length += 1
+
+    return length
+
+def generate_with_prefix_cache(model, inputs, prefix_cache, **generate_kwargs):
+    # generates for a single encoded prompt, only prefilling the tokens after the cached prefix. The
+    # sentencepiece tokenizer can merge across the prefix/suffix boundary, so the cache is cut back to
+    # the tokens the full prompt actually shares with it rather than assumed to match exactly
+    prefix_ids, past_key_values = prefix_cache
+    cached_length = shared_prefix_length(prefix_ids, inputs[0].tolist())
+
+    if cached_length == 0:
+        return model.generate(inputs, **generate_kwargs)
+
+    attention_mask = torch.ones_like(inputs)
+    past_key_values = slice_past_key_values(past_key_values, cached_length)
+
+    return model.generate(inputs, attention_mask=attention_mask, past_key_values=past_key_values, **generate_kwargs)
+
+def bucket_by_length(lengths, batch_size):
+    # groups item positions into batches of similar token length so that little of each batch is
+    # padding. Each batch is a list of positions into `lengths`, letting callers map outputs back
+    order = sorted(range(len(lengths)), key=lambda position: lengths[position])
+
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+def generate_batch(model, tokenizer, encoded_prompts, prefix_cache=None, **generate_kwargs):
+    # generates for a batch of already encoded prompts. Prompts are left padded to a common length
+    # with a matching attention mask. With a prefix cache, the shared prefix stays at the front of
+    # every row and only the per-sentence suffixes are padded, so the cache can be reused batch-wide
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    cached_length = 0
+    if prefix_cache is not None:
+        prefix_ids, past_key_values = prefix_cache
+        cached_length = min(shared_prefix_length(prefix_ids, prompt_ids) for prompt_ids in encoded_prompts)
+
+    suffixes = [prompt_ids[cached_length:] for prompt_ids in encoded_prompts]
+    suffix_width = max(len(suffix) for suffix in suffixes)
+
+    input_ids = []
+    attention_mask = []
+    for prompt_ids, suffix in zip(encoded_prompts, suffixes):
+        padding = suffix_width - len(suffix)
+        input_ids.append(prompt_ids[:cached_length] + [pad_token_id] * padding + suffix)
+        attention_mask.append([1] * cached_length + [0] * padding + [1] * len(suffix))
+
+    input_ids = torch.tensor(input_ids, device=model.device)
+    attention_mask = torch.tensor(attention_mask, device=model.device)
+
+    if cached_length > 0:
+        generate_kwargs['past_key_values'] = slice_past_key_values(past_key_values, cached_length, len(encoded_prompts))
+
+    return model.generate(input_ids, attention_mask=attention_mask, pad_token_id=pad_token_id, **generate_kwargs)
+
+class ResponseScanner:
+    # follows one generated sequence token by token, counting the terminators and whitespace separated
+    # words of its decoded text without decoding the whole sequence again at every step. Only the
+    # tokens since the last complete piece of text are decoded, together with the token before them,
+    # so that a sentencepiece tokenizer's leading space is kept and a character split over several
+    # byte tokens is only counted once it is complete
+
+    def __init__(self, tokenizer, terminator="#####"):
+        self.tokenizer = tokenizer
+        self.terminator = terminator
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ""
+        self.search_offset = 0
+        self.terminators = 0
+        self.words = 0
+        self.in_word = False
+
+    def extend(self, token_ids):
+        for token_id in token_ids:
+            self.token_ids.append(token_id)
+            prefix_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+            new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:], skip_special_tokens=True)
+            if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+                continue
+
+            added_text = new_text[len(prefix_text):]
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            self.text += added_text
+
+            # terminators are counted without overlaps, as str.count does, so the search resumes
+            # after the last one found, or where one could still be completed by the new text
+            while True:
+                position = self.text.find(self.terminator, self.search_offset)
+                if position == -1:
+                    break
+                self.terminators += 1
+                self.search_offset = position + len(self.terminator)
+            self.search_offset = max(self.search_offset, len(self.text) - len(self.terminator) + 1)
+
+            for character in added_text:
+                if character.isspace():
+                    self.in_word = False
+                elif not self.in_word:
+                    self.words += 1
+                    self.in_word = True
+
+    def is_complete(self, word_count):
+        # whether the text holds the terminator, or more words than the sentence (the extra item
+        # shows that the last tag is complete, and clean_and_align_predicted_tags would truncate
+        # anything past the word count anyway)
+        return self.terminators > 0 or self.words > word_count
+
+class TagSequenceStoppingCriteria(StoppingCriteria):
+    # stops a generated sequence once it contains the terminator, or once it holds more whitespace
+    # separated items than its sentence has words. Each row keeps a scanner that is only given the
+    # row's new tokens, and a finished row stays finished
+
+    def __init__(self, tokenizer, prompt_length, word_counts, terminator="#####"):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.word_counts = word_counts
+        self.terminator = terminator
+        self.scanners = [ResponseScanner(tokenizer, terminator) for _ in word_counts]
+        self.is_done = [False] * len(word_counts)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for row, (scanner, word_count) in enumerate(zip(self.scanners, self.word_counts)):
+            if not self.is_done[row]:
+                scanner.extend(input_ids[row, self.prompt_length + len(scanner.token_ids):].tolist())
+                self.is_done[row] = scanner.is_complete(word_count)
+
+        if PER_ROW_STOPPING:
+            return torch.tensor(self.is_done, dtype=torch.bool, device=input_ids.device)
+        return all(self.is_done)
+
+class PackedSequenceStoppingCriteria(StoppingCriteria):
+    # stops a packed response, holding the tag sequences of several sentences, once it contains a
+    # terminator for every sentence of its prompt, scanning each row's new tokens only
+
+    def __init__(self, tokenizer, prompt_length, sentence_counts, terminator="#####"):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.sentence_counts = sentence_counts
+        self.terminator = terminator
+        self.scanners = [ResponseScanner(tokenizer, terminator) for _ in sentence_counts]
+        self.is_done = [False] * len(sentence_counts)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for row, (scanner, sentence_count) in enumerate(zip(self.scanners, self.sentence_counts)):
+            if not self.is_done[row]:
+                scanner.extend(input_ids[row, self.prompt_length + len(scanner.token_ids):].tolist())
+                self.is_done[row] = scanner.terminators >= sentence_count
+
+        if PER_ROW_STOPPING:
+            return torch.tensor(self.is_done, dtype=torch.bool, device=input_ids.device)
+        return all(self.is_done)
+
+def max_response_tokens(word_count):
+    # the new token budget of one sentence's tag sequence and terminator
+    return word_count * MAX_TOKENS_PER_TAG + TERMINATOR_TOKENS
+
+def max_packed_response_tokens(word_counts):
+    # the new token budget of a packed response, covering every sentence's tags, terminator and numbered label
+    return sum(max_response_tokens(word_count) + PACKED_LABEL_TOKENS for word_count in word_counts)
+
+def packed_generation_kwargs(tokenizer, prompt_length, word_counts, terminator="#####"):
+    # generate arguments for packed prompts, given the word counts of the sentences in each prompt.
+    # Each response stops once it holds a terminated sequence per sentence, with a new token budget
+    # covering every sentence's tags, terminator and numbered label
+    return {
+        'max_new_tokens': max(max_packed_response_tokens(pack_word_counts) for pack_word_counts in word_counts),
+        'stopping_criteria': StoppingCriteriaList([PackedSequenceStoppingCriteria(tokenizer, prompt_length, [len(pack_word_counts) for pack_word_counts in word_counts], terminator)]),
+    }
+
+def tag_generation_kwargs(tokenizer, prompt_length, word_counts, terminator="#####", tag_grammar=None):
+    # generate arguments that stop each sequence at the terminator or once it holds a tag per word,
+    # with a new token budget sized to the longest sentence instead of a fixed total length. With a
+    # tag grammar, decoding is instead constrained to valid BIO tag sequences, which force the
+    # terminator and then the end of sequence token after the last tag
+    if tag_grammar is not None:
+        return {
+            'max_new_tokens': max(word_counts) * tag_grammar.max_tag_length + len(tag_grammar.terminator_ids) + 1,
+            'logits_processor': LogitsProcessorList([BIOConstrainedLogitsProcessor(tag_grammar, prompt_length, word_counts)]),
+        }
+
+    return {
+        'max_new_tokens': max_response_tokens(max(word_counts)),
+        'stopping_criteria': StoppingCriteriaList([TagSequenceStoppingCriteria(tokenizer, prompt_length, word_counts, terminator)]),
+    }
@@ -0,0 +1,197 @@
+"""
+Per-stage instrumentation of a run. The tracer times the stages of each language (loading the data,
+building and tokenizing the prompts, prefill, decode, detokenization, parsing and file writes) and
+records every sentence's latency, prompt and generated token counts and tokens per second. Each
+stage call and each sentence is one line of a JSONL trace, written by a background AsyncFileWriter
+so tracing stays off the decode loop. Each language's totals, latency quantiles, tokens per second
+and the peak resident and accelerator memory are written as a Prometheus text or CSV summary.
+
+Per-sentence output, such as each decoded response, goes through the 'llama_ner' logger at the DEBUG
+level instead of being printed, so large runs do not spend their time writing to stdout.
+"""
+
+import csv
+import io
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+from ner_writer import AsyncFileWriter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger('llama_ner')
+
+# Summary formats and the file extension of each
+METRICS_FORMATS = {'prometheus': '.prom', 'csv': '.csv'}
+
+# Stages whose time is spent generating, for the tokens per second of a whole language
+GENERATION_STAGES = ('prefill', 'decode', 'generate')
+
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+
+def peak_memory():
+    # the peak resident set size of this process and the peak memory allocated on the accelerator,
+    # in bytes. ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = 0
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    peak_accelerator = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0
+
+    return peak_rss, peak_accelerator
+
+def trace_stage(tracer, stage, **fields):
+    # times a with block as one call of the stage, or does nothing without a tracer
+    return tracer.stage(stage, **fields) if tracer is not None else nullcontext()
+
+class TimingStreamer(BaseStreamer):
+    # passed to model.generate as its streamer to split the time spent in prefill from the decode
+    # steps. generate puts the prompt first, and the first new tokens once the prefill is done
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.end_time = None
+        self.puts = 0
+
+    def put(self, value):
+        self.puts += 1
+        if self.puts == 2:
+            self.first_token_time = time.perf_counter()
+
+    def end(self):
+        self.end_time = time.perf_counter()
+        if self.first_token_time is None:
+            self.first_token_time = self.end_time
+
+    def prefill_seconds(self):
+        return self.first_token_time - self.start_time
+
+    def decode_seconds(self):
+        return self.end_time - self.first_token_time
+
+class StageTracer:
+
+    def __init__(self, trace_filepath, metrics_format='prometheus'):
+        if metrics_format not in METRICS_FORMATS:
+            raise ValueError(f"Unknown metrics format {metrics_format!r}, expected one of {list(METRICS_FORMATS)}")
+
+        self.writer = AsyncFileWriter(trace_filepath, mode='a')
+        self.metrics_format = metrics_format
+        self.language = None
+
+        # totals per (language, stage), and the sentence records per language
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.latencies = {}
+        self.prompt_tokens = {}
+        self.generated_tokens = {}
+
+    def _trace(self, record):
+        self.writer.write(json.dumps({'time': time.time(), 'language': self.language, **record}) + "\n")
+
+    def begin_language(self, language):
+        # the language the following stages and sentences are recorded against
+        self.language = language
+
+    def add_stage(self, stage, seconds, **fields):
+        key = (self.language, stage)
+        self.stage_seconds[key] = self.stage_seconds.get(key, 0.0) + seconds
+        self.stage_calls[key] = self.stage_calls.get(key, 0) + 1
+        self._trace({'event': 'stage', 'stage': stage, 'seconds': seconds, **fields})
+
+    @contextmanager
+    def stage(self, stage, **fields):
+        # times the body of a with block as one call of the stage
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(stage, time.perf_counter() - start_time, **fields)
+
+    def sentence(self, sentence_id, latency, prompt_tokens, generated_tokens=None, **fields):
+        # one sentence's latency from the start of its generation and its token counts. The generated
+        # tokens are None where a backend does not report them
+        self.latencies.setdefault(self.language, []).append(latency)
+        self.prompt_tokens[self.language] = self.prompt_tokens.get(self.language, 0) + prompt_tokens
+        self.generated_tokens[self.language] = self.generated_tokens.get(self.language, 0) + (generated_tokens or 0)
+
+        self._trace({
+            'event': 'sentence',
+            'sentence_id': int(sentence_id),
+            'latency_seconds': latency,
+            'prompt_tokens': prompt_tokens,
+            'generated_tokens': generated_tokens,
+            'tokens_per_second': generated_tokens / latency if generated_tokens is not None and latency > 0 else None,
+            **fields,
+        })
+
+    def samples(self, languages):
+        # (metric, labels, value) summary samples of the given languages
+        samples = []
+        for language in languages:
+            label = {'language': language or ""}
+            for (stage_language, stage), seconds in sorted(self.stage_seconds.items(), key=lambda item: item[0][1]):
+                if stage_language == language:
+                    samples.append(('stage_seconds_total', dict(label, stage=stage), seconds))
+                    samples.append(('stage_calls_total', dict(label, stage=stage), self.stage_calls[(stage_language, stage)]))
+
+            latencies = self.latencies.get(language, [])
+            if not latencies:
+                continue
+            generation_seconds = sum(self.stage_seconds.get((language, stage), 0.0) for stage in GENERATION_STAGES)
+            samples.append(('sentences_total', label, len(latencies)))
+            samples.append(('sentence_latency_seconds_mean', label, float(np.mean(latencies))))
+            for quantile in LATENCY_QUANTILES:
+                samples.append(('sentence_latency_seconds', dict(label, quantile=str(quantile)), float(np.quantile(latencies, quantile))))
+            samples.append(('prompt_tokens_total', label, self.prompt_tokens[language]))
+            samples.append(('generated_tokens_total', label, self.generated_tokens[language]))
+            samples.append(('generated_tokens_per_second', label, self.generated_tokens[language] / generation_seconds if generation_seconds > 0 else 0.0))
+
+        peak_rss, peak_accelerator = peak_memory()
+        samples.append(('peak_rss_bytes', {}, peak_rss))
+        samples.append(('peak_accelerator_bytes', {}, peak_accelerator))
+
+        return samples
+
+    def format_samples(self, samples):
+        # Prometheus text exposition, every metric a gauge prefixed with llama_ner_, or one CSV row per sample
+        if self.metrics_format == 'csv':
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(['metric', 'language', 'stage', 'quantile', 'value'])
+            for metric, labels, value in samples:
+                writer.writerow([metric, labels.get('language', ""), labels.get('stage', ""), labels.get('quantile', ""), value])
+            return output.getvalue()
+
+        # every sample of a metric follows its TYPE line
+        lines = []
+        for metric in dict.fromkeys(metric for metric, _, _ in samples):
+            lines.append(f"# TYPE llama_ner_{metric} gauge")
+            for sample_metric, labels, value in samples:
+                if sample_metric == metric:
+                    label_text = ",".join(f'{name}="{label_value}"' for name, label_value in labels.items())
+                    lines.append(f"llama_ner_{metric}{{{label_text}}} {value}" if label_text else f"llama_ner_{metric} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_summary(self, metrics_filepath, language=None):
+        # the summary of one language, or of every language recorded so far, including the stages
+        # recorded before any language began, such as loading the data
+        languages = [language] if language is not None else list(dict.fromkeys([stage_language for stage_language, _ in self.stage_seconds] + list(self.latencies)))
+        with open(metrics_filepath, 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(self.format_samples(self.samples(languages)))
+
+    def close(self, metrics_filepath=None):
+        if metrics_filepath is not None:
+            self.write_summary(metrics_filepath)
+        self.writer.close()
@@ -0,0 +1,95 @@
+"""
+An append-only checkpoint journal of the sentences evaluated for one language. Each generated
+response is written as one JSON line holding the sentence's row index, the raw response and its
+aligned tags, and is flushed and fsync'd before the next sentence, so a crash or a pre-empted
+instance loses at most the sentences still being generated. On restart the completed sentences are
+read back from the journal instead of being generated again.
+
+The journal's first line is a header holding a fingerprint of everything that decides the responses:
+the model and its generation settings, the prompt and its few shot examples, and the generation
+options. A journal written under any other fingerprint is discarded rather than resumed, so that
+changing the model or an option never mixes stale responses into a new run.
+"""
+
+import hashlib
+import json
+import os
+
+def settings_fingerprint(settings):
+    # a sha256 digest of a JSON-able dict of settings, independent of its key order
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def model_settings(model):
+    # what identifies an in-process model's responses: its name, its dtype and layer types (which
+    # tell a quantized model apart from the full precision one) and its generation config
+    return {
+        'Model': model.name_or_path,
+        'Dtype': model.dtype,
+        'Layer Types': sorted({f"{type(module).__module__}.{type(module).__name__}" for module in model.modules()}),
+        'Generation Config': model.generation_config.to_dict(),
+    }
+
+class SentenceJournal:
+
+    def __init__(self, path, fingerprint=None):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.entries = {}
+
+        # read back the sentences completed by an earlier run. A crash in the middle of a write can
+        # leave a torn last line, which is cut off so that new entries start on a clean line
+        valid_length = 0
+        journal_fingerprint = None
+        if os.path.exists(path):
+            with open(path, 'rb') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    if 'fingerprint' in entry:
+                        journal_fingerprint = entry['fingerprint']
+                    else:
+                        self.entries[entry['sentence_id']] = entry
+                    valid_length += len(line)
+
+            # a journal from other settings is started over. Without a fingerprint to check against,
+            # as when merging shard journals, the journal's own header is taken as it is
+            if fingerprint is not None and valid_length > 0 and journal_fingerprint != fingerprint:
+                print(f"DISCARDING JOURNAL: {path} was written with other settings, {len(self.entries)} sentences will be generated again")
+                self.entries = {}
+                valid_length = 0
+
+            if valid_length < os.path.getsize(path):
+                os.truncate(path, valid_length)
+
+        if fingerprint is None:
+            self.fingerprint = journal_fingerprint
+
+        self.file = open(path, 'a', encoding='utf-8')
+        if valid_length == 0 and self.fingerprint is not None:
+            self._write({'fingerprint': self.fingerprint})
+
+    def __contains__(self, sentence_id):
+        return sentence_id in self.entries
+
+    def record(self, sentence_id, response, tags):
+        entry = {'sentence_id': sentence_id, 'response': response, 'tags': tags}
+        self._write(entry)
+        self.entries[sentence_id] = entry
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+def remove_journal(path):
+    # a journal is only needed until its language's scores are written. Removing it then means a
+    # rerun of a finished language generates it afresh instead of resuming finished responses
+    if path is not None and os.path.exists(path):
+        os.remove(path)
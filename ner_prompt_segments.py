@@ -0,0 +1,118 @@
+"""
+Prompt assembly from pre-tokenized segments. The instruction header, the tag table and every few
+shot example of a prompt never change, so each is encoded once and its token ids are kept, and a
+full prompt is built by concatenating id lists instead of encoding thousands of characters again for
+every test sentence. The per-sentence suffixes of all test sentences are encoded up front in one
+batched call. Segments always end in a newline, and the Llama-2 tokenizer has no pieces spanning a
+newline, so a segment is encoded as if it followed one and the concatenated ids are exactly the ids
+of the whole prompt. This is checked on the first prompt, and a tokenizer that does merge across
+newlines has its prompts encoded whole instead.
+"""
+
+from ner_instrumentation import logger
+
+class PromptEncoder:
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.anchor_ids = tokenizer.encode("\n", add_special_tokens=False)
+        self.segment_ids = {}
+        self.head_ids = {}
+        self.template_ids = {}
+        self.exact = None
+
+        self.segments_encoded = 0
+        self.segment_reuses = 0
+        self.prompts_encoded = 0
+
+    def _continuations(self, texts):
+        # the ids each text gets when it follows a newline, in one batched call. The anchor newline is
+        # encoded in front of each text and its ids dropped again, as a leading space at the very start
+        # of a string is encoded differently from one in the middle of a prompt. None if the text
+        # merges into the anchor
+        encoded = self.tokenizer(["\n" + text for text in texts], add_special_tokens=False)['input_ids']
+        anchor_length = len(self.anchor_ids)
+
+        return [ids[anchor_length:] if ids[:anchor_length] == self.anchor_ids else None for ids in encoded]
+
+    def encode_segments(self, segments):
+        # the continuation ids of each segment, encoding the ones not seen before in one batched call
+        new_segments = [segment for segment in dict.fromkeys(segments) if segment not in self.segment_ids]
+        self.segment_reuses += len(segments) - len(new_segments)
+        for segment, ids in zip(new_segments, self._continuations(new_segments) if new_segments else []):
+            self.segment_ids[segment] = ids
+        self.segments_encoded += len(new_segments)
+
+        return [self.segment_ids[segment] for segment in segments]
+
+    def encode_head(self, segment):
+        # the ids of a segment at the very start of a prompt, including the beginning of sequence token
+        if segment not in self.head_ids:
+            self.head_ids[segment] = self.tokenizer.encode(segment)
+            self.segments_encoded += 1
+        else:
+            self.segment_reuses += 1
+
+        return self.head_ids[segment]
+
+    def continuation_lengths(self, segments):
+        # the number of tokens each segment takes after the start of a prompt. A segment that merges
+        # into the one before it is counted as if encoded alone
+        return [
+            len(ids) if ids is not None else len(self.tokenizer.encode(segment, add_special_tokens=False))
+            for segment, ids in zip(segments, self.encode_segments(segments))
+        ]
+
+    def segment_lengths(self, segments):
+        # the number of tokens each of a prompt's segments takes, counting the beginning of sequence
+        # token with the first
+        return [len(self.encode_head(segments[0]))] + self.continuation_lengths(segments[1:])
+
+    def encode_template(self, segments):
+        # the ids of a prompt template given as its segments, with the first encoded as the start of
+        # the prompt (including the beginning of sequence token) and the rest as continuations. Every
+        # segment and every whole template is only ever encoded once
+        key = tuple(segments)
+        if key in self.template_ids:
+            self.segment_reuses += len(segments)
+            return self.template_ids[key]
+
+        head_ids = self.encode_head(segments[0])
+        tail_ids = self.encode_segments(segments[1:])
+        template_ids = None if any(ids is None for ids in tail_ids) else head_ids + [token_id for ids in tail_ids for token_id in ids]
+        self.template_ids[key] = template_ids
+
+        return template_ids
+
+    def encode_prompts(self, templates, suffixes):
+        # the ids of every prompt, each given as its template's segments and its own suffix text
+        self.prompts_encoded += len(suffixes)
+        if not suffixes:
+            return []
+
+        if self.exact is not False:
+            suffix_ids = self.encode_segments(suffixes)
+            encoded_prompts = []
+            for segments, ids in zip(templates, suffix_ids):
+                template_ids = self.encode_template(segments)
+                if template_ids is None or ids is None:
+                    break
+                encoded_prompts.append(template_ids + ids)
+
+            # the first prompt assembled is compared against encoding it whole, once per encoder
+            if len(encoded_prompts) == len(suffixes) and self.exact is None:
+                self.exact = encoded_prompts[0] == self.tokenizer.encode("".join(templates[0]) + suffixes[0])
+            if len(encoded_prompts) == len(suffixes) and self.exact:
+                return encoded_prompts
+            self.exact = False
+            logger.warning("PROMPT SEGMENTS: the tokenizer merges tokens across segments, encoding whole prompts instead")
+
+        return self.tokenizer(["".join(segments) + suffix for segments, suffix in zip(templates, suffixes)])['input_ids']
+
+    def stats(self):
+        return {
+            'Prompts Encoded': self.prompts_encoded,
+            'Segments Encoded': self.segments_encoded,
+            'Segment Reuses': self.segment_reuses,
+            'Exact': bool(self.exact),
+        }
@@ -0,0 +1,205 @@
+"""
+A radix tree of key/value caches keyed on prompt token ids, for prompts that share long prefixes
+without being identical, such as the per-sentence few shot prompts of llama_ner_sample_every.py.
+All of them share the instruction and tag list header, and they often share leading examples too.
+Each edge of the tree holds the keys and values of its tokens. A prompt reuses the longest prefix
+already in the tree, only the remainder is run through the model, and the result is added to the
+tree. A prompt whose prefix ends below the first level gets the keys and values of the whole path
+concatenated once, and they are kept on the deepest node of the path for the next prompt that ends
+there. Once the tree holds more than its memory budget, the least recently used leaves and kept paths
+are evicted, taken from a heap ordered by when they were last used.
+"""
+
+import heapq
+import itertools
+
+import torch
+
+from ner_continuous_batching import to_legacy_cache, to_model_cache
+from ner_generation import shared_prefix_length
+
+def key_values_nbytes(key_values):
+    return sum(key.nbytes + value.nbytes for key, value in key_values)
+
+class RadixNode:
+    __slots__ = ('token_ids', 'key_values', 'path_key_values', 'children', 'parent', 'last_used', 'nbytes')
+
+    def __init__(self, token_ids, key_values, parent):
+        # the tokens on the edge into this node, and every layer's (key, value) for just those
+        # positions. path_key_values optionally holds every layer's (key, value) for the whole path
+        # from the root down to this node, kept after it was concatenated for a prompt
+        self.token_ids = token_ids
+        self.key_values = key_values
+        self.path_key_values = None
+        self.children = {}
+        self.parent = parent
+        self.last_used = 0
+        self.nbytes = key_values_nbytes(key_values)
+
+class RadixPrefixCache:
+
+    def __init__(self, model, memory_budget):
+        self.model = model
+        self.memory_budget = memory_budget
+        self.root = RadixNode([], (), None)
+        self.nbytes = 0
+        self.clock = 0
+
+        # (last_used, tie breaker, node) for every node that can give memory back, that is every
+        # leaf and every node keeping its path. Entries go stale when their node is used again or
+        # evicted, and are skipped when they come up
+        self.eviction_heap = []
+        self.counter = itertools.count()
+
+        self.lookups = 0
+        self.prompt_tokens = 0
+        self.hit_tokens = 0
+        self.max_hit_tokens = 0
+        self.evictions = 0
+
+    def _match(self, token_ids):
+        # the nodes along the longest cached prefix of token_ids, each with how many of its edge's
+        # tokens matched (only the last one can be partial), and the length of that prefix
+        path = []
+        matched = 0
+        node = self.root
+        while matched < len(token_ids):
+            child = node.children.get(token_ids[matched])
+            if child is None:
+                break
+
+            length = 0
+            limit = min(len(child.token_ids), len(token_ids) - matched)
+            while length < limit and child.token_ids[length] == token_ids[matched + length]:
+                length += 1
+
+            path.append((child, length))
+            matched += length
+            if length < len(child.token_ids):
+                break
+            node = child
+
+        return path, matched
+
+    def _split(self, node, length):
+        # splits the edge into node after its first `length` tokens, returning the new upper node.
+        # The path down to node is unchanged, so a path node keeps stays valid
+        upper = RadixNode(node.token_ids[:length], tuple((key[:, :, :length].clone(), value[:, :, :length].clone()) for key, value in node.key_values), node.parent)
+        upper.last_used = node.last_used
+        upper.parent.children[upper.token_ids[0]] = upper
+
+        self.nbytes -= node.nbytes
+        node.token_ids = node.token_ids[length:]
+        node.key_values = tuple((key[:, :, length:].clone(), value[:, :, length:].clone()) for key, value in node.key_values)
+        node.nbytes = key_values_nbytes(node.key_values)
+        node.parent = upper
+        upper.children[node.token_ids[0]] = node
+        self.nbytes += upper.nbytes + node.nbytes
+
+        return upper
+
+    def _touch(self, node):
+        # marks a node as used now, queueing it for eviction if it can give memory back
+        node.last_used = self.clock
+        if not node.children or node.path_key_values is not None:
+            heapq.heappush(self.eviction_heap, (node.last_used, next(self.counter), node))
+
+    def _path_key_values(self, nodes):
+        # every layer's (key, value) along the matched path. A first level node's own tensors are
+        # the whole path, and a deeper path is concatenated once and then kept on its deepest node
+        node = nodes[-1]
+        if len(nodes) == 1:
+            return node.key_values
+
+        if node.path_key_values is None:
+            node.path_key_values = tuple(
+                (torch.cat([path_node.key_values[layer][0] for path_node in nodes], dim=2), torch.cat([path_node.key_values[layer][1] for path_node in nodes], dim=2))
+                for layer in range(len(node.key_values))
+            )
+            self.nbytes += key_values_nbytes(node.path_key_values)
+            self._touch(node)
+
+        return node.path_key_values
+
+    def _evict(self):
+        # gives memory back, least recently used first, until the tree fits in its memory budget.
+        # A node keeping its path drops that first, and a leaf is then removed from the tree, which
+        # can leave its parent a leaf in turn
+        while self.nbytes > self.memory_budget and self.eviction_heap:
+            last_used, _, node = heapq.heappop(self.eviction_heap)
+            if node.parent is None or last_used != node.last_used:
+                continue
+
+            if node.path_key_values is not None:
+                self.nbytes -= key_values_nbytes(node.path_key_values)
+                node.path_key_values = None
+            if node.children:
+                continue
+
+            parent = node.parent
+            del parent.children[node.token_ids[0]]
+            self.nbytes -= node.nbytes
+            node.parent = None
+            node.key_values = ()
+            self.evictions += 1
+            if parent is not self.root and not parent.children:
+                heapq.heappush(self.eviction_heap, (parent.last_used, next(self.counter), parent))
+
+    def prefix(self, token_ids):
+        # the (token ids, past_key_values) of all of token_ids, as build_prefix_cache returns them,
+        # so generate_with_prefix_cache and generate_batch can use it. Only the tokens past the
+        # longest cached prefix are run through the model, and they are then added to the tree
+        token_ids = list(token_ids)
+        self.clock += 1
+        self.lookups += 1
+        self.prompt_tokens += len(token_ids)
+        if not token_ids:
+            return token_ids, None
+
+        path, matched = self._match(token_ids)
+        self.hit_tokens += matched
+        self.max_hit_tokens = max(self.max_hit_tokens, matched)
+
+        # a partly matched last edge is split so that the matched part is a node of its own
+        if path and path[-1][1] < len(path[-1][0].token_ids):
+            node, length = path[-1]
+            path[-1] = (self._split(node, length), length)
+        nodes = [node for node, _ in path]
+        for node in nodes:
+            self._touch(node)
+
+        past_key_values = self._path_key_values(nodes) if nodes else None
+
+        if matched < len(token_ids):
+            input_ids = torch.tensor([token_ids[matched:]], device=self.model.device)
+            with torch.no_grad():
+                outputs = self.model(input_ids, past_key_values=to_model_cache(past_key_values) if past_key_values is not None else None, use_cache=True)
+            past_key_values = to_legacy_cache(outputs.past_key_values)
+
+            # the new tokens hang off the matched prefix as a new leaf, holding copies of just their
+            # positions so the rest of the prompt's cache can be freed
+            parent = nodes[-1] if nodes else self.root
+            leaf = RadixNode(token_ids[matched:], tuple((key[:, :, matched:].clone(), value[:, :, matched:].clone()) for key, value in past_key_values), parent)
+            parent.children[leaf.token_ids[0]] = leaf
+            self.nbytes += leaf.nbytes
+            self._touch(leaf)
+
+        self._evict()
+
+        return token_ids, to_model_cache(past_key_values)
+
+    def stats(self):
+        return {
+            'Lookups': self.lookups,
+            'Mean Prefix Tokens': self.prompt_tokens / self.lookups if self.lookups else 0.0,
+            'Mean Hit Tokens': self.hit_tokens / self.lookups if self.lookups else 0.0,
+            'Max Hit Tokens': self.max_hit_tokens,
+            'Hit Token Rate': self.hit_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            'Memory Bytes': self.nbytes,
+            'Evictions': self.evictions,
+        }
+
+def common_prefix(encoded_prompts):
+    # the longest prefix every prompt shares, always leaving each prompt at least one token to prefill
+    first = encoded_prompts[0]
+    return first[:min(shared_prefix_length(first, prompt_ids) for prompt_ids in encoded_prompts)]
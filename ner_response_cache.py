@@ -0,0 +1,131 @@
+"""
+A persistent on-disk cache of generated responses, so that rerunning a script after changing only
+the parsing or the metrics does not regenerate every test sentence. Responses are stored in a SQLite
+database keyed by a hash of the model name, the prompt token ids, the model's generation config and
+any other settings that change what gets generated (such as constrained decoding). The cache counts
+hits and misses, and evicts the least recently used responses once it holds more than a set number.
+
+Worker processes of a sharded run never write to the shared cache file. Each writes to a cache file of
+its own and only reads the shared one, and the parent merges the workers' files into the shared one
+once they have all finished, so there is only ever one writer per file.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from array import array
+
+class ResponseCache:
+
+    def __init__(self, path, model_name, generation_config=None, max_entries=100000, shared_path=None, timeout=60.0):
+        # a connection waits up to `timeout` seconds for a lock held by another connection, rather
+        # than failing with "database is locked" straight away
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, uri=True)
+        self.connection.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, last_used INTEGER NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+        # everything but the prompt that goes into the key, serialised once
+        generation_config = {name: value for name, value in (generation_config or {}).items() if name != 'transformers_version'}
+        self.key_prefix = json.dumps({'model': model_name, 'generation_config': generation_config}, sort_keys=True, default=str)
+
+        # the shared cache file of a sharded run, only ever read from here, if it exists yet
+        self.shared = shared_path is not None and os.path.exists(shared_path)
+        if self.shared:
+            self.connection.execute("ATTACH DATABASE ? AS shared", (f"file:{shared_path}?mode=ro",))
+
+        self.max_entries = max_entries
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, prompt_ids, **settings):
+        # hash of the model and generation setup, the extra settings and the prompt's token ids
+        digest = hashlib.sha256(self.key_prefix.encode('utf-8'))
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+        digest.update(array('q', prompt_ids).tobytes())
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        # the cached response for the key, or None, marking the response as the most recently used
+        row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None and self.shared:
+            # a response from the shared cache is copied into this one, so that the merge carries
+            # its use back to the shared cache
+            row = self.connection.execute("SELECT response FROM shared.responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self.put(key, row[0])
+                return row[0]
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time_ns(), key))
+        return row[0]
+
+    def put(self, key, response):
+        cursor = self.connection.execute("INSERT OR IGNORE INTO responses (key, response, last_used) VALUES (?, ?, ?)", (key, response, time.time_ns()))
+        if cursor.rowcount == 1:
+            self.entries += 1
+        else:
+            self.connection.execute("UPDATE responses SET response = ?, last_used = ? WHERE key = ?", (response, time.time_ns(), key))
+
+        self._evict()
+
+    def merge(self, path):
+        # copies every response of another cache file into this one, keeping the latest use of each
+        self.connection.execute("ATTACH DATABASE ? AS other", (path,))
+        try:
+            self.connection.execute("INSERT INTO responses (key, response, last_used) SELECT key, response, last_used FROM other.responses WHERE true ON CONFLICT (key) DO UPDATE SET response = excluded.response, last_used = MAX(last_used, excluded.last_used)")
+        finally:
+            self.connection.execute("DETACH DATABASE other")
+
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self._evict()
+
+    def _evict(self):
+        # evict the least recently used responses once over the size cap
+        if self.max_entries is not None and self.entries > self.max_entries:
+            excess = self.entries - self.max_entries
+            self.connection.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,))
+            self.entries -= excess
+            self.evictions += excess
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'Hits': self.hits,
+            'Misses': self.misses,
+            'Hit Rate': self.hits / lookups if lookups else 0.0,
+            'Entries': self.entries,
+            'Evictions': self.evictions,
+        }
+
+    def close(self):
+        self.connection.close()
+
+def lookup_responses(response_cache, encoded_prompts, **settings):
+    # the cache keys of a list of encoded prompts, the responses already cached for them by position,
+    # and the positions that still need generating. Without a response cache nothing is cached
+    if response_cache is None:
+        return None, {}, list(range(len(encoded_prompts)))
+
+    cache_keys = [response_cache.make_key(prompt_ids, **settings) for prompt_ids in encoded_prompts]
+    cached_responses = {}
+    missing_positions = []
+    for position, cache_key in enumerate(cache_keys):
+        response = response_cache.get(cache_key)
+        if response is None:
+            missing_positions.append(position)
+        else:
+            cached_responses[position] = response
+
+    return cache_keys, cached_responses, missing_positions
@@ -0,0 +1,105 @@
+"""
+Record keeping shared by llama_ner.py and llama_ner_sample_every.py. Both scripts write each
+decoded response to the same file format, parse the tags out of a response the same way, and write
+the predictions and scores of a language once every sentence is done, so these helpers live here
+once rather than in both scripts.
+"""
+
+import json
+
+from new_ner_metric import score_corpus
+from ner_instrumentation import logger, trace_stage
+from ner_tags import decode_tags
+from ner_writer import AsyncFileWriter
+
+def record_decoded_response(decoded_response, decoded_response_writer):
+    # Responses are only printed at the DEBUG log level, formatted lazily
+    logger.debug("DECODED RESPONSE: \n%s\n/////////////////////////\n\n", decoded_response)
+
+    # Queue the response for the background writer, which keeps every response in the file
+    decoded_response_writer.write(f"START OF DECODED RESPONSE \n\n{decoded_response}END OF DECODED RESPONSE \n\n\n")
+
+def write_decoded_responses(dataset, generated_responses, decoded_response_filepath):
+    # Rewrite the decoded responses file in dataset order from raw responses keyed by row index, as
+    # when merging the responses of separately generated shards
+    decoded_response_writer = AsyncFileWriter(decoded_response_filepath)
+    for row in dataset:
+        decoded_response_writer.write(f"START OF DECODED RESPONSE \n\nSentence: {row.text}\nSequence of BIO Tags:{generated_responses[row.sentence_id]}END OF DECODED RESPONSE \n\n\n")
+    decoded_response_writer.close()
+
+def finish_response(generated_responses, index, sentence, generated_response, decoded_response_writer, on_response=None):
+    # Record a finished response against its row index and hand it on straight away
+    record_decoded_response(f"Sentence: {sentence}\nSequence of BIO Tags:{generated_response}", decoded_response_writer)
+    generated_responses[index] = generated_response
+
+    if on_response is not None:
+        on_response(index, generated_response)
+
+def extract_predicted_tags(generated_response):
+    # Locate the end of the predicted tags in the newly generated text
+    end_index = generated_response.find("#####")
+    predicted_tags_str = generated_response[:end_index].strip() if end_index != -1 else generated_response.strip()
+    predicted_tags = predicted_tags_str.split() if predicted_tags_str else []
+
+    return predicted_tags
+
+def clean_and_align_predicted_tags(predicted_tags, sentence_length):
+    # Replace any non-tag elements with 'O' and truncate or pad to match sentence length
+    cleaned_tags = [
+        tag if tag.startswith('B-') or tag.startswith('I-') or tag == 'O' else 'O'
+        for tag in predicted_tags
+    ]
+
+    return cleaned_tags[:sentence_length] + ['O'] * (sentence_length - len(cleaned_tags))
+
+def align_response(generated_response, sentence_length, tag_codes=None):
+    # The aligned tags of a raw response, with compact tag codes mapped back to the full tags before
+    # cleaning and scoring
+    generated_prediction = extract_predicted_tags(generated_response)
+    if tag_codes is not None:
+        generated_prediction = decode_tags(generated_prediction, tag_codes)
+
+    return clean_and_align_predicted_tags(generated_prediction, sentence_length)
+
+def write_predictions_and_scores(dataset, aligned_predictions, prediction_filepath, score_filepath, token_report=None, tracer=None):
+    # List to store cleaned and aligned predicted tags
+    cleaned_predicted_tags = []
+
+    # Prediction records go through a background writer as well
+    prediction_writer = AsyncFileWriter(prediction_filepath)
+
+    # Iterate over the test data
+    for row in dataset:
+        sentence = row.text
+        aligned_tags = aligned_predictions[row.sentence_id]
+
+        # Save aligned tags and reference tags for each sentence
+        prediction_writer.write(f"Sentence: {sentence}\nPredicted Tags: {' '.join(aligned_tags)}\nReference Tags: {' '.join(row.tags)}\n\n")
+
+        logger.debug("ALIGNED TAGS: %s", aligned_tags)
+
+        cleaned_predicted_tags.append(aligned_tags)
+
+    with trace_stage(tracer, 'file_writes', file=prediction_filepath):
+        prediction_writer.close()
+
+    # Calculate evaluation metrics over the corpus's tag ids, matching seqeval's entity scores
+    entity_scores = score_corpus(dataset, cleaned_predicted_tags)
+    precision = entity_scores['Precision']
+    recall = entity_scores['Recall']
+    f1_score = entity_scores['F1-Score']
+
+    # Save the scores
+    with open(score_filepath, 'w', encoding='utf-8') as score_file:
+        scores = {
+            'Precision': precision,
+            'Recall': recall,
+            'F1-Score': f1_score
+        }
+        if token_report is not None:
+            scores['Compact Tag Token Report'] = token_report
+        score_file.write(json.dumps(scores, indent=4))
+
+    print(f"Precision: {precision}, Recall: {recall}, F1-Score: {f1_score}")
+
+    return scores
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+Runs any of our prompting strategies over any of the MultiCoNER languages from a single JSON or
+YAML config, in one process. The model and tokenizer are loaded once, each language's test file is
+loaded once, and every (strategy, language) job goes through the same response cache. Each job
+samples its sentences and writes its output files exactly as the strategy's own script does, so
+the prediction files can be passed to new_ner_metric.py as before.
+
+With num_shards above one, every job's sample is split by sentence id into that many shards, each
+generated by its own worker process with its own model replica, and the shard journals are then
+merged back in the original order and scored once. The shards can also be run on separate nodes
+sharing the folder path, one --shard each, followed by a single --merge.
+
+Usage: python ner_runner.py runner_config.json [--shard INDEX [--device DEVICE] | --merge]
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+import llama_ner
+import llama_ner_init_run
+import llama_ner_sample_every
+from ner_conll import open_corpus
+from ner_responses import align_response, write_decoded_responses, write_predictions_and_scores
+from ner_cpu_inference import cache_model_name, configure_cpu_threads, load_cpu_model
+from ner_journal import SentenceJournal, model_settings, settings_fingerprint
+from ner_response_cache import ResponseCache
+from ner_sharding import shard_of, shard_filepath, merge_shard_journals
+from ner_tags import COMPACT_TAG_CODES
+from new_ner_metric import eval_and_write_new_ner_metrics
+
+LANGUAGES = {
+    'en': "English",
+    'bn': "Bangla",
+    'fa': "Farsi",
+    'hi': "Hindi",
+    'pt': "Portuguese",
+    'it': "Italian",
+    'uk': "Ukrainian",
+}
+
+# Options every job reads, with the values the scripts use. A strategy entry in the config may
+# override any of them for that strategy alone
+DEFAULT_OPTIONS = {
+    'sample_size': 300,
+    'use_prefix_cache': False,
+    'batch_size': 1,
+    'constrained_decoding': False,
+    'compact_tags': False,
+    'decode_slots': 0,
+    'radix_cache_budget': 2 * 1024 ** 3,
+    'prompt_token_budget': None,
+    'prompt_overflow': 'trim',
+    'few_shot_selection': 'sample',
+    'sentences_per_prompt': 1,
+    'speculative_drafter': None,
+    'speculative_tokens': 8,
+}
+
+def run_fixed_5_shot(model, tokenizer, language_code, dataset, folder_path, options, response_cache, shard=None, draft_model=None):
+    # llama_ner_init_run.py: 5 few shot examples sampled once, with the less detailed prompt. Given a
+    # (shard index, number of shards), only that shard is generated, into its own journal
+    few_shot_data, sample_data = llama_ner_init_run.get_examples_and_sample(dataset, options['few_shot_size'], options['sample_size'])
+    prediction_filepath = folder_path + f"{language_code}_prediction_vs_reference_tags.txt"
+    score_filepath = folder_path + f"{language_code}_score.txt"
+    if shard is None:
+        llama_ner_init_run.evaluate_for_language(model, tokenizer, LANGUAGES[language_code], sample_data, few_shot_data, prediction_filepath, score_filepath, use_prefix_cache=options['use_prefix_cache'], batch_size=options['batch_size'])
+    else:
+        # the script keeps no journal, so the shard's aligned tags are journalled here, under the
+        # settings that decide them
+        journal_fingerprint = settings_fingerprint({
+            'Model': model_settings(model),
+            'Tokenizer': tokenizer.name_or_path,
+            'Language': LANGUAGES[language_code],
+            'Few Shot Sentence Ids': [int(index) for index in few_shot_data.index],
+        })
+        journal = SentenceJournal(shard_filepath(folder_path + f"{language_code}_journal_init_run.jsonl", *shard), fingerprint=journal_fingerprint)
+        shard_data = shard_of(sample_data, *shard)
+        shard_data = shard_data.drop([index for index in shard_data.index if index in journal])
+        try:
+            aligned_predictions = llama_ner_init_run.predict_for_language(model, tokenizer, LANGUAGES[language_code], shard_data, few_shot_data, use_prefix_cache=options['use_prefix_cache'], batch_size=options['batch_size'])
+            for index, aligned_tags in aligned_predictions.items():
+                journal.record(int(index), None, aligned_tags)
+        finally:
+            journal.close()
+
+    return prediction_filepath
+
+def merge_fixed_5_shot(tokenizer, language_code, dataset, folder_path, options, num_shards):
+    few_shot_data, sample_data = llama_ner_init_run.get_examples_and_sample(dataset, options['few_shot_size'], options['sample_size'])
+    prediction_filepath = folder_path + f"{language_code}_prediction_vs_reference_tags.txt"
+    score_filepath = folder_path + f"{language_code}_score.txt"
+    journal_filepath = folder_path + f"{language_code}_journal_init_run.jsonl"
+    entries = merge_shard_journals(sample_data, journal_filepath, num_shards)
+    llama_ner_init_run.write_predictions_and_scores(sample_data, {index: entry['tags'] for index, entry in entries.items()}, prediction_filepath, score_filepath)
+    remove_shard_files(journal_filepath, num_shards)
+
+    return prediction_filepath
+
+def run_fixed_10_shot(model, tokenizer, language_code, dataset, folder_path, options, response_cache, shard=None, draft_model=None):
+    # llama_ner.py: 10 few shot examples sampled once, with the more detailed prompt. Given a (shard
+    # index, number of shards), only that shard is generated, into its own journal
+    few_shot_data, sample_data = llama_ner.get_examples_and_sample(dataset, options['few_shot_size'], options['sample_size'])
+    prediction_filepath = folder_path + f"{language_code}_predicted_vs_reference_tags.txt"
+    score_filepath = folder_path + f"{language_code}_evaluation_scores.json"
+    decoded_filepath = folder_path + f"{language_code}_decoded_responses.txt"
+    journal_filepath = folder_path + f"{language_code}_journal.jsonl"
+
+    # the 'draft_model' drafter is the draft model loaded once for every job
+    speculative_drafter = draft_model if options['speculative_drafter'] == 'draft_model' else options['speculative_drafter']
+    if shard is None:
+        llama_ner.evaluate_for_language(model, tokenizer, LANGUAGES[language_code], sample_data, few_shot_data, prediction_filepath, score_filepath, decoded_filepath, use_prefix_cache=options['use_prefix_cache'], batch_size=options['batch_size'], constrained=options['constrained_decoding'], compact_tags=options['compact_tags'], decode_slots=options['decode_slots'], response_cache=response_cache, journal_filepath=journal_filepath, prompt_token_budget=options['prompt_token_budget'], prompt_overflow=options['prompt_overflow'], sentences_per_prompt=options['sentences_per_prompt'], speculative_drafter=speculative_drafter, speculative_tokens=options['speculative_tokens'])
+    else:
+        llama_ner.generate_for_language(model, tokenizer, LANGUAGES[language_code], shard_of(sample_data, *shard), few_shot_data, shard_filepath(decoded_filepath, *shard), use_prefix_cache=options['use_prefix_cache'], batch_size=options['batch_size'], constrained=options['constrained_decoding'], compact_tags=options['compact_tags'], decode_slots=options['decode_slots'], response_cache=response_cache, journal_filepath=shard_filepath(journal_filepath, *shard), prompt_token_budget=options['prompt_token_budget'], prompt_overflow=options['prompt_overflow'], sentences_per_prompt=options['sentences_per_prompt'], speculative_drafter=speculative_drafter, speculative_tokens=options['speculative_tokens'])
+
+    return prediction_filepath
+
+def merge_fixed_10_shot(tokenizer, language_code, dataset, folder_path, options, num_shards):
+    few_shot_data, sample_data = llama_ner.get_examples_and_sample(dataset, options['few_shot_size'], options['sample_size'])
+    prediction_filepath = folder_path + f"{language_code}_predicted_vs_reference_tags.txt"
+    score_filepath = folder_path + f"{language_code}_evaluation_scores.json"
+    decoded_filepath = folder_path + f"{language_code}_decoded_responses.txt"
+    journal_filepath = folder_path + f"{language_code}_journal.jsonl"
+    entries = merge_shard_journals(sample_data, journal_filepath, num_shards)
+
+    # the compact tag token report covers the whole sample, so it is worked out again here
+    token_report = llama_ner.build_language_prompt(tokenizer, LANGUAGES[language_code], sample_data, few_shot_data, compact_tags=True)[2] if options['compact_tags'] else None
+    write_decoded_responses(sample_data, {index: entry['response'] for index, entry in entries.items()}, decoded_filepath)
+    tag_codes = COMPACT_TAG_CODES if options['compact_tags'] else None
+    write_predictions_and_scores(sample_data, {index: align_response(entry['response'], len(sample_data.by_id(index)), tag_codes=tag_codes) for index, entry in entries.items()}, prediction_filepath, score_filepath, token_report=token_report)
+    remove_shard_files(decoded_filepath, num_shards)
+    remove_shard_files(journal_filepath, num_shards)
+
+    return prediction_filepath
+
+def run_sample_every(model, tokenizer, language_code, dataset, folder_path, options, response_cache, shard=None, draft_model=None):
+    # llama_ner_sample_every.py: 10 few shot examples sampled for every test sentence. As in the
+    # script, a language whose scores file already exists is skipped. Given a (shard index, number
+    # of shards), only that shard is generated, into its own journal
+    sample_data, few_shot_dataset = llama_ner_sample_every.get_sample_and_remove(dataset, options['sample_size'])
+    prediction_filepath = folder_path + f"{language_code}_predicted_vs_reference_tags_sample_every.txt"
+    score_filepath = folder_path + f"{language_code}_evaluation_scores_sample_every.json"
+    decoded_filepath = folder_path + f"{language_code}_decoded_responses_sample_every.txt"
+    journal_filepath = folder_path + f"{language_code}_journal_sample_every.jsonl"
+    if os.path.exists(score_filepath):
+        print(f"ALREADY DONE: {score_filepath}")
+    elif shard is None:
+        llama_ner_sample_every.evaluate_for_language(model, tokenizer, LANGUAGES[language_code], sample_data, few_shot_dataset, options['few_shot_size'], prediction_filepath, score_filepath, decoded_filepath, batch_size=options['batch_size'], constrained=options['constrained_decoding'], compact_tags=options['compact_tags'], decode_slots=options['decode_slots'], response_cache=response_cache, journal_filepath=journal_filepath, radix_cache_budget=options['radix_cache_budget'], prompt_token_budget=options['prompt_token_budget'], prompt_overflow=options['prompt_overflow'], few_shot_selection=options['few_shot_selection'])
+    else:
+        llama_ner_sample_every.generate_for_language(model, tokenizer, LANGUAGES[language_code], shard_of(sample_data, *shard), few_shot_dataset, options['few_shot_size'], shard_filepath(decoded_filepath, *shard), batch_size=options['batch_size'], constrained=options['constrained_decoding'], compact_tags=options['compact_tags'], decode_slots=options['decode_slots'], response_cache=response_cache, journal_filepath=shard_filepath(journal_filepath, *shard), radix_cache_budget=options['radix_cache_budget'], prompt_token_budget=options['prompt_token_budget'], prompt_overflow=options['prompt_overflow'], few_shot_selection=options['few_shot_selection'])
+
+    return prediction_filepath
+
+def merge_sample_every(tokenizer, language_code, dataset, folder_path, options, num_shards):
+    sample_data, few_shot_dataset = llama_ner_sample_every.get_sample_and_remove(dataset, options['sample_size'])
+    prediction_filepath = folder_path + f"{language_code}_predicted_vs_reference_tags_sample_every.txt"
+    score_filepath = folder_path + f"{language_code}_evaluation_scores_sample_every.json"
+    decoded_filepath = folder_path + f"{language_code}_decoded_responses_sample_every.txt"
+    if os.path.exists(score_filepath):
+        print(f"ALREADY DONE: {score_filepath}")
+        return prediction_filepath
+    journal_filepath = folder_path + f"{language_code}_journal_sample_every.jsonl"
+    entries = merge_shard_journals(sample_data, journal_filepath, num_shards)
+
+    # the compact tag token report covers the whole sample, so it is worked out again here
+    token_report = llama_ner_sample_every.build_token_report(tokenizer, LANGUAGES[language_code], sample_data, few_shot_dataset, options['few_shot_size'], COMPACT_TAG_CODES) if options['compact_tags'] else None
+    write_decoded_responses(sample_data, {index: entry['response'] for index, entry in entries.items()}, decoded_filepath)
+    tag_codes = COMPACT_TAG_CODES if options['compact_tags'] else None
+    write_predictions_and_scores(sample_data, {index: align_response(entry['response'], len(sample_data.by_id(index)), tag_codes=tag_codes) for index, entry in entries.items()}, prediction_filepath, score_filepath, token_report=token_report)
+    remove_shard_files(decoded_filepath, num_shards)
+    remove_shard_files(journal_filepath, num_shards)
+
+    return prediction_filepath
+
+def remove_shard_files(filepath, num_shards):
+    # the shards' own decoded responses files and journals, once the merged files and scores have
+    # been written from the journals
+    for shard_index in range(num_shards):
+        path = shard_filepath(filepath, shard_index, num_shards)
+        if os.path.exists(path):
+            os.remove(path)
+
+# Each strategy's job, the merge of its shards, and its number of few shot examples
+STRATEGIES = {
+    'fixed_5_shot': (run_fixed_5_shot, merge_fixed_5_shot, 5),
+    'fixed_10_shot': (run_fixed_10_shot, merge_fixed_10_shot, 10),
+    'sample_every': (run_sample_every, merge_sample_every, 10),
+}
+
+def load_config(config_path):
+    # reads a .json config, or a .yaml/.yml one when PyYAML is installed
+    with open(config_path, 'r', encoding='utf-8') as config_file:
+        if config_path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is needed to read YAML configs, install it or use a JSON config") from None
+            config = yaml.safe_load(config_file)
+        else:
+            config = json.load(config_file)
+
+    unknown_keys = set(config) - {'folder_path', 'model_name', 'token', 'languages', 'strategies', 'use_response_cache', 'custom_metric', 'num_shards', 'devices', 'draft_model_name', 'log_level', 'cpu_precision', 'cpu_threads'} - set(DEFAULT_OPTIONS)
+    if unknown_keys:
+        raise ValueError(f"Unknown config keys: {sorted(unknown_keys)}")
+
+    return config
+
+def configure_logging(config):
+    # decoded responses and aligned tags are only printed at the DEBUG log level. Spawned shard
+    # workers start without the parent's logging, so each configures its own
+    logging.basicConfig(level=config.get('log_level', 'INFO'), format="%(message)s")
+
+def plan_jobs(config):
+    # the (strategy name, language code, options) of every job in the order they run: strategy by
+    # strategy, and within a strategy language by language in the config's order
+    defaults = dict(DEFAULT_OPTIONS)
+    defaults.update({key: value for key, value in config.items() if key in DEFAULT_OPTIONS})
+
+    languages = config.get('languages', list(LANGUAGES))
+    for language_code in languages:
+        if language_code not in LANGUAGES:
+            raise ValueError(f"Unknown language {language_code!r}, expected one of {list(LANGUAGES)}")
+
+    jobs = []
+    for strategy in config.get('strategies', list(STRATEGIES)):
+        # a strategy is given by its name, or as a mapping with its name and any options to override
+        overrides = dict(strategy) if isinstance(strategy, dict) else {'name': strategy}
+        name = overrides.pop('name')
+        if name not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {name!r}, expected one of {list(STRATEGIES)}")
+        unknown_keys = set(overrides) - set(DEFAULT_OPTIONS) - {'few_shot_size'}
+        if unknown_keys:
+            raise ValueError(f"Unknown options for strategy {name!r}: {sorted(unknown_keys)}")
+
+        options = dict(defaults, few_shot_size=STRATEGIES[name][2])
+        options.update(overrides)
+        jobs.extend((name, language_code, options) for language_code in languages)
+
+    return jobs
+
+def load_datasets(folder_path, jobs):
+    # Each language's test file is opened once and shared by every strategy, which all sample it
+    # with the same fixed random state as their scripts, so only the sampled sentences are parsed
+    datasets = {}
+    for _, language_code, _ in jobs:
+        if language_code not in datasets:
+            datasets[language_code] = open_corpus(folder_path + f"{language_code}_test.conll")
+
+    return datasets
+
+def load_model(config, device=None):
+    # the tokenizer and the model, spread over every visible GPU, or as one replica on the given
+    # device. With a cpu_precision, the model is loaded for CPU inference in that precision instead
+    model_name = config.get('model_name', "meta-llama/Llama-2-7b-chat-hf")
+    tokenizer = AutoTokenizer.from_pretrained(model_name, token=config.get('token'))
+    if config.get('cpu_precision') is not None:
+        model = load_cpu_model(model_name, token=config.get('token'), precision=config['cpu_precision'])
+    elif device is None:
+        model = AutoModelForCausalLM.from_pretrained(model_name, token=config.get('token'), device_map = 'auto')
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name, token=config.get('token')).to(device)
+
+    return tokenizer, model
+
+def load_draft_model(config, jobs, device=None):
+    # the small model drafting tokens for speculative decoding, only loaded when a job uses it
+    if not any(options['speculative_drafter'] == 'draft_model' for _, _, options in jobs):
+        return None
+
+    draft_model_name = config.get('draft_model_name', "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    if config.get('cpu_precision') is not None:
+        return load_cpu_model(draft_model_name, token=config.get('token'), precision=config['cpu_precision'])
+    if device is None:
+        return AutoModelForCausalLM.from_pretrained(draft_model_name, token=config.get('token'), device_map = 'auto')
+    return AutoModelForCausalLM.from_pretrained(draft_model_name, token=config.get('token')).to(device)
+
+def open_response_cache(config, model, shard_index=None):
+    # Responses already generated by an earlier job or run with the same prompts and settings are
+    # reused. A shard writes its responses to a cache file of its own, reading the shared one as well,
+    # so that concurrent shards never write to the same file
+    if not config.get('use_response_cache', True):
+        return None
+    cache_filepath = config.get('folder_path', '') + "response_cache.sqlite"
+    model_name = cache_model_name(config.get('model_name', "meta-llama/Llama-2-7b-chat-hf"), config.get('cpu_precision'))
+    if shard_index is not None:
+        return ResponseCache(shard_filepath(cache_filepath, shard_index, config['num_shards']), model_name, model.generation_config.to_dict(), shared_path=cache_filepath)
+    return ResponseCache(cache_filepath, model_name, model.generation_config.to_dict())
+
+def merge_response_caches(config):
+    # folds the shards' own response cache files into the shared one, which only this process writes
+    if not config.get('use_response_cache', True):
+        return
+    cache_filepath = config.get('folder_path', '') + "response_cache.sqlite"
+    response_cache = ResponseCache(cache_filepath, cache_model_name(config.get('model_name', "meta-llama/Llama-2-7b-chat-hf"), config.get('cpu_precision')))
+    try:
+        for shard_index in range(config['num_shards']):
+            path = shard_filepath(cache_filepath, shard_index, config['num_shards'])
+            if os.path.exists(path):
+                response_cache.merge(path)
+                os.remove(path)
+    finally:
+        response_cache.close()
+
+def score_custom_metric(config, prediction_filepaths):
+    # Optionally score every prediction file with our custom metric as well
+    existing_filepaths = [filepath for filepath in prediction_filepaths if os.path.exists(filepath)]
+    if config.get('custom_metric', False) and existing_filepaths:
+        eval_and_write_new_ner_metrics(existing_filepaths)
+
+def run(config):
+    # runs every job in this process, or, with more than one shard in the config, across one worker
+    # process per shard followed by the merge
+    if config.get('num_shards', 1) > 1:
+        return run_sharded(config)
+
+    folder_path = config.get('folder_path', '')
+    jobs = plan_jobs(config)
+    datasets = load_datasets(folder_path, jobs)
+
+    # Load the LLaMA model, once for every job
+    if config.get('cpu_precision') is not None:
+        configure_cpu_threads(config.get('cpu_threads'))
+    tokenizer, model = load_model(config)
+    draft_model = load_draft_model(config, jobs)
+    response_cache = open_response_cache(config, model)
+
+    prediction_filepaths = []
+    try:
+        for name, language_code, options in jobs:
+            print(f"{name.upper()} {LANGUAGES[language_code].upper()}")
+            run_job = STRATEGIES[name][0]
+            prediction_filepaths.append(run_job(model, tokenizer, language_code, datasets[language_code], folder_path, options, response_cache, draft_model=draft_model))
+            print()
+    finally:
+        if response_cache is not None:
+            response_cache.close()
+
+    score_custom_metric(config, prediction_filepaths)
+
+    return prediction_filepaths
+
+def shard_device(config, shard_index):
+    # the device of a shard's model replica, taken in turn from the config's devices, or else from
+    # the visible GPUs, or the CPU if there are none
+    devices = config.get('devices') or [f"cuda:{index}" for index in range(torch.cuda.device_count())] or ["cpu"]
+    return devices[shard_index % len(devices)]
+
+def run_shard(config, shard_index, device=None, local_workers=1):
+    # generates one shard of every job, with its own model replica. Shards can run as local worker
+    # processes, local_workers of them on this node, or as separate processes on separate nodes
+    # sharing the folder path
+    configure_logging(config)
+    num_shards = config['num_shards']
+    folder_path = config.get('folder_path', '')
+    jobs = plan_jobs(config)
+    datasets = load_datasets(folder_path, jobs)
+
+    # CPU shards on one node each take their own group of cores, an even share of them by default
+    if config.get('cpu_precision') is not None:
+        configure_cpu_threads(config.get('cpu_threads'), worker_index=shard_index, num_workers=local_workers)
+    tokenizer, model = load_model(config, device or shard_device(config, shard_index))
+    draft_model = load_draft_model(config, jobs, device or shard_device(config, shard_index))
+    response_cache = open_response_cache(config, model, shard_index=shard_index)
+
+    try:
+        for name, language_code, options in jobs:
+            print(f"{name.upper()} {LANGUAGES[language_code].upper()} SHARD {shard_index} OF {num_shards}")
+            run_job = STRATEGIES[name][0]
+            run_job(model, tokenizer, language_code, datasets[language_code], folder_path, options, response_cache, shard=(shard_index, num_shards), draft_model=draft_model)
+            print()
+    finally:
+        if response_cache is not None:
+            response_cache.close()
+
+def merge_shards(config):
+    # rebuilds every job's output files in the sample's original order from the shard journals and
+    # scores them once, and merges the shards' response caches. Only the tokenizer is loaded, for the
+    # compact tag token reports
+    merge_response_caches(config)
+    num_shards = config['num_shards']
+    folder_path = config.get('folder_path', '')
+    jobs = plan_jobs(config)
+    datasets = load_datasets(folder_path, jobs)
+    tokenizer = AutoTokenizer.from_pretrained(config.get('model_name', "meta-llama/Llama-2-7b-chat-hf"), token=config.get('token')) if any(options['compact_tags'] for _, _, options in jobs) else None
+
+    prediction_filepaths = []
+    for name, language_code, options in jobs:
+        print(f"{name.upper()} {LANGUAGES[language_code].upper()} MERGE OF {num_shards} SHARDS")
+        merge_job = STRATEGIES[name][1]
+        prediction_filepaths.append(merge_job(tokenizer, language_code, datasets[language_code], folder_path, options, num_shards))
+        print()
+
+    score_custom_metric(config, prediction_filepaths)
+
+    return prediction_filepaths
+
+def run_sharded(config):
+    # one worker process per shard on this machine, then the merge once all of them have finished
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_shard, args=(config, shard_index, None, config['num_shards'])) for shard_index in range(config['num_shards'])]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [shard_index for shard_index, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed, rerun to resume them from their journals")
+
+    return merge_shards(config)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the jobs in a JSON or YAML config")
+    parser.add_argument('config_path')
+    parser.add_argument('--shard', type=int, help="only generate this shard of the config's num_shards, e.g. on one node of several")
+    parser.add_argument('--device', help="the device for the --shard model replica, e.g. cuda:0")
+    parser.add_argument('--merge', action='store_true', help="only merge and score the finished shards")
+    args = parser.parse_args()
+
+    config = load_config(args.config_path)
+    configure_logging(config)
+    if args.shard is not None:
+        run_shard(config, args.shard, args.device)
+    elif args.merge:
+        merge_shards(config)
+    else:
+        run(config)
@@ -0,0 +1,45 @@
+"""
+Deterministic sharding of an evaluation across worker processes, GPUs or nodes. Sentences are
+assigned to shards by their sentence id, so every worker picks out the same shard of a language's
+sample on its own, without any coordination. Each worker writes the sentences it finishes to its
+own checkpoint journal (e.g. en_journal.shard0of4.jsonl). Once every shard is done, the journals are
+merged back in the sample's original order and scored once.
+"""
+
+import os
+
+import numpy as np
+
+from ner_journal import SentenceJournal
+
+def shard_of(dataset, shard_index, num_shards):
+    # the sentences of a NerCorpus whose sentence id falls in the given shard, in their original order
+    return dataset.take(np.flatnonzero(dataset.sentence_ids % num_shards == shard_index))
+
+def shard_filepath(filepath, shard_index, num_shards):
+    # the given shard's own copy of a file, e.g. en_journal.shard0of4.jsonl for en_journal.jsonl
+    stem, extension = os.path.splitext(filepath)
+    return f"{stem}.shard{shard_index}of{num_shards}{extension}"
+
+def merge_shard_journals(dataset, journal_filepath, num_shards):
+    # the journal entry of every sentence in the dataset keyed by sentence id, read back from the
+    # journals of all the shards. Raises if a shard has not finished all of its sentences, or if the
+    # shards were generated with different settings
+    entries = {}
+    fingerprints = set()
+    for shard_index in range(num_shards):
+        path = shard_filepath(journal_filepath, shard_index, num_shards)
+        if os.path.exists(path):
+            journal = SentenceJournal(path)
+            entries.update(journal.entries)
+            fingerprints.add(journal.fingerprint)
+            journal.close()
+
+    if len(fingerprints) > 1:
+        raise RuntimeError(f"The {num_shards} shard journals of {journal_filepath} were written with different settings, rerun the shards with the same config")
+
+    missing = [int(index) for index in dataset.index if int(index) not in entries]
+    if missing:
+        raise RuntimeError(f"{len(missing)} of {len(dataset)} sentences are missing from the {num_shards} shard journals of {journal_filepath}, starting with sentence {missing[0]}")
+
+    return {int(index): entries[int(index)] for index in dataset.index}
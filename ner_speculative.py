@@ -0,0 +1,289 @@
+"""
+Speculative (assisted) decoding for NER generation. A tag sequence is mostly runs of " O" with the
+occasional B- or I- tag, so its next few tokens are usually easy to guess. A drafter proposes several
+tokens at a time, and Llama-2 checks all of them in a single forward pass over the last token and
+the draft. The longest run of draft tokens the model agrees with is kept together with the model's
+own next token, so every pass yields at least one token and often several.
+
+Two drafters are provided. The prompt lookup drafter needs no extra model: it finds the latest
+earlier occurrence of the last few tokens in the prompt and the response so far, whose few shot
+examples are full of the same tag runs, and proposes the tokens that followed it. The draft model
+drafter decodes the draft with a small model that shares Llama-2's tokenizer, such as TinyLlama.
+
+With greedy decoding the output is the one plain decoding gives, up to floating point differences
+between scoring the draft in one pass and one token at a time. When the model's generation config
+samples, draft tokens are accepted by rejection sampling against the model's distribution, so the
+output follows the same distribution as plain sampling.
+
+Running this file directly checks the decoder with both drafters against model.generate on the CPU,
+with a tiny randomly initialised Llama model and a one layer Llama model holding its first layer as
+the draft model, and prints the stats. The speedup is measured against plain greedy decoding of one
+token per pass from the same few shot prefix cache, after a warm-up call, so that it only measures
+what drafting saves.
+"""
+
+import time
+
+import torch
+
+from ner_continuous_batching import sampling_probabilities, to_legacy_cache, to_model_cache
+from ner_generation import ResponseScanner, max_response_tokens, shared_prefix_length, slice_past_key_values
+
+def crop_cache(legacy_cache, length):
+    # the first `length` positions of every layer's keys and values
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in legacy_cache)
+
+class PromptLookupDrafter:
+    # proposes the tokens that followed the latest earlier occurrence of the sequence's last few tokens
+
+    def __init__(self, num_tokens=8, max_ngram_size=3):
+        self.num_tokens = num_tokens
+        self.max_ngram_size = max_ngram_size
+
+    def propose(self, token_ids, num_tokens, sampling=None):
+        # the draft as a list of token ids, and None for its distributions as every draft token is certain.
+        # Longer n-grams are tried first. The latest occurrence with a full draft after it is preferred,
+        # otherwise the one with the longest draft
+        for ngram_size in range(min(self.max_ngram_size, len(token_ids) - 1), 0, -1):
+            ngram = token_ids[-ngram_size:]
+            best_draft = []
+            for start in range(len(token_ids) - ngram_size - 1, -1, -1):
+                if token_ids[start:start + ngram_size] == ngram:
+                    draft = token_ids[start + ngram_size:start + ngram_size + num_tokens]
+                    if len(draft) > len(best_draft):
+                        best_draft = draft
+                    if len(best_draft) == num_tokens:
+                        break
+            if best_draft:
+                return best_draft, None
+
+        return [], None
+
+class DraftModelDrafter:
+    # decodes the draft with a small model sharing the tokenizer, keeping its key/value cache between
+    # calls so that only the tokens it has not seen yet are run through it
+
+    def __init__(self, draft_model, num_tokens=8):
+        self.draft_model = draft_model
+        self.num_tokens = num_tokens
+        self.cache_ids = []
+        self.cache = None
+
+    def propose(self, token_ids, num_tokens, sampling=None):
+        # the draft as a list of token ids, and given (temperature, top_p) to sample with, the
+        # distributions each draft token was sampled from as a len(draft) x vocabulary tensor
+        cached_length = shared_prefix_length(self.cache_ids, token_ids) if self.cache is not None else 0
+        cache = crop_cache(self.cache, cached_length) if cached_length > 0 else None
+        input_ids = token_ids[cached_length:]
+
+        draft = []
+        draft_probabilities = []
+        with torch.no_grad():
+            for _ in range(num_tokens):
+                outputs = self.draft_model(torch.tensor([input_ids], device=self.draft_model.device), past_key_values=to_model_cache(cache) if cache is not None else None, use_cache=True)
+                cache = to_legacy_cache(outputs.past_key_values)
+                logits = outputs.logits[0, -1].float()
+
+                if sampling is None:
+                    token_id = int(logits.argmax())
+                else:
+                    probabilities = sampling_probabilities(logits, *sampling)
+                    token_id = int(torch.multinomial(probabilities, 1))
+                    draft_probabilities.append(probabilities)
+
+                draft.append(token_id)
+                input_ids = [token_id]
+
+        # the last draft token has not been run through the draft model, so it is not in the cache
+        self.cache_ids = token_ids + draft[:-1]
+        self.cache = cache
+
+        return draft, torch.stack(draft_probabilities) if draft_probabilities else None
+
+class SpeculativeDecoder:
+    # generates the tag sequence of one sentence at a time, verifying drafted tokens in batches
+
+    def __init__(self, model, tokenizer, drafter, prefix_cache=None, terminator="#####"):
+        draft_model = getattr(drafter, 'draft_model', None)
+        if draft_model is not None and draft_model.config.vocab_size != model.config.vocab_size:
+            raise ValueError(f"The draft model's vocabulary of {draft_model.config.vocab_size} tokens does not match the model's {model.config.vocab_size}")
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.drafter = drafter
+        self.prefix_cache = prefix_cache
+        self.terminator = terminator
+
+        # follow the model's own sampling settings, as model.generate does
+        generation_config = model.generation_config
+        self.do_sample = bool(generation_config.do_sample)
+        self.temperature = generation_config.temperature or 1.0
+        self.top_p = generation_config.top_p if generation_config.top_p is not None else 1.0
+
+        self.sentences = 0
+        self.generated_tokens = 0
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+        self.forward_passes = 0
+        self.seconds = 0.0
+
+    def _is_finished(self, generated_ids, scanner, word_count, max_new_tokens):
+        if generated_ids[-1] == self.tokenizer.eos_token_id or len(generated_ids) >= max_new_tokens:
+            return True
+
+        # only the tokens generated since the last check are scanned
+        scanner.extend(generated_ids[len(scanner.token_ids):])
+        return scanner.is_complete(word_count)
+
+    def _prefill(self, prompt_ids):
+        # runs the prompt through the model, reusing the few shot prefix cache where it matches
+        cached_length = 0
+        past_key_values = None
+        if self.prefix_cache is not None:
+            prefix_ids, prefix_past_key_values = self.prefix_cache
+            cached_length = shared_prefix_length(prefix_ids, prompt_ids)
+            if cached_length > 0:
+                past_key_values = to_model_cache(to_legacy_cache(slice_past_key_values(prefix_past_key_values, cached_length)))
+
+        input_ids = torch.tensor([prompt_ids[cached_length:]], device=self.model.device)
+        with torch.no_grad():
+            outputs = self.model(input_ids, past_key_values=past_key_values, use_cache=True)
+
+        return outputs.logits[0, -1:].float(), to_legacy_cache(outputs.past_key_values)
+
+    def _verify(self, logits, draft, draft_probabilities):
+        # the leading draft tokens the model accepts followed by one token of the model's own, given
+        # the model's logits after the last accepted token and after each draft token
+        if not self.do_sample:
+            predicted = logits.argmax(dim=-1).tolist()
+            accepted = 0
+            while accepted < len(draft) and draft[accepted] == predicted[accepted]:
+                accepted += 1
+            return draft[:accepted] + [predicted[accepted]]
+
+        # each draft token is kept with probability p/q, and the first rejected one is replaced by a
+        # sample from the part of the model's distribution the draft did not cover
+        probabilities = sampling_probabilities(logits, self.temperature, self.top_p)
+        for position, token_id in enumerate(draft):
+            draft_probability = float(draft_probabilities[position, token_id]) if draft_probabilities is not None else 1.0
+            if float(torch.rand(())) * draft_probability < float(probabilities[position, token_id]):
+                continue
+
+            if draft_probabilities is not None:
+                residual = (probabilities[position] - draft_probabilities[position].to(probabilities.device)).clamp(min=0)
+            else:
+                residual = probabilities[position].clone()
+                residual[token_id] = 0
+            if float(residual.sum()) <= 0:
+                residual = probabilities[position]
+            return draft[:position] + [int(torch.multinomial(residual, 1))]
+
+        return draft + [int(torch.multinomial(probabilities[len(draft)], 1))]
+
+    def generate(self, prompt_ids, word_count):
+        # the generated text for one encoded prompt, stopped at the terminator or once it holds a tag
+        # for every word, with the same new token budget as tag_generation_kwargs
+        start_time = time.perf_counter()
+        max_new_tokens = max_response_tokens(word_count)
+        sampling = (self.temperature, self.top_p) if self.do_sample else None
+
+        logits, cache = self._prefill(prompt_ids)
+        generated_ids = self._verify(logits, [], None)
+        scanner = ResponseScanner(self.tokenizer, self.terminator)
+        self.forward_passes += 1
+
+        while not self._is_finished(generated_ids, scanner, word_count, max_new_tokens):
+            # the cache holds every token but the last generated one, which is run with the draft
+            num_tokens = min(self.drafter.num_tokens, max_new_tokens - len(generated_ids) - 1)
+            draft, draft_probabilities = self.drafter.propose(prompt_ids + generated_ids, num_tokens, sampling) if num_tokens > 0 else ([], None)
+
+            input_ids = torch.tensor([generated_ids[-1:] + draft], device=self.model.device)
+            with torch.no_grad():
+                outputs = self.model(input_ids, past_key_values=to_model_cache(cache), use_cache=True)
+            self.forward_passes += 1
+
+            new_ids = self._verify(outputs.logits[0].float(), draft, draft_probabilities)
+            self.drafted_tokens += len(draft)
+            self.accepted_tokens += len(new_ids) - 1
+
+            # only the positions of the accepted tokens are kept, the model's own token is not in it yet
+            cache = crop_cache(to_legacy_cache(outputs.past_key_values), len(prompt_ids) + len(generated_ids) + len(new_ids) - 1)
+
+            # the tokens are taken one at a time, so the sequence stops exactly where plain decoding would
+            for token_id in new_ids:
+                generated_ids.append(token_id)
+                if self._is_finished(generated_ids, scanner, word_count, max_new_tokens):
+                    break
+
+        self.sentences += 1
+        self.generated_tokens += len(generated_ids)
+        self.seconds += time.perf_counter() - start_time
+
+        return self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+
+    def stats(self):
+        # plain decoding takes one forward pass of the model per token, so the tokens per pass are the
+        # speedup in model passes
+        return {
+            'Sentences': self.sentences,
+            'Generated Tokens': self.generated_tokens,
+            'Drafted Tokens': self.drafted_tokens,
+            'Accepted Tokens': self.accepted_tokens,
+            'Acceptance Rate': self.accepted_tokens / self.drafted_tokens if self.drafted_tokens else 0.0,
+            'Forward Passes': self.forward_passes,
+            'Tokens Per Forward Pass': self.generated_tokens / self.forward_passes if self.forward_passes else 0.0,
+            'Tokens Per Second': self.generated_tokens / self.seconds if self.seconds > 0 else 0.0,
+        }
+
+if __name__ == '__main__':
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    # tiny randomly initialised Llama models, decoded greedily, only need token ids and an eos id
+    class TokenIdTokenizer:
+        eos_token_id = 2
+
+        def decode(self, token_ids, skip_special_tokens=True):
+            return " ".join(str(token_id) for token_id in token_ids if not (skip_special_tokens and token_id == self.eos_token_id))
+
+    torch.manual_seed(16)
+    config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, max_position_embeddings=512, bos_token_id=1, eos_token_id=2)
+    model = LlamaForCausalLM(config).eval()
+    model.generation_config.do_sample = False
+    # the draft model keeps only the first layer of the model, so that the two roughly agree
+    draft_config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=1, num_attention_heads=4, max_position_embeddings=512, bos_token_id=1, eos_token_id=2)
+    draft_model = LlamaForCausalLM(draft_config).eval()
+    draft_model.load_state_dict(model.state_dict(), strict=False)
+    tokenizer = TokenIdTokenizer()
+
+    # prompts made of repeated runs, like the tag sequences of the few shot examples
+    prefix_ids = [1] + torch.randint(3, 12, (8,)).tolist() * 5
+    requests = [(prefix_ids + torch.randint(3, 12, (int(torch.randint(2, 12, ())),)).tolist(), int(torch.randint(4, 16, ()))) for _ in range(12)]
+
+    with torch.no_grad():
+        prefix_cache = (prefix_ids, model(torch.tensor([prefix_ids]), use_cache=True).past_key_values)
+
+    expected = []
+    for prompt_ids, word_count in requests:
+        # with no terminator in this vocabulary, a sentence ends after word_count + 1 tokens
+        expected_ids = model.generate(torch.tensor([prompt_ids]), attention_mask=torch.ones((1, len(prompt_ids)), dtype=torch.long), max_new_tokens=word_count + 1, do_sample=False, pad_token_id=2)[0, len(prompt_ids):]
+        expected.append(tokenizer.decode(expected_ids.tolist()))
+
+    def timed_run(drafter):
+        # the decoder's responses and seconds for every request, after an untimed warm-up request
+        # through a decoder of its own, which is left out of the stats
+        SpeculativeDecoder(model, tokenizer, drafter, prefix_cache=prefix_cache).generate(*requests[0])
+        decoder = SpeculativeDecoder(model, tokenizer, drafter, prefix_cache=prefix_cache)
+        start_time = time.perf_counter()
+        results = [decoder.generate(prompt_ids, word_count) for prompt_ids, word_count in requests]
+        return decoder, results, time.perf_counter() - start_time
+
+    # a drafter that never proposes a token leaves plain greedy decoding, one token per pass, from the
+    # same prefix cache, so that the speedup only measures drafting
+    plain_seconds = timed_run(PromptLookupDrafter(num_tokens=0))[2]
+
+    for drafter in [PromptLookupDrafter(num_tokens=8), DraftModelDrafter(draft_model, num_tokens=4)]:
+        decoder, results, seconds = timed_run(drafter)
+
+        mismatches = sum(result != expected_response for result, expected_response in zip(results, expected))
+        print(f"{type(drafter).__name__} mismatches against model.generate: {mismatches} of {len(requests)}, speedup {plain_seconds / seconds:.2f}x")
+        print(decoder.stats())
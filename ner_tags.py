@@ -0,0 +1,82 @@
+"""
+The closed MultiCoNER II tag inventory listed in the prompts of the llama_ner python scripts: 33 fine
+grained entity types grouped into six coarse categories, each with a B- and an I- tag, plus the O
+tag, for 67 tags in total. Each tag also has a compact code of a B/I letter followed by a two letter
+entity type code, which tokenizes to far fewer tokens than the full tag.
+"""
+
+ENTITY_TYPES = {
+    "Location (LOC)": ["Facility", "OtherLOC", "HumanSettlement", "Station"],
+    "Creative Work (CW)": ["VisualWork", "MusicalWork", "WrittenWork", "ArtWork", "Software"],
+    "Group (GRP)": ["MusicalGRP", "PublicCORP", "PrivateCORP", "AerospaceManufacturer", "SportsGRP", "CarManufacturer", "ORG"],
+    "Person (PER)": ["Scientist", "Artist", "Athlete", "Politician", "Cleric", "SportsManager", "OtherPER"],
+    "Product (PROD)": ["Clothing", "Vehicle", "Food", "Drink", "OtherPROD"],
+    "Medical (MED)": ["Medication/Vaccine", "MedicalProcedure", "AnatomicalStructure", "Symptom", "Disease"],
+}
+
+# Every tag in the same order as the prompt lists them
+BIO_TAGS = [
+    f"{prefix}-{entity_type}"
+    for entity_types in ENTITY_TYPES.values()
+    for entity_type in entity_types
+    for prefix in ("B", "I")
+] + ["O"]
+
+# Two letter code for each entity type, used to build the compact tags
+ENTITY_TYPE_CODES = {
+    "Facility": "FA", "OtherLOC": "OL", "HumanSettlement": "HS", "Station": "ST",
+    "VisualWork": "VW", "MusicalWork": "MW", "WrittenWork": "WW", "ArtWork": "AW", "Software": "SW",
+    "MusicalGRP": "MG", "PublicCORP": "PC", "PrivateCORP": "PV", "AerospaceManufacturer": "AM", "SportsGRP": "SG", "CarManufacturer": "CM", "ORG": "OR",
+    "Scientist": "SC", "Artist": "AR", "Athlete": "AT", "Politician": "PO", "Cleric": "CL", "SportsManager": "SM", "OtherPER": "OP",
+    "Clothing": "CT", "Vehicle": "VE", "Food": "FO", "Drink": "DR", "OtherPROD": "OD",
+    "Medication/Vaccine": "MV", "MedicalProcedure": "MP", "AnatomicalStructure": "AS", "Symptom": "SY", "Disease": "DI",
+}
+
+# Full tag to compact tag, e.g. B-Facility to BFA, with O left as it is
+COMPACT_TAG_CODES = {tag: tag if tag == 'O' else tag[0] + ENTITY_TYPE_CODES[tag[2:]] for tag in BIO_TAGS}
+
+def encode_tags(tags, tag_codes):
+    # maps full tags to their codes, leaving anything outside the inventory untouched
+    return [tag_codes.get(tag, tag) for tag in tags]
+
+def decode_tags(tags, tag_codes):
+    # maps codes back to full tags, leaving anything unrecognised for clean_and_align_predicted_tags
+    full_tags = {code: tag for tag, code in tag_codes.items()}
+    return [full_tags.get(tag, tag) for tag in tags]
+
+def describe_compact_tags(tag_codes):
+    # the prompt's listing of all possible tags, giving the B- and I- codes of each entity type
+    lines = [
+        f"{category}: " + ", ".join(f"{tag_codes['B-' + entity_type]}/{tag_codes['I-' + entity_type]} ({entity_type})" for entity_type in entity_types)
+        for category, entity_types in ENTITY_TYPES.items()
+    ]
+    lines.append(f"{tag_codes['O']} (Outside of any entity)")
+
+    return "\n".join(lines) + "\n"
+
+def compact_token_report(tokenizer, prompt, compact_prompt, reference_tags, tag_codes, terminator="#####"):
+    # token counts of the prompt and of the reference tag sequences (as they would be generated) in
+    # both the full and the compact tag alphabet, and the tokens saved per test sentence overall
+    def output_tokens(tags):
+        return len(tokenizer.encode(" " + " ".join(tags) + " " + terminator, add_special_tokens=False))
+
+    prompt_tokens = len(tokenizer.encode(prompt))
+    compact_prompt_tokens = len(tokenizer.encode(compact_prompt))
+    output_token_counts = [output_tokens(tags) for tags in reference_tags]
+    compact_output_token_counts = [output_tokens(encode_tags(tags, tag_codes)) for tags in reference_tags]
+
+    return {
+        'Prompt Tokens': prompt_tokens,
+        'Compact Prompt Tokens': compact_prompt_tokens,
+        'Mean Output Tokens': sum(output_token_counts) / len(output_token_counts),
+        'Mean Compact Output Tokens': sum(compact_output_token_counts) / len(compact_output_token_counts),
+        'Tokens Saved Per Sentence': (prompt_tokens - compact_prompt_tokens) + (sum(output_token_counts) - sum(compact_output_token_counts)) / len(output_token_counts),
+    }
+
+def can_follow(previous_tag, tag):
+    # O and every B- tag may appear anywhere, while an I- tag may only continue an entity of the same
+    # type, i.e. directly follow the B- or I- tag of that type
+    if not tag.startswith('I-'):
+        return True
+
+    return previous_tag is not None and previous_tag != 'O' and previous_tag[2:] == tag[2:]
@@ -0,0 +1,91 @@
+"""
+A buffered file writer that does its disk I/O on a background thread. Records are put on a bounded
+queue and the writer thread appends them to the file in batches, flushing once enough text has
+built up or enough time has passed, so writing decoded responses and predictions never blocks the
+decode loop on a file operation. If the thread fails, the error is raised on the next write or on
+close, and a write after close raises rather than being dropped.
+"""
+
+import queue
+import threading
+import time
+
+# Marks the end of the records on the queue
+_CLOSE = object()
+
+class AsyncFileWriter:
+
+    def __init__(self, path, mode='w', max_queue_size=1024, flush_size=64 * 1024, flush_interval=1.0):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.closed = False
+
+        self.file = open(path, mode, encoding='utf-8')
+        self.thread = threading.Thread(target=self._run, name=f"AsyncFileWriter({path})", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        buffer = []
+        buffered_size = 0
+        last_flush = time.monotonic()
+
+        try:
+            while True:
+                timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+                try:
+                    record = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    record = None
+
+                if record is not None and record is not _CLOSE:
+                    buffer.append(record)
+                    buffered_size += len(record)
+
+                # write out the buffer on the size or time threshold, and whatever is left on close
+                if buffer and (record is _CLOSE or buffered_size >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval):
+                    self.file.write("".join(buffer))
+                    self.file.flush()
+                    buffer = []
+                    buffered_size = 0
+                if not buffer:
+                    last_flush = time.monotonic()
+
+                if record is _CLOSE:
+                    break
+        except Exception as error:
+            self.error = error
+        finally:
+            self.file.close()
+
+    def _put(self, record):
+        # blocks while the queue is full, but not forever if the writer thread has died. A record
+        # the thread can no longer write raises its error, or that the writer is closed
+        while self.thread.is_alive():
+            try:
+                self.queue.put(record, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+        if self.error is not None:
+            raise self.error
+        raise RuntimeError(f"writer is closed: {self.path}")
+
+    def write(self, text):
+        if self.error is not None:
+            raise self.error
+        if self.closed:
+            raise RuntimeError(f"writer is closed: {self.path}")
+        self._put(text)
+
+    def close(self):
+        # closing again only waits for the thread and raises its error, if any
+        if not self.closed:
+            self.closed = True
+            self._put(_CLOSE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
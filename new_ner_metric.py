@@ -4,55 +4,211 @@ python scripts, and evaluates the model output using our own custom NER evaluati
 the accuracy of the generated entity tags irrespective of position (one metric includes the outside
 of entity set tag, and another excludes it), averaged across all test sentences for a given
 language.
+
+Each file is parsed in one pass into integer tag id arrays, and every score is computed with NumPy
+over those arrays: the custom metric from per-sentence tag histograms, and entity level precision,
+recall and F1-score (overall and per entity type) that match seqeval's default mode. The files are
+scored in parallel across a process pool, and each file's scores are written next to it. The same
+scores can be computed straight from a NerCorpus and the predicted tags with score_corpus.
 """
 
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-def eval_and_write_new_ner_metric(filename):
-    # given an input filename as described above, evaluates the model output with the hit rate by
-    # BIO tag classification, both including and excluding the O tag
+import numpy as np
 
-    sentence_str = "Sentence: "
-    prediction_str = "Predicted Tags: "
-    reference_str = "Reference Tags: "
+SENTENCE_STR = "Sentence: "
+PREDICTION_STR = "Predicted Tags: "
+REFERENCE_STR = "Reference Tags: "
 
-    num_correct = 0
-    num_correct_excluding_o = 0
-    total_tokens_excluding_o = 0
-    total_tokens = 0
+# Chunk tag codes, following seqeval's reading of the first character of each tag
+O, B, I, E, S, DOT, OTHER = range(7)
+CHUNK_TAG_CODES = {'O': O, 'B': B, 'I': I, 'E': E, 'S': S, '.': DOT}
+
+def read_tag_file(filename):
+    # one pass over a prediction vs. reference file, returning the unique tags and the predicted and
+    # reference tag id arrays, each with the number of tags in every sentence
     with open(filename, 'r', encoding='utf-8') as instream:
-        prediction_dict = {}
+        lines = instream.read().splitlines()
+
+    predicted = [line[len(PREDICTION_STR):].split() for line in lines if line.startswith(PREDICTION_STR)]
+    reference = [line[len(REFERENCE_STR):].split() for line in lines if line.startswith(REFERENCE_STR)]
+
+    predicted_lengths = np.array([len(tags) for tags in predicted], dtype=np.int64)
+    reference_lengths = np.array([len(tags) for tags in reference], dtype=np.int64)
+    tokens = np.array([tag for tags in predicted for tag in tags] + [tag for tags in reference for tag in tags] + ['O'], dtype=object)
+
+    vocabulary, tag_ids = np.unique(tokens, return_inverse=True)
+    predicted_ids = tag_ids[:predicted_lengths.sum()]
+    reference_ids = tag_ids[predicted_lengths.sum():-1]
+
+    return vocabulary, (predicted_ids, predicted_lengths), (reference_ids, reference_lengths)
+
+def position_free_accuracy(predicted, reference, o_id, vocabulary_size):
+    # the custom metric: within each sentence, a reference tag is correct if an unused copy of it is
+    # among the predicted tags, i.e. the per-sentence sum over tags of the smaller of the two counts
+    (predicted_ids, predicted_lengths), (reference_ids, reference_lengths) = predicted, reference
+    num_sentences = min(len(predicted_lengths), len(reference_lengths))
+    predicted_lengths, reference_lengths = predicted_lengths[:num_sentences], reference_lengths[:num_sentences]
+    predicted_ids, reference_ids = predicted_ids[:predicted_lengths.sum()], reference_ids[:reference_lengths.sum()]
+
+    size = num_sentences * vocabulary_size
+    predicted_counts = np.bincount(np.repeat(np.arange(num_sentences), predicted_lengths) * vocabulary_size + predicted_ids, minlength=size)
+    reference_counts = np.bincount(np.repeat(np.arange(num_sentences), reference_lengths) * vocabulary_size + reference_ids, minlength=size)
+    correct_counts = np.minimum(predicted_counts, reference_counts).reshape(num_sentences, vocabulary_size)
+
+    num_correct = int(correct_counts.sum())
+    num_correct_excluding_o = num_correct - int(correct_counts[:, o_id].sum())
+    total_tokens = len(reference_ids)
+    total_tokens_excluding_o = int((reference_ids != o_id).sum())
+
+    return {
+        'Token Accuracy Score Including O': num_correct / total_tokens if total_tokens else 0.0,
+        'Token Accuracy Score Excluding O': num_correct_excluding_o / total_tokens_excluding_o if total_tokens_excluding_o else 0.0,
+    }
+
+def extract_entities(tag_ids, lengths, chunk_codes, type_ids, o_id, start_type_id):
+    # seqeval's get_entities over the sentences joined with an O after each, as seqeval joins them,
+    # returned as arrays of entity types, first positions and last positions
+    sentence_ends = np.cumsum(lengths)
+    sequence = np.insert(tag_ids, sentence_ends, o_id)
+    sequence = np.append(sequence, o_id)
+
+    codes = chunk_codes[sequence]
+    types = type_ids[sequence]
+    previous_codes = np.concatenate([[O], codes[:-1]])
+    previous_types = np.concatenate([[start_type_id], types[:-1]])
+    type_changed = previous_types != types
+
+    chunk_end = (
+        (previous_codes == E) | (previous_codes == S)
+        | (((previous_codes == B) | (previous_codes == I)) & ((codes == B) | (codes == S) | (codes == O)))
+        | ((previous_codes != O) & (previous_codes != DOT) & type_changed)
+    )
+    chunk_start = (
+        (codes == B) | (codes == S)
+        | (((previous_codes == E) | (previous_codes == S) | (previous_codes == O)) & ((codes == E) | (codes == I)))
+        | ((codes != O) & (codes != DOT) & type_changed)
+    )
+
+    # each entity runs from the latest chunk start up to the token before its chunk end
+    start_positions = np.flatnonzero(chunk_start)
+    end_positions = np.flatnonzero(chunk_end) - 1
+    latest_start = np.searchsorted(start_positions, end_positions, side='right') - 1
+    begin_positions = np.where(latest_start >= 0, start_positions[np.maximum(latest_start, 0)], 0)
+
+    return previous_types[end_positions + 1], begin_positions, end_positions
 
-        for line in instream:
-            if line.startswith(sentence_str):
-                continue
+def entity_scores(predicted, reference, vocabulary, o_id):
+    # seqeval-equivalent micro averaged entity precision, recall and F1-score, overall and per type
+    chunk_codes = np.array([CHUNK_TAG_CODES.get(tag[0], OTHER) for tag in vocabulary], dtype=np.int8)
+    type_names, type_ids = np.unique([tag[1:].split('-', maxsplit=1)[-1] or '_' for tag in vocabulary] + [''], return_inverse=True)
+    start_type_id = type_ids[-1]
+    type_ids = type_ids[:-1]
 
-            elif line.startswith(prediction_str):
-                for predicted_tag in line[len(prediction_str):].split(" "):
-                    if predicted_tag not in prediction_dict:
-                        prediction_dict[predicted_tag] = 0
-                    prediction_dict[predicted_tag] += 1
+    predicted_types, predicted_begins, predicted_ends = extract_entities(*predicted, chunk_codes, type_ids, o_id, start_type_id)
+    reference_types, reference_begins, reference_ends = extract_entities(*reference, chunk_codes, type_ids, o_id, start_type_id)
 
-            elif line.startswith(reference_str):
-                for ref_tag in line[len(reference_str):].split(" "):
-                    if ref_tag in prediction_dict and prediction_dict[ref_tag] > 0:
-                        num_correct += 1
-                        prediction_dict[ref_tag] -= 1
+    # encode each (type, begin, end) entity as a single integer to match them with a set intersection
+    width = max(len(predicted[0]), len(reference[0])) + len(predicted[1]) + len(reference[1]) + 2
+    predicted_keys = (predicted_begins * width + predicted_ends) * len(type_names) + predicted_types
+    reference_keys = (reference_begins * width + reference_ends) * len(type_names) + reference_types
+    correct_types = np.intersect1d(predicted_keys, reference_keys) % len(type_names)
+
+    num_types = len(type_names)
+    predicted_counts = np.bincount(predicted_types, minlength=num_types)
+    reference_counts = np.bincount(reference_types, minlength=num_types)
+    correct_counts = np.bincount(correct_types, minlength=num_types)
+
+    def precision_recall_f1(correct, predicted_total, reference_total):
+        precision = correct / predicted_total if predicted_total else 0.0
+        recall = correct / reference_total if reference_total else 0.0
+        f1_score = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        return precision, recall, f1_score
+
+    precision, recall, f1_score = precision_recall_f1(int(correct_counts.sum()), int(predicted_counts.sum()), int(reference_counts.sum()))
+    scores = {'Precision': precision, 'Recall': recall, 'F1-Score': f1_score, 'Per Entity Type': {}}
+    for type_id in np.flatnonzero(predicted_counts + reference_counts):
+        type_precision, type_recall, type_f1_score = precision_recall_f1(int(correct_counts[type_id]), int(predicted_counts[type_id]), int(reference_counts[type_id]))
+        scores['Per Entity Type'][str(type_names[type_id])] = {
+            'Precision': type_precision,
+            'Recall': type_recall,
+            'F1-Score': type_f1_score,
+            'Support': int(reference_counts[type_id]),
+        }
+
+    return scores
+
+def score_tags(vocabulary, predicted, reference):
+    # every score for predicted and reference tags given as (tag ids, sentence lengths) over a vocabulary holding O
+    o_id = list(vocabulary).index('O')
+
+    scores = position_free_accuracy(predicted, reference, o_id, len(vocabulary))
+    scores.update(entity_scores(predicted, reference, vocabulary, o_id))
+
+    return scores
+
+def score_corpus(corpus, predicted_tags):
+    # every score for a list of predicted tag sequences against the reference tags of a NerCorpus,
+    # interning the predicted tags onto the corpus's tag ids
+    vocabulary = list(corpus.tag_names)
+    tag_index = {tag: tag_id for tag_id, tag in enumerate(vocabulary)}
+    if 'O' not in tag_index:
+        tag_index['O'] = len(vocabulary)
+        vocabulary.append('O')
+
+    predicted_ids = []
+    for tags in predicted_tags:
+        for tag in tags:
+            tag_id = tag_index.get(tag)
+            if tag_id is None:
+                tag_id = tag_index[tag] = len(vocabulary)
+                vocabulary.append(tag)
+            predicted_ids.append(tag_id)
+
+    predicted = (np.array(predicted_ids, dtype=np.int64), np.array([len(tags) for tags in predicted_tags], dtype=np.int64))
+    reference = (corpus.tag_ids.astype(np.int64), corpus.lengths)
+
+    return score_tags(vocabulary, predicted, reference)
+
+def custom_score_filepath(filename):
+    # the scores file sits next to the input file, named after it, e.g. en_custom_ner_score_sample_every.txt
+    # for en_predicted_vs_reference_tags_sample_every.txt. The 5 shot files from llama_ner_init_run.py
+    # (en_prediction_vs_reference_tags.txt) get an _init_run suffix so they never share a scores file
+    # with the 10 shot ones
+    directory, basename = os.path.split(filename)
+    stem = os.path.splitext(basename)[0]
+    if "predicted_vs_reference_tags" in stem:
+        return os.path.join(directory, stem.replace("predicted_vs_reference_tags", "custom_ner_score") + ".txt")
+    if "prediction_vs_reference_tags" in stem:
+        return os.path.join(directory, stem.replace("prediction_vs_reference_tags", "custom_ner_score") + "_init_run.txt")
+
+    return os.path.join(directory, stem + "_custom_ner_score.txt")
+
+def eval_and_write_new_ner_metric(filename):
+    # given an input filename as described above, evaluates the model output with the hit rate by
+    # BIO tag classification, both including and excluding the O tag, along with the entity scores
+    scores = score_tags(*read_tag_file(filename))
 
-                        if ref_tag != "O":
-                            num_correct_excluding_o += 1
-                    total_tokens += 1
+    with open(custom_score_filepath(filename), 'w', encoding='utf-8') as outstream:
+        outstream.write(f"Token Accuracy Score Including O: {scores['Token Accuracy Score Including O']}\n")
+        outstream.write(f"Token Accuracy Score Excluding O: {scores['Token Accuracy Score Excluding O']}\n")
+        outstream.write(f"Entity Precision: {scores['Precision']}, Recall: {scores['Recall']}, F1-Score: {scores['F1-Score']}\n")
+        for entity_type, type_scores in scores['Per Entity Type'].items():
+            outstream.write(f"{entity_type} Precision: {type_scores['Precision']}, Recall: {type_scores['Recall']}, F1-Score: {type_scores['F1-Score']}, Support: {type_scores['Support']}\n")
 
-                    if ref_tag != "O":
-                        total_tokens_excluding_o += 1
+    return scores
 
-                prediction_dict.clear()
+def eval_and_write_new_ner_metrics(filenames, max_workers=None):
+    # scores every file, in parallel across a process pool when there is more than one
+    if len(filenames) == 1:
+        return {filenames[0]: eval_and_write_new_ner_metric(filenames[0])}
 
-    with open(filename[:2] + "_custom_ner_score_sample_every.txt", 'w') as outstream:
-        outstream.write(f"Token Accuracy Score Including O: {num_correct / total_tokens}\n")
-        outstream.write(f"Token Accuracy Score Excluding O: {num_correct_excluding_o / total_tokens_excluding_o}\n")
+    with ProcessPoolExecutor(max_workers=max_workers or min(len(filenames), os.cpu_count() or 1)) as executor:
+        return dict(zip(filenames, executor.map(eval_and_write_new_ner_metric, filenames)))
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
-        for filename in sys.argv[1:]:
-            eval_and_write_new_ner_metric(filename)
+        for filename, scores in eval_and_write_new_ner_metrics(sys.argv[1:]).items():
+            print(f"{filename}: Including O: {scores['Token Accuracy Score Including O']}, Excluding O: {scores['Token Accuracy Score Excluding O']}, Entity F1-Score: {scores['F1-Score']}")